@@ -0,0 +1,71 @@
+"""
+Synthetic peaks dataset: reproducible, clustered like the real mountain ranges.
+
+Each peak is drawn in one of the ranges below (weighted by its size), around the range
+axis with a gaussian spread, and gets a height from a gamma distribution scaled to the
+range. Names are unique, like in the db.
+
+    python -m benchmarks.dataset 100000 > peaks.ndjson
+"""
+import json
+import random
+import sys
+from typing import Iterator
+
+# name, center latitude, center longitude, spread in latitude, spread in longitude,
+# typical height, max height, weight
+MOUNTAIN_RANGES = (
+    ("Himalaya", 28.5, 84.0, 2.0, 8.0, 5500, 8849, 14),
+    ("Karakoram", 35.8, 76.0, 1.0, 2.5, 5200, 8611, 4),
+    ("Andes", -20.0, -68.0, 18.0, 3.0, 4200, 6961, 14),
+    ("Rockies", 45.0, -112.0, 8.0, 5.0, 2800, 4401, 12),
+    ("Alps", 46.2, 9.0, 1.0, 4.0, 2600, 4808, 10),
+    ("Pyrenees", 42.7, 0.5, 0.4, 2.0, 2200, 3404, 3),
+    ("Caucasus", 42.8, 44.0, 0.8, 3.5, 3300, 5642, 4),
+    ("Tian Shan", 42.0, 80.0, 1.5, 6.0, 4000, 7439, 5),
+    ("Alaska Range", 62.5, -150.0, 1.0, 4.0, 2500, 6190, 4),
+    ("Scandes", 64.0, 14.0, 4.0, 3.0, 1300, 2469, 5),
+    ("East African Rift", -2.0, 36.0, 6.0, 2.0, 2500, 5895, 4),
+    ("Southern Alps", -43.5, 170.5, 1.2, 1.5, 2000, 3724, 3),
+    ("Kamchatka", 55.0, 159.5, 2.5, 1.5, 1800, 4754, 2),
+    ("Japanese Alps", 36.0, 137.5, 1.0, 1.0, 2200, 3776, 3),
+    ("Atlas", 31.5, -6.0, 1.0, 3.0, 2500, 4167, 3),
+    ("Appalachians", 38.0, -80.0, 6.0, 4.0, 900, 2037, 6),
+)
+
+_SYLLABLES = (
+    "al", "an", "ar", "ba", "bel", "ca", "cor", "da", "del", "do", "el", "en", "fa", "gar",
+    "ha", "ka", "kor", "la", "lan", "ma", "mon", "na", "nor", "pa", "pic", "ra", "ros",
+    "sa", "sel", "ta", "tor", "va", "vel", "za",
+)
+_PREFIXES = ("Mont", "Pic", "Mount", "Cerro", "Piz", "Punta", "Nevado", "Dent", "Aiguille")
+
+
+def generate_peaks(n: int, seed: int = 0) -> Iterator[dict]:
+    rnd = random.Random(seed)
+    weights = [r[-1] for r in MOUNTAIN_RANGES]
+    names = set()
+    for i in range(n):
+        _, lat_0, lon_0, lat_spread, lon_spread, typical, highest, _ = rnd.choices(MOUNTAIN_RANGES, weights)[0]
+        latitude = min(89.99, max(-89.99, rnd.gauss(lat_0, lat_spread)))
+        longitude = (rnd.gauss(lon_0, lon_spread) + 180.0) % 360.0 - 180.0
+        # a few very high peaks and many small ones
+        height = int(min(highest, max(100, rnd.gammavariate(6.0, typical / 6.0))))
+        name = "{} {}".format(
+            rnd.choice(_PREFIXES),
+            "".join(rnd.choice(_SYLLABLES) for _ in range(rnd.randint(2, 4))).capitalize(),
+        )
+        if name in names:
+            name = f"{name[:22]} {i}"
+        names.add(name)
+        yield {
+            "name": name,
+            "height": height,
+            "latitude": round(latitude, 6),
+            "longitude": round(longitude, 6),
+        }
+
+
+if __name__ == "__main__":
+    for peak in generate_peaks(int(sys.argv[1]), seed=int(sys.argv[2]) if len(sys.argv) > 2 else 0):
+        sys.stdout.write(json.dumps(peak) + "\n")
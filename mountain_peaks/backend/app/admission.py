@@ -0,0 +1,329 @@
+"""
+Admission control of the requests, per class of route: point reads, searches, full dumps
+and writes.
+
+Under a spike, the sync routes queue for a thread of the threadpool then for a connection
+of the db pool, and the cheap point reads wait behind the full dumps and the huge bboxes.
+Each class of route gets its own limit of requests in flight and its own bounded queue: a
+request finding the queue full, or waiting in it longer than the queue timeout, fails fast
+with a 503 and a Retry-After header, before holding a thread or a connection.
+The bbox searches are classified by their estimated number of peaks, from the in-memory
+indexes or the bbox area, before touching the db: the large ones are demoted to the dumps
+class, the oversized ones are rejected.
+The slots are taken by the route dependencies and released by AdmissionMiddleware once the
+response is fully sent, the streamed ones included.
+It is optional: only enabled when the env var PEAKS_ADMISSION is set to "YES".
+"""
+import asyncio
+import math
+from collections import deque
+from contextvars import ContextVar
+from os import getenv
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from ..db.models import DBPeak
+from .crud_ops import error_message
+from .grid_pyramid import get_grid_pyramid, zoom_for_cell_size
+from .peaks_count import get_peaks_count, set_peaks_count
+from .spatial_index import get_peak_index
+from .schemas import BBox as BBoxORM
+
+ROUTE_CLASSES = ("point", "search", "dump", "write")
+# (requests in flight, requests queued) of each class, per worker: their sum should stay
+# below the threadpool size (40 threads by default)
+DEFAULT_LIMITS = {"point": (16, 128), "search": (8, 32), "dump": (2, 4), "write": (6, 32)}
+# estimated number of peaks above which a bbox search is a dump, or is rejected
+DEFAULT_BBOX_DEMOTE = 10_000
+DEFAULT_BBOX_REJECT = 1_000_000
+# the estimate walks the pyramid cells of a zoom level with about this many cells per bbox side
+_ESTIMATE_CELLS_PER_SIDE = 4
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class RouteClassLimiter:
+    """Requests in flight and FIFO queue of a class of route, the slots are thread-safe"""
+
+    def __init__(self, name: str, max_in_flight: int, max_queued: int, queue_timeout: float):
+        if max_in_flight <= 0 or max_queued < 0:
+            raise ValueError("max_in_flight shall be strictly positive and max_queued positive")
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self._lock = Lock()
+
+    async def acquire(self) -> bool:
+        # False when the queue is full or the wait timed out, the request has to be shed
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._waiters:
+                self.in_flight += 1
+                return True
+            if len(self._waiters) >= self.max_queued:
+                self.rejected += 1
+                return False
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # cancelled while queued: a slot handed over meanwhile goes to the next request
+            if not self._leave(waiter):
+                self.release()
+            raise
+        if self._leave(waiter):
+            with self._lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def _leave(self, waiter: _Waiter) -> bool:
+        # True when the waiter left the queue without a slot, a slot handed over at the timeout is kept
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters.remove(waiter)
+            return True
+
+    def release(self) -> None:
+        # the slot goes to the first waiter, if any, else back to the pool
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+            else:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": len(self._waiters),
+                "rejected": self.rejected,
+                "max_in_flight": self.max_in_flight,
+                "max_queued": self.max_queued,
+            }
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[int, int]]] = None,
+        queue_timeout: float = 1.0,
+        retry_after: int = 1,
+        bbox_demote: int = DEFAULT_BBOX_DEMOTE,
+        bbox_reject: int = DEFAULT_BBOX_REJECT,
+        total_peaks: Optional[int] = None,
+    ):
+        limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.limiters = {
+            name: RouteClassLimiter(name, *limits[name], queue_timeout=queue_timeout) for name in ROUTE_CLASSES
+        }
+        self.retry_after = retry_after
+        self.bbox_demote = bbox_demote
+        # 0 means no rejection
+        self.bbox_reject = bbox_reject
+        if total_peaks is not None:
+            self.total_peaks = total_peaks
+
+    @property
+    def total_peaks(self) -> int:
+        # size of the table, for the estimates from the bbox area: counted when the controller is built,
+        # then kept up to date by the writes of the worker
+        return get_peaks_count()
+
+    @total_peaks.setter
+    def total_peaks(self, count: int) -> None:
+        set_peaks_count(count)
+
+    def render(self) -> str:
+        # Prometheus text exposition format, appended to the other metrics
+        lines = []
+        for metric, kind, help_text in (
+            ("in_flight", "gauge", "Requests in flight"),
+            ("queued", "gauge", "Requests waiting for a slot"),
+            ("rejected", "counter", "Requests shed with a 503"),
+        ):
+            name = f"peaks_admission_{metric}" + ("_total" if kind == "counter" else "")
+            lines += [f"# HELP {name} {help_text}, per class of route", f"# TYPE {name} {kind}"]
+            for route_class, limiter in self.limiters.items():
+                lines.append(f'{name}{{route_class="{route_class}"}} {limiter.stats()[metric]}')
+        return "\n".join(lines) + "\n"
+
+
+def _limits_from_env() -> Dict[str, Tuple[int, int]]:
+    # PEAKS_ADMISSION_POINT=16,128: 16 point reads in flight, 128 more queued
+    limits = {}
+    for name in ROUTE_CLASSES:
+        if value := getenv(f"PEAKS_ADMISSION_{name.upper()}"):
+            max_in_flight, max_queued = (int(part) for part in value.split(","))
+            limits[name] = (max_in_flight, max_queued)
+    return limits
+
+
+def build_admission(session: Session) -> AdmissionController:
+    return AdmissionController(
+        limits=_limits_from_env(),
+        queue_timeout=float(getenv("PEAKS_ADMISSION_QUEUE_TIMEOUT", "1.0")),
+        retry_after=int(getenv("PEAKS_ADMISSION_RETRY_AFTER", "1")),
+        bbox_demote=int(getenv("PEAKS_ADMISSION_BBOX_DEMOTE", str(DEFAULT_BBOX_DEMOTE))),
+        bbox_reject=int(getenv("PEAKS_ADMISSION_BBOX_REJECT", str(DEFAULT_BBOX_REJECT))),
+        total_peaks=session.scalar(select(func.count()).select_from(DBPeak)),
+    )
+
+
+# process-wide controller, None while the admission control is disabled
+_ADMISSION: Optional[AdmissionController] = None
+
+
+def get_admission() -> Optional[AdmissionController]:
+    return _ADMISSION
+
+
+def set_admission(admission: Optional[AdmissionController]) -> None:
+    global _ADMISSION
+    _ADMISSION = admission
+
+
+def estimate_bbox_peaks(bbox: BBoxORM, total_peaks: int = 0) -> int:
+    # about the number of peaks of the bbox, without touching the db: an upper bound from the
+    # cells of the in-memory indexes if any, else the share of the earth's surface of the bbox
+    estimate = 0
+    for lat_min, lat_max, lon_min, lon_max in bbox.parts():
+        if (pyramid := get_grid_pyramid()) is not None:
+            side = max(lat_max - lat_min, lon_max - lon_min, 1e-6)
+            zoom = min(pyramid.max_zoom, zoom_for_cell_size(side / _ESTIMATE_CELLS_PER_SIDE))
+            estimate += sum(cluster.count for cluster in pyramid.clusters(zoom, lat_min, lat_max, lon_min, lon_max))
+        elif (index := get_peak_index()) is not None:
+            estimate += index.count_upper_bound(lat_min, lat_max, lon_min, lon_max)
+        else:
+            surface_share = (
+                (math.sin(math.radians(lat_max)) - math.sin(math.radians(lat_min))) * (lon_max - lon_min) / 720.0
+            )
+            estimate += math.ceil(total_peaks * surface_share)
+    return estimate
+
+
+_REQUEST_SLOTS: ContextVar[Optional[List[RouteClassLimiter]]] = ContextVar("peaks_request_slots", default=None)
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware releasing the slots of a request once its response is sent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        slots: List[RouteClassLimiter] = []
+        token = _REQUEST_SLOTS.set(slots)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _REQUEST_SLOTS.reset(token)
+            for limiter in slots:
+                limiter.release()
+
+
+async def admit(route_class: str) -> None:
+    # take a slot of the class for the current request, or shed it with a 503
+    controller, slots = get_admission(), _REQUEST_SLOTS.get()
+    if controller is None or slots is None:
+        return
+    limiter = controller.limiters[route_class]
+    if not await limiter.acquire():
+        raise HTTPException(
+            503,
+            detail=error_message(f"Too many {route_class} requests in progress, retry later"),
+            headers={"Retry-After": str(controller.retry_after)},
+        )
+    slots.append(limiter)
+
+
+class Admission:
+    """Route dependency admitting the requests in a fixed class"""
+
+    def __init__(self, route_class: str):
+        if route_class not in ROUTE_CLASSES:
+            raise ValueError(f"Unknown route class {route_class}, expected one of {ROUTE_CLASSES}")
+        self.route_class = route_class
+
+    async def __call__(self) -> None:
+        await admit(self.route_class)
+
+
+admit_point = Admission("point")
+admit_search = Admission("search")
+admit_dump = Admission("dump")
+admit_write = Admission("write")
+
+
+async def admit_peaks_list(request: Request) -> None:
+    # the pages are searches, the whole table is a dump
+    await admit("search" if "limit" in request.query_params else "dump")
+
+
+async def _admit_bboxes(bboxes: List[BBoxORM]) -> None:
+    if (controller := get_admission()) is None:
+        return
+    estimate = sum(estimate_bbox_peaks(bbox, controller.total_peaks) for bbox in bboxes)
+    if controller.bbox_reject and estimate > controller.bbox_reject:
+        raise HTTPException(
+            422,
+            detail=error_message(
+                f"About {estimate} peaks in the bbox, more than the {controller.bbox_reject} allowed: "
+                "narrow it, or use /get_peaks_clusters or /peaks/ndjson"
+            ),
+        )
+    await admit("dump" if estimate > controller.bbox_demote else "search")
+
+
+async def _json_body(request: Request):
+    # the body already read by FastAPI, parsed again: the estimate runs before the route
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def admit_bbox(request: Request) -> None:
+    try:
+        bboxes = [BBoxORM.model_validate(await _json_body(request))]
+    except ValidationError:
+        # rejected with a 422 by the route validation anyway
+        bboxes = []
+    await _admit_bboxes(bboxes)
+
+
+async def admit_bboxes(request: Request) -> None:
+    body = await _json_body(request)
+    try:
+        bboxes = [BBoxORM.model_validate(item) for item in body] if isinstance(body, list) else []
+    except ValidationError:
+        bboxes = []
+    await _admit_bboxes(bboxes)
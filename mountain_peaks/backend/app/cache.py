@@ -0,0 +1,215 @@
+"""
+Read-through cache of the serialized responses of the read endpoints.
+
+The entries are keyed on the normalized request (an id, a PeakAttr, a BBox snapped to a
+grid) prefixed with a global data version. The version is bumped by the crud operations
+after each committed write, so that an entry computed before a write is never served
+again: stale entries are not looked up anymore and age out of the LRU/TTL.
+With the read replicas, the version only follows the writes, not the replication: the results
+read on a replica are cached for the replication lag at most, and the reads of a client which
+just wrote (possibly on another worker, whose version the local cache doesn't see) skip the
+lookup and go to the primary.
+
+The compressed variants of the bodies are cached too, keyed on the ETag of the body and
+the encoding: a repeated hit is served without compressing again.
+
+The default backend is an in-process LRU with a TTL. A backend shared between the workers
+(Redis, optional "redis" package) also shares the data version, so that a write on a
+worker invalidates the entries of all of them.
+"""
+import math
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Awaitable, Callable, Optional, Tuple
+
+from .compression import compress
+from .schemas import BBox as BBoxORM, PeakAttr as PeakAttrORM
+
+# the bboxes are snapped outward on this grid, degrees unit
+BBOX_GRID = 0.1
+
+
+class LocalResponseCache:
+    """In-process LRU cache with a time-to-live, holding the data version of the worker"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._version = 0
+        self._lock = Lock()
+
+    def data_version(self) -> int:
+        return self._version
+
+    def bump_data_version(self) -> None:
+        with self._lock:
+            self._version += 1
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body = entry
+            if expires_at < monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def set(self, key: str, body: bytes, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (monotonic() + (ttl if ttl is not None else self.ttl), body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisResponseCache:
+    """Cache shared by all the workers, the data version is a Redis counter"""
+
+    _VERSION_KEY = "mountain_peaks:data_version"
+
+    def __init__(self, url: str, ttl: float = 300.0):
+        # optional dependency, only needed with a shared cache
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def data_version(self) -> int:
+        return int(self._client.get(self._VERSION_KEY) or 0)
+
+    def bump_data_version(self) -> None:
+        self._client.incr(self._VERSION_KEY)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(f"mountain_peaks:{key}")
+
+    def set(self, key: str, body: bytes, ttl: Optional[float] = None) -> None:
+        self._client.set(f"mountain_peaks:{key}", body, px=int((ttl if ttl is not None else self.ttl) * 1000))
+
+    def clear(self) -> None:
+        for key in self._client.scan_iter("mountain_peaks:*"):
+            if key.decode() != self._VERSION_KEY:
+                self._client.delete(key)
+
+
+def build_response_cache():
+    ttl = float(getenv("PEAKS_RESPONSE_CACHE_TTL", "300"))
+    if url := getenv("PEAKS_RESPONSE_CACHE_URL"):
+        return RedisResponseCache(url=url, ttl=ttl)
+    return LocalResponseCache(max_entries=int(getenv("PEAKS_RESPONSE_CACHE_SIZE", "1024")), ttl=ttl)
+
+
+# process-wide cache, None while the response cache is disabled
+_RESPONSE_CACHE = None
+
+
+def get_response_cache():
+    return _RESPONSE_CACHE
+
+
+def set_response_cache(cache) -> None:
+    global _RESPONSE_CACHE
+    _RESPONSE_CACHE = cache
+
+
+def bump_data_version() -> None:
+    # called by the crud operations after each committed write
+    if _RESPONSE_CACHE is not None:
+        _RESPONSE_CACHE.bump_data_version()
+
+
+def _grid_bounds(bbox: BBoxORM) -> Tuple[int, int, int, int]:
+    return (
+        math.floor(bbox.latitude_min / BBOX_GRID),
+        math.ceil(bbox.latitude_max / BBOX_GRID),
+        math.floor(bbox.longitude_min / BBOX_GRID),
+        math.ceil(bbox.longitude_max / BBOX_GRID),
+    )
+
+
+def snap_bbox(bbox: BBoxORM) -> BBoxORM:
+    # smallest bbox aligned on the grid containing the given one:
+    # the nearby bboxes share the same cache entry, which is then refined to the exact bounds
+    i_min, i_max, j_min, j_max = _grid_bounds(bbox)
+    longitude_min = max(-180.0, min(bbox.longitude_min, j_min * BBOX_GRID))
+    longitude_max = min(180.0, max(bbox.longitude_max, j_max * BBOX_GRID))
+    if bbox.crosses_antimeridian and longitude_min <= longitude_max:
+        # both parts of the bbox grew until they met: all the longitudes are covered
+        longitude_min, longitude_max = -180.0, 180.0
+    return BBoxORM(
+        latitude_min=max(-90.0, min(bbox.latitude_min, i_min * BBOX_GRID)),
+        latitude_max=min(90.0, max(bbox.latitude_max, i_max * BBOX_GRID)),
+        longitude_min=longitude_min,
+        longitude_max=longitude_max,
+    )
+
+
+def bbox_key(bbox: BBoxORM) -> str:
+    # the bboxes crossing the antimeridian don't share the entries of the regular ones
+    prefix = "bbox-wrap" if bbox.crosses_antimeridian else "bbox"
+    return "{}:{}:{}:{}:{}".format(prefix, *_grid_bounds(bbox))
+
+
+def exact_bbox_key(bbox: BBoxORM) -> str:
+    # the exact bounds, for the bboxes searched without snapping
+    return "bbox-exact:{!r}:{!r}:{!r}:{!r}".format(
+        float(bbox.latitude_min), float(bbox.latitude_max), float(bbox.longitude_min), float(bbox.longitude_max)
+    )
+
+
+def attr_key(attr: PeakAttrORM) -> str:
+    if attr.name is not None:
+        return f"attr:name:{attr.name}"
+    return f"attr:height:{attr.height}"
+
+
+def read_through(key: str, produce: Callable[[], bytes], lookup: bool = True, ttl: Optional[float] = None) -> bytes:
+    # serve the body from the cache, or produce and store it; without lookup the body is produced
+    # and stored anyway, ttl overrides the time-to-live of the cache for the stored entry
+    cache = get_response_cache()
+    if cache is None:
+        return produce()
+    # the version is read before running the query: if a write is committed meanwhile,
+    # the entry is stored under the previous version and can't be served anymore
+    versioned_key = f"{cache.data_version()}:{key}"
+    if not lookup or (body := cache.get(versioned_key)) is None:
+        body = produce()
+        cache.set(versioned_key, body, ttl=ttl)
+    return body
+
+
+async def read_through_async(
+    key: str, produce: Callable[[], Awaitable[bytes]], lookup: bool = True, ttl: Optional[float] = None
+) -> bytes:
+    # same for the async routes
+    cache = get_response_cache()
+    if cache is None:
+        return await produce()
+    versioned_key = f"{cache.data_version()}:{key}"
+    if not lookup or (body := cache.get(versioned_key)) is None:
+        body = await produce()
+        cache.set(versioned_key, body, ttl=ttl)
+    return body
+
+
+def encode_through(body: bytes, etag: str, encoding: str) -> bytes:
+    # compressed variant of a body given to etag_response, from the cache or compressed and stored:
+    # the ETag identifies the body, the entry needs no data version
+    cache = get_response_cache()
+    if cache is None:
+        return compress(body, encoding)
+    key = f"encoded:{encoding}:{etag}"
+    if (encoded := cache.get(key)) is None:
+        encoded = compress(body, encoding)
+        cache.set(key, encoded)
+    return encoded
@@ -0,0 +1,217 @@
+"""
+Content negotiation and compression of the responses: gzip, and brotli or zstd when the
+optional "brotli" or "zstandard" packages are installed.
+
+- etag_response compresses the read bodies itself, with a distinct ETag per encoding. The
+  response cache keeps the compressed variants of its bodies, keyed on their ETag, so that
+  a repeated hit is served without compressing again.
+- CompressionMiddleware compresses the other responses above the size threshold, and the
+  streaming responses (the NDJSON dump) chunk by chunk, each chunk flushed to the client.
+The compression is only enabled with PEAKS_COMPRESSION=YES.
+"""
+import zlib
+from os import getenv
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    # optional dependency, brotli is only offered when installed
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    # optional dependency, zstd is only offered when installed
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# by order of preference when the client accepts several of them equally
+SUPPORTED_ENCODINGS = ("zstd", "br", "gzip")
+# the encodings offered, the ones whose package is installed
+ENCODINGS = tuple(
+    encoding for encoding in SUPPORTED_ENCODINGS if {"zstd": zstandard, "br": brotli}.get(encoding, zlib) is not None
+)
+# the bodies below this size are sent as is, the compression would not pay off
+DEFAULT_MIN_SIZE = 1024
+# media types worth compressing, the other responses are sent as is
+_COMPRESSIBLE_TYPES = (b"application/json", b"application/x-ndjson", b"text/")
+# fast levels: most of the bodies are compressed on the fly
+_GZIP_LEVEL = 6
+_BROTLI_QUALITY = 5
+_ZSTD_LEVEL = 3
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return zlib.compress(body, level=_GZIP_LEVEL, wbits=31)
+    if encoding == "br":
+        return brotli.compress(body, quality=_BROTLI_QUALITY)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(body)
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+class StreamCompressor:
+    """Compression of a stream, each chunk being flushed so that the client can decode it at once"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level=_GZIP_LEVEL, wbits=31)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=_BROTLI_QUALITY)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding {encoding}")
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "gzip":
+            return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def _accepted_qualities(accept_encoding: str) -> Dict[str, float]:
+    # "gzip;q=0.8, br, *;q=0" -> {"gzip": 0.8, "br": 1.0, "*": 0.0}
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+class CompressionSettings:
+    def __init__(self, min_size: int = DEFAULT_MIN_SIZE, encodings: Iterable[str] = ENCODINGS):
+        self.min_size = min_size
+        self.encodings = tuple(encodings)
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        # the preferred encoding among the ones of the client with the highest quality, None for identity
+        if not accept_encoding:
+            return None
+        qualities = _accepted_qualities(accept_encoding)
+        best, best_quality = None, 0.0
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, qualities.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+
+def build_compression() -> CompressionSettings:
+    return CompressionSettings(min_size=int(getenv("PEAKS_COMPRESSION_MIN_SIZE", str(DEFAULT_MIN_SIZE))))
+
+
+# process-wide settings, None while the compression is disabled
+_COMPRESSION: Optional[CompressionSettings] = None
+
+
+def get_compression() -> Optional[CompressionSettings]:
+    return _COMPRESSION
+
+
+def set_compression(compression: Optional[CompressionSettings]) -> None:
+    global _COMPRESSION
+    _COMPRESSION = compression
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    # a representation has its own strong ETag, "<hash>-<encoding>"
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else etag
+
+
+def decoded_etag(etag: str) -> str:
+    # ETag of the identity representation, the 304s hold for all the encodings of a body
+    tag, dash, encoding = etag.rpartition("-")
+    return f'{tag}"' if dash and encoding.rstrip('"') in SUPPORTED_ENCODINGS else etag
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware compressing the responses not compressed by the routes"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (settings := get_compression()) is None:
+            return await self.app(scope, receive, send)
+        accept_encoding = _header(scope.get("headers", []), b"accept-encoding")
+        encoding = settings.negotiate(accept_encoding.decode("latin-1") if accept_encoding else None)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        start_message = None
+        compressor: Optional[StreamCompressor] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                content_type = _header(headers, b"content-type") or b""
+                passthrough = (
+                    _header(headers, b"content-encoding") is not None
+                    or not content_type.startswith(_COMPRESSIBLE_TYPES)
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    # held until the first body chunk tells whether the body is worth compressing
+                    start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if start_message is not None:
+                start, start_message = start_message, None
+                if not more_body and len(body) < settings.min_size:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                headers = [
+                    (key, value) for key, value in start.get("headers", [])
+                    if key.lower() not in (b"content-length", b"etag")
+                ]
+                if (etag := _header(start.get("headers", []), b"etag")) is not None:
+                    headers.append((b"etag", encoded_etag(etag.decode("latin-1"), encoding).encode("latin-1")))
+                headers += [(b"content-encoding", encoding.encode()), (b"vary", b"Accept-Encoding")]
+                if not more_body:
+                    # whole body at once, one-shot compression
+                    compressed = compress(body, encoding)
+                    headers.append((b"content-length", str(len(compressed)).encode()))
+                    await send({**start, "headers": headers})
+                    await send({"type": "http.response.body", "body": compressed})
+                    passthrough = True
+                    return
+                await send({**start, "headers": headers})
+                compressor = StreamCompressor(encoding)
+            chunk = compressor.compress(body) if body else b""
+            if not more_body:
+                chunk += compressor.finish()
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,106 +1,741 @@
-from typing import List
+import heapq
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
-from sqlalchemy import select, and_, delete
+import numpy as np
+
+from sqlalchemy import bindparam, column, select, insert, table, update, and_, or_, delete, exists, func, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from ..db.models import DBPeak
+from ..db.config import pg_trgm_enabled, sqlite_rtree_enabled
+from ..db.hilbert import hilbert_boxes_ranges, hilbert_key, hilbert_keys
+from ..db.replicas import mark_write
+from ..db.models import DBPeak, DBPeakTombstone, DBRevision
+from .spatial_index import get_peak_index
+from .name_index import get_name_index
+from .height_index import get_height_index
+from .grid_pyramid import GridCluster, GridPyramid, cell_of, cell_size, get_grid_pyramid
+from .cache import bump_data_version
+from .single_flight import bump_write_generation
+from .peaks_count import count_written_peaks
+from .geo import MAX_DISTANCE_KM, circle_bounds, haversine_km, points_in_boxes, points_in_polygon
 from .schemas import (
+    Area as AreaORM,
     BBox as BBoxORM,
+    Coords as CoordsORM,
     Peak as PeakORM,
     PeakCreate as PeakCreateORM,
     PeakUpdate as PeakUpdateORM,
+    PeakBulkUpdate as PeakBulkUpdateORM,
     PeakAttr as PeakAttrORM,
 )
 
+# the columns of the Peak schema, in order
+_PEAK_COLUMNS = (DBPeak.pid, DBPeak.name, DBPeak.height, DBPeak.latitude, DBPeak.longitude)
+# max number of ids sent in a single "pid IN (...)" statement
+_IDS_CHUNK_SIZE = 1000
+# R*Tree index of the positions, created by the migrations on SQLite with PEAKS_SQLITE_RTREE=YES
+_PEAKS_RTREE = table(
+    "peaks_rtree", column("id"), column("latitude_min"), column("latitude_max"),
+    column("longitude_min"), column("longitude_max"),
+)
+# first search radius of the k nearest peaks, doubled until enough peaks are found
+_KNN_START_RADIUS_KM = 25.0
+
+
+def _select_peaks(as_rows: bool):
+    # the rows are plain (pid, name, height, latitude, longitude) tuples, cheaper than ORM objects
+    return select(*_PEAK_COLUMNS) if as_rows else select(DBPeak)
 
-def get_all_peaks(session: Session) -> List[DBPeak]:
-    return session.execute(select(DBPeak)).scalars().all()
 
+def _fetch_all(session: Session, select_peaks, as_rows: bool) -> list:
+    result = session.execute(select_peaks)
+    return result.all() if as_rows else result.scalars().all()
 
-def get_a_peak_by_id(session: Session, pid: int) -> DBPeak:
+
+def get_all_peaks(session: Session, as_rows: bool = False) -> List[DBPeak]:
+    return _fetch_all(session, _select_peaks(as_rows), as_rows)
+
+
+def get_peaks_page(session: Session, limit: int, after: Optional[int] = None) -> List[DBPeak]:
+    # keyset pagination on the primary key: the page starts right after the "after" pid
+    select_peaks = select(DBPeak).order_by(DBPeak.pid).limit(limit)
+    if after is not None:
+        select_peaks = select_peaks.where(DBPeak.pid > after)
+    return session.execute(select_peaks).scalars().all()
+
+
+def iter_all_peaks(session: Session, chunk_size: int = 1000) -> Iterator[List[Tuple[int, str, int, float, float]]]:
+    # yield the peaks rows by chunks, from a server-side cursor when the db driver supports it,
+    # so that the memory stays flat whatever the table size
+    select_peaks = select(*_PEAK_COLUMNS).order_by(DBPeak.pid).execution_options(yield_per=chunk_size)
+    yield from session.execute(select_peaks).partitions()
+
+
+def get_a_peak_by_id(session: Session, pid: int, as_rows: bool = False) -> DBPeak:
     # peak's id given
-    select_peaks = select(DBPeak).where(DBPeak.pid == pid)
-    peak_item = session.execute(select_peaks).scalar_one_or_none()
+    select_peaks = _select_peaks(as_rows).where(DBPeak.pid == pid)
+    peak_item = next(iter(_fetch_all(session, select_peaks, as_rows)), None)
     if peak_item is None:
         raise PeakNotFoundException
     return peak_item
 
 
-def find_peaks_into_bbox(session: Session, bbox: BBoxORM) -> List[DBPeak]:
-    # left-bottom-right-top given
-    select_peaks = select(DBPeak).where(and_(bbox.latitude_min <= DBPeak.latitude,
-                                             DBPeak.latitude <= bbox.latitude_max,
-                                             bbox.longitude_min <= DBPeak.longitude,
-                                             DBPeak.longitude <= bbox.longitude_max))
-    return session.execute(select_peaks).scalars().all()
+def get_peaks_by_ids(session: Session, pids: List[int], as_rows: bool = False) -> List[DBPeak]:
+    # fetch the rows by primary key, chunked to stay below the bound parameters limit
+    peak_items = []
+    for start in range(0, len(pids), _IDS_CHUNK_SIZE):
+        chunk = pids[start:start + _IDS_CHUNK_SIZE]
+        select_peaks = _select_peaks(as_rows).where(DBPeak.pid.in_(chunk)).order_by(DBPeak.pid)
+        peak_items.extend(_fetch_all(session, select_peaks, as_rows))
+    return peak_items
+
+
+def _get_peaks_in_order(session: Session, pids: List[int], as_rows: bool = False) -> List[DBPeak]:
+    # fetch the rows by primary key, in the order of the given pids
+    peak_items = {p.pid: p for p in get_peaks_by_ids(session=session, pids=pids, as_rows=as_rows)}
+    return [peak_items[pid] for pid in pids if pid in peak_items]
+
+
+def get_peaks_batch(
+    session: Session, pids: List[int], as_rows: bool = False
+) -> Tuple[Dict[int, DBPeak], List[int]]:
+    # the peaks found keyed by pid, and the missing pids in the given order, no exception raised
+    found = {peak_item.pid: peak_item for peak_item in get_peaks_by_ids(
+        session=session, pids=list(dict.fromkeys(pids)), as_rows=as_rows)}
+    missing = [pid for pid in dict.fromkeys(pids) if pid not in found]
+    return found, missing
+
+
+def _boxes_clause(session: Session, boxes: Sequence[Tuple[float, float, float, float]]):
+    # peaks inside any of the (lat_min, lat_max, lon_min, lon_max) boxes:
+    # the candidates come from an index on the positions, then are refined on the exact bounds
+    inside_boxes = or_(*(
+        and_(lat_min <= DBPeak.latitude, DBPeak.latitude <= lat_max,
+             lon_min <= DBPeak.longitude, DBPeak.longitude <= lon_max)
+        for lat_min, lat_max, lon_min, lon_max in boxes
+    ))
+    if session.get_bind().dialect.name == "sqlite" and sqlite_rtree_enabled():
+        overlapping = select(_PEAKS_RTREE.c.id).where(or_(*(
+            and_(_PEAKS_RTREE.c.latitude_max >= lat_min, _PEAKS_RTREE.c.latitude_min <= lat_max,
+                 _PEAKS_RTREE.c.longitude_max >= lon_min, _PEAKS_RTREE.c.longitude_min <= lon_max)
+            for lat_min, lat_max, lon_min, lon_max in boxes
+        )))
+        return and_(DBPeak.pid.in_(overlapping), inside_boxes)
+    in_ranges = or_(*(DBPeak.hkey.between(key_min, key_max) for key_min, key_max in hilbert_boxes_ranges(boxes)))
+    return and_(in_ranges, inside_boxes)
+
+
+def _bbox_clause(session: Session, bbox: BBoxORM):
+    return _boxes_clause(session, bbox.parts())
+
+
+def _pids_inside_boxes(index, boxes: Sequence[Tuple[float, float, float, float]]) -> List[int]:
+    # one pass on the in-memory index per box, the boxes may overlap
+    pids = set()
+    for box in boxes:
+        pids.update(index.query(*box))
+    return sorted(pids)
+
+
+def find_peaks_into_bbox(session: Session, bbox: BBoxORM, as_rows: bool = False) -> List[DBPeak]:
+    # left-bottom-right-top given, possibly across the antimeridian
+    if (index := get_peak_index()) is not None:
+        # the in-memory index resolves the bbox, the db is only hit by primary key
+        pids = _pids_inside_boxes(index, bbox.parts())
+        return get_peaks_by_ids(session=session, pids=pids, as_rows=as_rows)
+    return _fetch_all(session, _select_peaks(as_rows).where(_bbox_clause(session, bbox)), as_rows)
+
+
+def find_peaks_into_bboxes(session: Session, bboxes: List[BBoxORM], as_rows: bool = False) -> List[List[DBPeak]]:
+    # the peaks of each bbox, in the given order: the union of the bboxes is fetched at once,
+    # each peak is then dispatched to the bboxes containing it
+    boxes = [box for bbox in bboxes for box in bbox.parts()]
+    if (index := get_peak_index()) is not None:
+        peak_items = get_peaks_by_ids(session=session, pids=_pids_inside_boxes(index, boxes), as_rows=as_rows)
+    else:
+        select_peaks = _select_peaks(as_rows).where(_boxes_clause(session, boxes))
+        peak_items = _fetch_all(session, select_peaks.order_by(DBPeak.pid), as_rows)
+    return [[p for p in peak_items if bbox.contains(p.latitude, p.longitude)] for bbox in bboxes]
 
 
-def find_peaks_by_attr(session: Session, attr: PeakAttrORM) -> List[DBPeak]:
+def _inside_area(area: AreaORM, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    # vectorized refinement of the candidates: boxes then point-in-polygon tests
+    inside = points_in_boxes(latitudes, longitudes, [box for bbox in area.bboxes for box in bbox.parts()])
+    for polygon in area.polygons:
+        # only the candidates not already inside the area and inside the polygon bounds are tested
+        lat_min, lat_max, lon_min, lon_max = polygon.bounds()
+        to_test = ~inside & points_in_boxes(latitudes, longitudes, [(lat_min, lat_max, lon_min, lon_max)])
+        vertices = [(point.latitude, point.longitude) for point in polygon.points]
+        inside[to_test] = points_in_polygon(latitudes[to_test], longitudes[to_test], vertices)
+    return inside
+
+
+def find_peaks_into_area(session: Session, area: AreaORM, as_rows: bool = False) -> List[DBPeak]:
+    # peaks inside any of the bboxes or polygons of the area, with a single query (or index pass):
+    # the candidates are prefiltered on the boxes bounding the area, then refined in memory
+    boxes = [box for bbox in area.bboxes for box in bbox.parts()] + [polygon.bounds() for polygon in area.polygons]
+    if (index := get_peak_index()) is not None:
+        # the peaks deleted since the query of the index have no position anymore, they are skipped
+        located = [(pid, position) for pid in _pids_inside_boxes(index, boxes)
+                   if (position := index.position(pid)) is not None]
+        pids = np.array([pid for pid, _ in located], dtype=np.int64)
+        positions = np.array([position for _, position in located], dtype=float).reshape(-1, 2)
+        inside = _inside_area(area, positions[:, 0], positions[:, 1])
+        return get_peaks_by_ids(session=session, pids=pids[inside].tolist(), as_rows=as_rows)
+    select_peaks = _select_peaks(as_rows).where(_boxes_clause(session, boxes)).order_by(DBPeak.pid)
+    peak_items = _fetch_all(session, select_peaks, as_rows)
+    latitudes = np.fromiter((p.latitude for p in peak_items), dtype=float, count=len(peak_items))
+    longitudes = np.fromiter((p.longitude for p in peak_items), dtype=float, count=len(peak_items))
+    inside = _inside_area(area, latitudes, longitudes)
+    return [p for p, is_inside in zip(peak_items, inside) if is_inside]
+
+
+def find_peak_clusters(session: Session, bbox: BBoxORM, zoom: int) -> List[GridCluster]:
+    # the cells of the zoom level overlapping the bbox, with their count, centroid and highest peak
+    clusters = []
+    # a bbox crossing the antimeridian is split on a cell boundary, its parts share no cell
+    for bounds in bbox.parts():
+        if (pyramid := get_grid_pyramid()) is not None and zoom <= pyramid.max_zoom:
+            clusters.extend(pyramid.clusters(zoom, *bounds))
+            continue
+        # no precomputed pyramid: aggregate on the fly the peaks of the cells overlapping the bbox
+        lat_min, lat_max, lon_min, lon_max = bounds
+        size = cell_size(zoom)
+        i_min, j_min = cell_of(zoom, lat_min, lon_min)
+        i_max, j_max = cell_of(zoom, lat_max, lon_max)
+        cells_box = (-90.0 + i_min * size, min(90.0, -90.0 + (i_max + 1) * size),
+                     -180.0 + j_min * size, min(180.0, -180.0 + (j_max + 1) * size))
+        select_cells = _select_peaks(as_rows=True).where(_boxes_clause(session, [cells_box]))
+        rows = _fetch_all(session, select_cells, as_rows=True)
+        clusters.extend(GridPyramid(max_zoom=zoom).load(rows).clusters(zoom, *bounds))
+    return clusters
+
+
+def _positions_inside_circle(
+    session: Session, coords: CoordsORM, radius_km: float
+) -> List[Tuple[float, int]]:
+    # sorted (distance, pid) of the peaks inside the circle:
+    # the bboxes enclosing the circle prefilter the candidates, the haversine refines them
+    bounds = circle_bounds(coords.latitude, coords.longitude, radius_km)
+    if (index := get_peak_index()) is not None:
+        candidates = {}
+        for lat_min, lat_max, lon_min, lon_max in bounds:
+            for pid in index.query(lat_min, lat_max, lon_min, lon_max):
+                if (position := index.position(pid)) is not None:
+                    candidates[pid] = position
+        candidates = [(pid, lat, lon) for pid, (lat, lon) in candidates.items()]
+    else:
+        select_positions = (
+            select(DBPeak.pid, DBPeak.latitude, DBPeak.longitude).where(_boxes_clause(session, bounds))
+        )
+        candidates = session.execute(select_positions).all()
+    distances = []
+    for pid, latitude, longitude in candidates:
+        distance = haversine_km(coords.latitude, coords.longitude, latitude, longitude)
+        if distance <= radius_km:
+            distances.append((distance, pid))
+    distances.sort()
+    return distances
+
+
+def _peaks_with_distance(session: Session, distances: List[Tuple[float, int]]) -> List[Tuple[DBPeak, float]]:
+    peak_items = {p.pid: p for p in get_peaks_by_ids(session=session, pids=[pid for _, pid in distances])}
+    return [(peak_items[pid], distance) for distance, pid in distances if pid in peak_items]
+
+
+def find_peaks_around(session: Session, coords: CoordsORM, radius_km: float) -> List[Tuple[DBPeak, float]]:
+    # all the peaks within radius_km of the point, nearest first
+    distances = _positions_inside_circle(session=session, coords=coords, radius_km=radius_km)
+    return _peaks_with_distance(session=session, distances=distances)
+
+
+def find_nearest_peaks(session: Session, coords: CoordsORM, k: int) -> List[Tuple[DBPeak, float]]:
+    # the k nearest peaks of the point, nearest first
+    radius_km = _KNN_START_RADIUS_KM
+    while True:
+        distances = _positions_inside_circle(session=session, coords=coords, radius_km=radius_km)
+        # once k peaks are inside the circle, no peak outside can be nearer
+        if len(distances) >= k or radius_km >= MAX_DISTANCE_KM:
+            break
+        radius_km *= 2
+    return _peaks_with_distance(session=session, distances=distances[:k])
+
+
+def find_peaks_by_attr(session: Session, attr: PeakAttrORM, as_rows: bool = False) -> List[DBPeak]:
     attr_d = attr.model_dump()
     if len(attr_d) == 0:
         raise BadFormatEntryException
     if p_name := attr_d.get("name"):
         # peak's name given
-        select_peaks = select(DBPeak).where(DBPeak.name == p_name)
+        select_peaks = _select_peaks(as_rows).where(DBPeak.name == p_name)
         # no peaks should have the same name
-        req_by_name = session.execute(select_peaks).scalar_one_or_none()
-        peak_items = [req_by_name] if req_by_name is not None else []
+        peak_items = _fetch_all(session, select_peaks, as_rows)
     else:
         # peak's height given,
         # find it with a tolerance of 1 meter
         p_height = float(attr_d["height"])
-        select_peaks = select(DBPeak).where(
+        select_peaks = _select_peaks(as_rows).where(
             and_(
                 p_height + 1.0 >= DBPeak.height,
                 p_height - 1.0 <= DBPeak.height,
             )
         )
         # some peaks can have the same height
-        peak_items = session.execute(select_peaks).scalars().all()
+        peak_items = _fetch_all(session, select_peaks, as_rows)
     if len(peak_items) == 0:
         raise PeakNotFoundException
     return peak_items
 
 
-def check_peak_exists(session: Session, peak_data: PeakCreateORM) -> None:
-    # check if a peak has the same name in db
-    # if same name, raise an exception
-    attr_d = {}
-    for k, v in peak_data.model_dump().items():
-        if k in ["name", "height"]:
-            attr_d[k] = v
+def find_peaks_by_attrs(session: Session, attrs: List[PeakAttrORM], as_rows: bool = False) -> List[List[DBPeak]]:
+    # the peaks matching each attribute, in the given order, with a single query:
+    # an empty list instead of PeakNotFoundException for the attributes matching nothing
+    if not attrs:
+        return []
+    attrs_d = [attr.model_dump() for attr in attrs]
+    if any(not (attr_d.get("name") or attr_d.get("height")) for attr_d in attrs_d):
+        raise BadFormatEntryException
+    names = {attr_d["name"] for attr_d in attrs_d if attr_d.get("name")}
+    heights = {attr_d["height"] for attr_d in attrs_d if not attr_d.get("name")}
+    # same height tolerance of 1 meter as find_peaks_by_attr
+    clauses = [and_(height - 1 <= DBPeak.height, DBPeak.height <= height + 1) for height in sorted(heights)]
+    if names:
+        clauses.append(DBPeak.name.in_(names))
+    peak_items = _fetch_all(session, _select_peaks(as_rows).where(or_(*clauses)).order_by(DBPeak.pid), as_rows)
+    return [
+        [p for p in peak_items if p.name == attr_d["name"]] if attr_d.get("name")
+        else [p for p in peak_items if abs(p.height - attr_d["height"]) <= 1]
+        for attr_d in attrs_d
+    ]
+
+
+def find_peaks_by_height_range(
+    session: Session, height_min: int, height_max: int, limit: int, descending: bool = False, as_rows: bool = False
+) -> List[DBPeak]:
+    # peaks between the heights (bounds included), lowest first or highest first
+    if (index := get_height_index()) is not None:
+        pids = index.height_range(height_min, height_max, limit=limit, descending=descending)
+        return _get_peaks_in_order(session=session, pids=pids, as_rows=as_rows)
+    # the index on the height serves both the filter and the order, in either direction
+    order = (DBPeak.height.desc(), DBPeak.pid.desc()) if descending else (DBPeak.height, DBPeak.pid)
+    select_peaks = _select_peaks(as_rows).where(DBPeak.height.between(height_min, height_max))
+    return _fetch_all(session, select_peaks.order_by(*order).limit(limit), as_rows)
+
+
+def find_tallest_peaks(session: Session, n: int, bbox: Optional[BBoxORM] = None, as_rows: bool = False) -> List[DBPeak]:
+    # the n highest peaks, of the bbox if given, without sorting the whole table
+    boxes = bbox.parts() if bbox is not None else None
+    if (index := get_height_index()) is not None:
+        if boxes is not None and (spatial_index := get_peak_index()) is not None:
+            # the peaks of the bbox are known, the n highest are picked among them only
+            pids = heapq.nlargest(n, _pids_inside_boxes(spatial_index, boxes),
+                                  key=lambda pid: (index.height(pid) or 0, pid))
+        else:
+            # walk the heights from the highest down, until n peaks of the bbox are found
+            pids = index.tallest(n, boxes=boxes)
+        return _get_peaks_in_order(session=session, pids=pids, as_rows=as_rows)
+    select_peaks = _select_peaks(as_rows)
+    if boxes is not None:
+        select_peaks = select_peaks.where(_boxes_clause(session, boxes))
+    return _fetch_all(session, select_peaks.order_by(DBPeak.height.desc(), DBPeak.pid.desc()).limit(n), as_rows)
+
+
+def _like_prefix(prefix: str) -> str:
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%"
+
+
+def search_peaks_by_name(session: Session, query: str, k: int, as_rows: bool = False) -> List[DBPeak]:
+    # the k best matches of a name query: prefix matches (highest peaks first), then fuzzy ones
+    if (index := get_name_index()) is not None:
+        # resolved in memory, the db is only hit by primary key
+        return _get_peaks_in_order(session=session, pids=index.search(query, k), as_rows=as_rows)
+    prefix_match = DBPeak.name.ilike(_like_prefix(query), escape="\\")
+    if session.get_bind().dialect.name == "postgresql" and pg_trgm_enabled():
+        # "%" is the similarity operator of pg_trgm, served by the trigram index of the names
+        select_peaks = _select_peaks(as_rows).where(or_(prefix_match, DBPeak.name.op("%")(query))).order_by(
+            prefix_match.desc(), func.similarity(DBPeak.name, query).desc(), DBPeak.height.desc()
+        )
+    else:
+        # prefix matches only
+        select_peaks = _select_peaks(as_rows).where(prefix_match).order_by(DBPeak.height.desc(), DBPeak.name)
+    return _fetch_all(session, select_peaks.limit(k), as_rows)
+
+
+def get_current_revision(session: Session) -> int:
+    # the last revision below which every write is finished: no write can be committed there anymore
+    if session.get_bind().dialect.name == "postgresql":
+        # the transactions below the xmin of the current snapshot are all committed or aborted
+        return session.execute(select(func.txid_snapshot_xmin(func.txid_current_snapshot()) - 1)).scalar_one()
+    return session.execute(select(DBRevision.revision)).scalar_one()
+
+
+def get_peak_changes(
+    session: Session, since: int, limit: int, as_rows: bool = False
+) -> Tuple[List[DBPeak], List[int], int, bool]:
+    # peaks inserted or updated and pids deleted after the "since" revision, with the revision
+    # to give as "since" next time and whether more changes are left; about "limit" changes are
+    # returned, the changes of a revision are never split between two calls
+    current = get_current_revision(session)
+    changed = union_all(
+        select(DBPeak.revision).where(DBPeak.revision > since),
+        select(DBPeakTombstone.revision).where(DBPeakTombstone.revision > since),
+    ).subquery()
+    # the revision of the limit-th change, both lookups are range scans of the revision indexes
+    bound = session.execute(
+        select(changed.c.revision).order_by(changed.c.revision).offset(limit - 1).limit(1)
+    ).scalar_one_or_none()
+    # the writes committed after the counter was read are left for the next call
+    until = min(bound, current) if bound is not None else current
+    if until <= since:
+        return [], [], max(since, current), False
+    in_range = and_(DBPeak.revision > since, DBPeak.revision <= until)
+    select_peaks = _select_peaks(as_rows).where(in_range).order_by(DBPeak.revision, DBPeak.pid)
+    select_deleted = (
+        select(DBPeakTombstone.pid)
+        .where(DBPeakTombstone.revision > since, DBPeakTombstone.revision <= until)
+        # the sqlite pids can be reused: a peak inserted again is an upsert, not a deletion
+        .where(~exists().where(DBPeak.pid == DBPeakTombstone.pid))
+        .order_by(DBPeakTombstone.revision, DBPeakTombstone.pid)
+    )
+    upserted = _fetch_all(session, select_peaks, as_rows)
+    deleted = list(session.execute(select_deleted).scalars())
+    return upserted, deleted, until, until < current
+
+
+def _sync_after_write(upserted: List[PeakORM] = (), removed_pids: List[int] = (), added: int = 0) -> None:
+    # once a write is committed, keep the in-memory structures in sync with the db,
+    # added is the number of the upserted peaks which were inserted
     try:
-        return find_peaks_by_attr(session=session, attr=PeakAttrORM(**attr_d))[0]
-    except PeakNotFoundException:
-        # the peak elment does not exist yet
-        return False
+        _sync_indexes(upserted=upserted, removed_pids=removed_pids)
+        count_written_peaks(added=added, removed=len(removed_pids))
+    finally:
+        if upserted or removed_pids:
+            # the cached responses computed before this write are not served anymore, even if an index failed
+            bump_data_version()
+            # nor the results of the identical queries in flight
+            bump_write_generation()
+            # the next reads of this client go to the primary, until the replicas have the write
+            mark_write()
+
+
+def _sync_indexes(upserted: List[PeakORM], removed_pids: List[int]) -> None:
+    if (index := get_peak_index()) is not None:
+        for peak in upserted:
+            index.upsert(peak.pid, peak.latitude, peak.longitude)
+        for pid in removed_pids:
+            index.remove(pid)
+    if (name_index := get_name_index()) is not None:
+        for peak in upserted:
+            name_index.upsert(peak.pid, peak.name, peak.height)
+        for pid in removed_pids:
+            name_index.remove(pid)
+    if (height_index := get_height_index()) is not None:
+        for peak in upserted:
+            height_index.upsert(peak.pid, peak.height, peak.latitude, peak.longitude)
+        for pid in removed_pids:
+            height_index.remove(pid)
+    if (pyramid := get_grid_pyramid()) is not None:
+        for peak in upserted:
+            pyramid.upsert(peak.pid, peak.name, peak.height, peak.latitude, peak.longitude)
+        for pid in removed_pids:
+            pyramid.remove(pid)
+
+
+def _revision(session: Session):
+    # revision of the rows written by a statement, computed by the statement itself: no round-trip before it
+    if session.get_bind().dialect.name == "postgresql":
+        # the id of the write transaction: no row shared by the writers, which don't wait for each other;
+        # the revisions may be committed out of order, get_current_revision only counts the finished ones
+        return func.txid_current()
+    # the next value of the counter row, moved up by the triggers of the peaks table (db/migrate.py):
+    # the row stays locked until the commit, so the revisions are committed in order and a reader never
+    # skips a revision committed late (sqlite serializes the writers anyway); each statement of a
+    # transaction, and each deleted peak, takes its own revision
+    return select(DBRevision.revision + 1).scalar_subquery()
+
+
+def _delete_peak_rows(session: Session, where) -> list:
+    # DELETE ... RETURNING, the tombstones of the deleted peaks are written by the same statement:
+    # in a CTE on PostgreSQL, by a trigger of the peaks table otherwise (db/migrate.py)
+    delete_peaks = delete(DBPeak).where(where).returning(*_PEAK_COLUMNS)
+    if session.get_bind().dialect.name != "postgresql":
+        return session.execute(delete_peaks).all()
+    deleted = delete_peaks.cte("deleted_peaks")
+    insert_tombstones = postgresql.insert(DBPeakTombstone).from_select(
+        ["pid", "revision"], select(deleted.c.pid, _revision(session))
+    )
+    insert_tombstones = insert_tombstones.on_conflict_do_update(
+        index_elements=[DBPeakTombstone.pid], set_={"revision": insert_tombstones.excluded.revision}
+    )
+    return session.execute(select(deleted).add_cte(insert_tombstones.cte("inserted_tombstones"))).all()
+
+
+def _insert_skipping_duplicates(session: Session):
+    # INSERT ... ON CONFLICT (name) DO NOTHING on the dialects supporting it, plain INSERT otherwise
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "postgresql":
+        return postgresql.insert(DBPeak).on_conflict_do_nothing(index_elements=[DBPeak.name])
+    if dialect_name == "sqlite":
+        return sqlite.insert(DBPeak).on_conflict_do_nothing(index_elements=[DBPeak.name])
+    return insert(DBPeak)
+
+
+def _already_exists(session: Session, name: str) -> "PeakAlreadyExistsException":
+    session.rollback()
+    return PeakAlreadyExistsException(find_existing_names(session=session, names=[name]).get(name))
 
 
 def add_a_peak(session: Session, peak: PeakCreateORM) -> PeakORM:
-    db_peak = DBPeak(**peak.model_dump())
-    # peak_model = DBPeak.model_validate(peak)  # AVEC SQLModel
-    session.add(db_peak)
+    # a single INSERT ... RETURNING statement, the unique index on the name rejects duplicates
+    # even under concurrent writers
+    hkey = hilbert_key(peak.latitude, peak.longitude)
+    insert_peak = (
+        _insert_skipping_duplicates(session)
+        .values(**peak.model_dump(), revision=_revision(session), hkey=hkey)
+        .returning(*_PEAK_COLUMNS)
+    )
+    try:
+        row = session.execute(insert_peak).one_or_none()
+    except IntegrityError:
+        raise _already_exists(session=session, name=peak.name)
+    if row is None:
+        # ON CONFLICT DO NOTHING, the name is already used
+        raise _already_exists(session=session, name=peak.name)
+    session.commit()
+    added_peak = PeakORM(**row._asdict())
+    _sync_after_write(upserted=[added_peak], added=1)
+    return added_peak
+
+
+def find_existing_names(session: Session, names: List[str]) -> Dict[str, int]:
+    # pids of the peaks already in db among the given names, in a single query
+    existing = {}
+    for start in range(0, len(names), _IDS_CHUNK_SIZE):
+        select_names = select(DBPeak.name, DBPeak.pid).where(DBPeak.name.in_(names[start:start + _IDS_CHUNK_SIZE]))
+        existing.update(session.execute(select_names).all())
+    return existing
+
+
+def _insert_peak_rows(session: Session, peaks: List[PeakCreateORM]) -> List[PeakORM]:
+    # a single executemany INSERT ... RETURNING, not committed: the duplicated names are skipped
+    insert_peaks = _insert_skipping_duplicates(session).values(revision=_revision(session)).returning(*_PEAK_COLUMNS)
+    keys = hilbert_keys([peak.latitude for peak in peaks], [peak.longitude for peak in peaks])
+    rows = session.execute(insert_peaks, [
+        {**peak.model_dump(), "hkey": int(key)} for peak, key in zip(peaks, keys)
+    ]).all()
+    return [PeakORM(**row._asdict()) for row in rows]
+
+
+def add_peaks(session: Session, peaks: List[PeakCreateORM]) -> List[PeakORM]:
+    # insert a batch of peaks with a single executemany statement and a single commit,
+    # the peaks whose name is already used are skipped and not returned
+    if not peaks:
+        return []
+    added_peaks = _insert_peak_rows(session=session, peaks=peaks)
     session.commit()
-    session.refresh(db_peak)
-    return PeakORM(**db_peak.__dict__)
+    _sync_after_write(upserted=added_peaks, added=len(added_peaks))
+    return added_peaks
 
 
 def update_a_peak(session: Session, peak_id: int, peak_data: PeakUpdateORM) -> PeakORM:
-    peak_item = get_a_peak_by_id(session=session, pid=peak_id)
     # .model_dump() returns a dictionary of the model's fields and values
-    for k, v in peak_data.model_dump().items():
-        if v is not None:
-            setattr(peak_item, k, v)
+    changes = peak_data.model_dump(exclude_none=True)
+    if not changes:
+        return PeakORM.model_validate(get_a_peak_by_id(session=session, pid=peak_id))
+    if "latitude" in changes or "longitude" in changes:
+        # the Hilbert key follows the position, the missing coordinate is read first
+        if "latitude" not in changes or "longitude" not in changes:
+            select_position = select(DBPeak.latitude, DBPeak.longitude).where(DBPeak.pid == peak_id)
+            if (position := session.execute(select_position).one_or_none()) is None:
+                raise PeakNotFoundException
+            changes = {**position._asdict(), **changes}
+        changes["hkey"] = hilbert_key(changes["latitude"], changes["longitude"])
+    # a single UPDATE ... RETURNING statement, no SELECT before nor refresh after,
+    # unless only one coordinate of the position changes
+    update_peak = (
+        update(DBPeak)
+        .where(DBPeak.pid == peak_id)
+        .values(**changes, revision=_revision(session))
+        .returning(*_PEAK_COLUMNS)
+    )
+    try:
+        row = session.execute(update_peak).one_or_none()
+    except IntegrityError:
+        raise _already_exists(session=session, name=changes.get("name"))
+    if row is None:
+        session.rollback()
+        raise PeakNotFoundException
     session.commit()
-    session.refresh(peak_item)
-    return PeakORM(**peak_item.__dict__)
+    updated_peak = PeakORM(**row._asdict())
+    _sync_after_write(upserted=[updated_peak])
+    return updated_peak
 
 
 def delete_a_peak(session: Session, peak_id: int) -> PeakORM:
-    peak_item = get_a_peak_by_id(session=session, pid=peak_id)
-    session.execute(delete(DBPeak).where(DBPeak.pid == peak_id))
+    # a single DELETE ... RETURNING statement, which also keeps the tombstone for the changes feed
+    rows = _delete_peak_rows(session=session, where=DBPeak.pid == peak_id)
+    if not rows:
+        session.rollback()
+        raise PeakNotFoundException
+    row = rows[0]
     session.commit()
-    return PeakORM(**peak_item.__dict__)
+    _sync_after_write(removed_pids=[peak_id])
+    return PeakORM(**row._asdict())
+
+
+def _bulk_update_errors(
+    session: Session, updates: List[PeakBulkUpdateORM]
+) -> Tuple[Dict[int, str], Dict[int, Tuple[float, float]]]:
+    # rejected pids of a bulk update, with one query for the unknown pids and one for the used names,
+    # and the current positions of the existing peaks
+    errors = {}
+    seen_pids = set()
+    for peak_data in updates:
+        if peak_data.pid in seen_pids:
+            errors[peak_data.pid] = "pid given more than once"
+        seen_pids.add(peak_data.pid)
+    existing = get_peaks_by_ids(session=session, pids=sorted(seen_pids), as_rows=True)
+    positions = {p.pid: (p.latitude, p.longitude) for p in existing}
+    for pid in seen_pids - positions.keys():
+        errors[pid] = "no peak found with this id"
+    new_names = {}
+    for peak_data in updates:
+        if peak_data.name is not None:
+            new_names.setdefault(peak_data.name, []).append(peak_data.pid)
+    used_names = find_existing_names(session=session, names=list(new_names))
+    for name, pids in new_names.items():
+        for pid in pids:
+            if len(pids) > 1:
+                errors.setdefault(pid, f"name {name} given more than once")
+            elif used_names.get(name, pid) != pid:
+                errors.setdefault(pid, f"name {name} already used by the peak {used_names[name]}")
+    return errors, positions
+
+
+def _update_peak_rows(
+    session: Session, valid: List[PeakBulkUpdateORM], positions: Dict[int, Tuple[float, float]]
+) -> bool:
+    # executemany UPDATE by primary key, not committed, False when there was nothing to change
+    changes = [peak_data.model_dump(exclude_none=True) for peak_data in valid]
+    changes = [peak_changes for peak_changes in changes if len(peak_changes) > 1]
+    moved = [peak_changes for peak_changes in changes if "latitude" in peak_changes or "longitude" in peak_changes]
+    if moved:
+        # the Hilbert keys follow the positions, the unchanged coordinates are the current ones
+        latitudes = [peak_changes.get("latitude", positions[peak_changes["pid"]][0]) for peak_changes in moved]
+        longitudes = [peak_changes.get("longitude", positions[peak_changes["pid"]][1]) for peak_changes in moved]
+        for peak_changes, key in zip(moved, hilbert_keys(latitudes, longitudes)):
+            peak_changes["hkey"] = int(key)
+    if not changes:
+        return False
+    # the rows are grouped by set of changed columns, a statement per group
+    groups: Dict[Tuple[str, ...], List[dict]] = {}
+    for peak_changes in changes:
+        groups.setdefault(tuple(column for column in peak_changes if column != "pid"), []).append(peak_changes)
+    try:
+        for columns, group in groups.items():
+            update_peaks = (
+                update(DBPeak.__table__)
+                .where(DBPeak.pid == bindparam("b_pid"))
+                .values(revision=_revision(session), **{column: bindparam(column) for column in columns})
+            )
+            session.execute(update_peaks, [
+                {"b_pid": peak_changes["pid"], **{column: peak_changes[column] for column in columns}}
+                for peak_changes in group
+            ])
+    except IntegrityError:
+        # a concurrent writer took a name meanwhile
+        session.rollback()
+        raise PeakAlreadyExistsException(None)
+    return True
+
+
+def _peaks_by_ids(session: Session, pids: List[int]) -> List[PeakORM]:
+    return [PeakORM(**row._asdict()) for row in get_peaks_by_ids(session=session, pids=pids, as_rows=True)]
+
+
+def update_peaks(
+    session: Session, updates: List[PeakBulkUpdateORM], atomic: bool = False
+) -> Tuple[List[PeakORM], Dict[int, str]]:
+    # apply many updates with a single executemany statement and a single commit:
+    # the rejected updates are reported, or reject them all in atomic mode
+    errors, positions = _bulk_update_errors(session=session, updates=updates)
+    if errors and atomic:
+        raise BulkWriteException(errors)
+    valid = [peak_data for peak_data in updates if peak_data.pid not in errors]
+    changed = False
+    if any(len(peak_data.model_dump(exclude_none=True)) > 1 for peak_data in valid):
+        changed = _update_peak_rows(session=session, valid=valid, positions=positions)
+        session.commit()
+    updated_peaks = _peaks_by_ids(session=session, pids=[peak_data.pid for peak_data in valid])
+    _sync_after_write(upserted=updated_peaks if changed else [])
+    return updated_peaks, errors
+
+
+def commit_peak_writes(
+    session: Session, peaks: List[PeakCreateORM], updates: List[PeakBulkUpdateORM]
+) -> Tuple[List[PeakORM], List[int], Dict[int, str], bool]:
+    # the transaction of write_peaks: returns the peaks added, the pids of the valid updates,
+    # the rejected updates and whether a row was updated; to be followed by finish_peak_writes
+    added_peaks = _insert_peak_rows(session=session, peaks=peaks) if peaks else []
+    errors, valid, changed = {}, [], False
+    if updates:
+        # after the inserts, so that a name taken by one of them is rejected
+        errors, positions = _bulk_update_errors(session=session, updates=updates)
+        valid = [peak_data for peak_data in updates if peak_data.pid not in errors]
+        changed = _update_peak_rows(session=session, valid=valid, positions=positions)
+    if added_peaks or changed:
+        session.commit()
+    else:
+        # nothing written
+        session.rollback()
+    return added_peaks, [peak_data.pid for peak_data in valid], errors, changed
+
+
+def finish_peak_writes(
+    session: Session, added_peaks: List[PeakORM], updated_pids: List[int], changed: bool
+) -> List[PeakORM]:
+    # once commit_peak_writes is committed: the updated peaks as written, the in-memory structures in sync
+    updated_peaks = _peaks_by_ids(session=session, pids=updated_pids)
+    _sync_after_write(upserted=added_peaks + (updated_peaks if changed else []), added=len(added_peaks))
+    return updated_peaks
+
+
+def write_peaks(
+    session: Session, peaks: List[PeakCreateORM], updates: List[PeakBulkUpdateORM]
+) -> Tuple[List[PeakORM], List[PeakORM], Dict[int, str]]:
+    # inserts and updates of many peaks in a single transaction (a single revision on PostgreSQL): returns the
+    # peaks added (the already used names are skipped), the peaks updated and the rejected updates
+    added_peaks, updated_pids, errors, changed = commit_peak_writes(session=session, peaks=peaks, updates=updates)
+    updated_peaks = finish_peak_writes(
+        session=session, added_peaks=added_peaks, updated_pids=updated_pids, changed=changed
+    )
+    return added_peaks, updated_peaks, errors
+
+
+def delete_peaks(session: Session, pids: List[int], atomic: bool = False) -> Tuple[List[PeakORM], List[int]]:
+    # DELETE ... WHERE pid IN (...) RETURNING, in a single transaction: the unknown pids are
+    # reported, or nothing is deleted in atomic mode
+    pids = list(dict.fromkeys(pids))
+    deleted_peaks = []
+    for start in range(0, len(pids), _IDS_CHUNK_SIZE):
+        rows = _delete_peak_rows(session=session, where=DBPeak.pid.in_(pids[start:start + _IDS_CHUNK_SIZE]))
+        deleted_peaks.extend(PeakORM(**row._asdict()) for row in rows)
+    deleted_pids = {peak.pid for peak in deleted_peaks}
+    missing = [pid for pid in pids if pid not in deleted_pids]
+    if missing and atomic:
+        session.rollback()
+        raise BulkWriteException({pid: "no peak found with this id" for pid in missing})
+    if deleted_pids:
+        session.commit()
+    else:
+        # nothing deleted
+        session.rollback()
+    deleted_peaks.sort(key=lambda peak: peak.pid)
+    _sync_after_write(removed_pids=sorted(deleted_pids))
+    return deleted_peaks, missing
 
 
 def error_message(message):
@@ -113,3 +748,18 @@ class PeakNotFoundException(Exception):
 
 class BadFormatEntryException(Exception):
     pass
+
+
+class PeakAlreadyExistsException(Exception):
+    # args[0] is the pid of the peak already using the name, when known
+    pass
+
+
+class BulkWriteException(Exception):
+    # args[0] maps the rejected pids to the reason, nothing was written
+    pass
+
+
+class WriteQueueFullException(Exception):
+    # the write-behind queue holds too many pending writes, the write is not accepted
+    pass
@@ -0,0 +1,127 @@
+"""
+Async counterparts of the crud operations, for the AsyncSession-based routes.
+
+Each operation runs the sync one through AsyncSession.run_sync: the statements are the
+same, but the db IO is awaited on the event loop (asyncpg, aiosqlite) instead of
+blocking a thread of the threadpool.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db.models import DBPeak
+from . import crud_ops
+from .grid_pyramid import GridCluster
+from .schemas import (
+    Area as AreaORM,
+    BBox as BBoxORM,
+    Coords as CoordsORM,
+    Peak as PeakORM,
+    PeakCreate as PeakCreateORM,
+    PeakUpdate as PeakUpdateORM,
+    PeakBulkUpdate as PeakBulkUpdateORM,
+    PeakAttr as PeakAttrORM,
+)
+
+
+async def get_all_peaks(session: AsyncSession, as_rows: bool = False) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.get_all_peaks, as_rows=as_rows)
+
+
+async def get_peaks_page(session: AsyncSession, limit: int, after: Optional[int] = None) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.get_peaks_page, limit=limit, after=after)
+
+
+async def get_a_peak_by_id(session: AsyncSession, pid: int, as_rows: bool = False) -> DBPeak:
+    return await session.run_sync(crud_ops.get_a_peak_by_id, pid=pid, as_rows=as_rows)
+
+
+async def get_peaks_by_ids(session: AsyncSession, pids: List[int]) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.get_peaks_by_ids, pids=pids)
+
+
+async def get_peaks_batch(session: AsyncSession, pids: List[int]) -> Tuple[Dict[int, DBPeak], List[int]]:
+    return await session.run_sync(crud_ops.get_peaks_batch, pids=pids)
+
+
+async def find_peaks_into_bbox(session: AsyncSession, bbox: BBoxORM, as_rows: bool = False) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.find_peaks_into_bbox, bbox=bbox, as_rows=as_rows)
+
+
+async def find_peaks_into_bboxes(session: AsyncSession, bboxes: List[BBoxORM]) -> List[List[DBPeak]]:
+    return await session.run_sync(crud_ops.find_peaks_into_bboxes, bboxes=bboxes)
+
+
+async def find_peaks_into_area(session: AsyncSession, area: AreaORM, as_rows: bool = False) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.find_peaks_into_area, area=area, as_rows=as_rows)
+
+
+async def find_peak_clusters(session: AsyncSession, bbox: BBoxORM, zoom: int) -> List[GridCluster]:
+    return await session.run_sync(crud_ops.find_peak_clusters, bbox=bbox, zoom=zoom)
+
+
+async def find_peaks_around(session: AsyncSession, coords: CoordsORM, radius_km: float) -> List[Tuple[DBPeak, float]]:
+    return await session.run_sync(crud_ops.find_peaks_around, coords=coords, radius_km=radius_km)
+
+
+async def find_nearest_peaks(session: AsyncSession, coords: CoordsORM, k: int) -> List[Tuple[DBPeak, float]]:
+    return await session.run_sync(crud_ops.find_nearest_peaks, coords=coords, k=k)
+
+
+async def find_peaks_by_attr(session: AsyncSession, attr: PeakAttrORM, as_rows: bool = False) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.find_peaks_by_attr, attr=attr, as_rows=as_rows)
+
+
+async def find_peaks_by_attrs(session: AsyncSession, attrs: List[PeakAttrORM]) -> List[List[DBPeak]]:
+    return await session.run_sync(crud_ops.find_peaks_by_attrs, attrs=attrs)
+
+
+async def search_peaks_by_name(session: AsyncSession, query: str, k: int, as_rows: bool = False) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.search_peaks_by_name, query=query, k=k, as_rows=as_rows)
+
+
+async def get_peak_changes(
+    session: AsyncSession, since: int, limit: int, as_rows: bool = False
+) -> Tuple[List[DBPeak], List[int], int, bool]:
+    return await session.run_sync(crud_ops.get_peak_changes, since=since, limit=limit, as_rows=as_rows)
+
+
+async def find_peaks_by_height_range(
+    session: AsyncSession, height_min: int, height_max: int, limit: int, descending: bool = False, as_rows: bool = False
+) -> List[DBPeak]:
+    return await session.run_sync(
+        crud_ops.find_peaks_by_height_range,
+        height_min=height_min, height_max=height_max, limit=limit, descending=descending, as_rows=as_rows,
+    )
+
+
+async def find_tallest_peaks(
+    session: AsyncSession, n: int, bbox: Optional[BBoxORM] = None, as_rows: bool = False
+) -> List[DBPeak]:
+    return await session.run_sync(crud_ops.find_tallest_peaks, n=n, bbox=bbox, as_rows=as_rows)
+
+
+async def add_a_peak(session: AsyncSession, peak: PeakCreateORM) -> PeakORM:
+    return await session.run_sync(crud_ops.add_a_peak, peak=peak)
+
+
+async def add_peaks(session: AsyncSession, peaks: List[PeakCreateORM]) -> List[PeakORM]:
+    return await session.run_sync(crud_ops.add_peaks, peaks=peaks)
+
+
+async def update_a_peak(session: AsyncSession, peak_id: int, peak_data: PeakUpdateORM) -> PeakORM:
+    return await session.run_sync(crud_ops.update_a_peak, peak_id=peak_id, peak_data=peak_data)
+
+
+async def delete_a_peak(session: AsyncSession, peak_id: int) -> PeakORM:
+    return await session.run_sync(crud_ops.delete_a_peak, peak_id=peak_id)
+
+
+async def update_peaks(
+    session: AsyncSession, updates: List[PeakBulkUpdateORM], atomic: bool = False
+) -> Tuple[List[PeakORM], Dict[int, str]]:
+    return await session.run_sync(crud_ops.update_peaks, updates=updates, atomic=atomic)
+
+
+async def delete_peaks(session: AsyncSession, pids: List[int], atomic: bool = False) -> Tuple[List[PeakORM], List[int]]:
+    return await session.run_sync(crud_ops.delete_peaks, pids=pids, atomic=atomic)
@@ -0,0 +1,75 @@
+"""
+Great-circle helpers, distances in kilometers and coordinates in degrees
+"""
+import math
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+# half of the earth circumference, no two points can be farther away
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+def haversine_km(latitude_1: float, longitude_1: float, latitude_2: float, longitude_2: float) -> float:
+    phi_1, phi_2 = math.radians(latitude_1), math.radians(latitude_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(longitude_2 - longitude_1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def circle_bounds(
+    latitude: float, longitude: float, radius_km: float
+) -> List[Tuple[float, float, float, float]]:
+    """Bounding boxes (lat_min, lat_max, lon_min, lon_max) enclosing a spherical cap.
+
+    Two boxes are returned when the cap crosses the antimeridian.
+    """
+    if radius_km >= MAX_DISTANCE_KM:
+        return [(-90.0, 90.0, -180.0, 180.0)]
+    d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    lat_min, lat_max = latitude - d_lat, latitude + d_lat
+    if lat_min <= -90.0 or lat_max >= 90.0:
+        # a pole is inside the cap, all the longitudes are concerned
+        return [(max(lat_min, -90.0), min(lat_max, 90.0), -180.0, 180.0)]
+    d_lon = math.degrees(
+        math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude))))
+    )
+    lon_min, lon_max = longitude - d_lon, longitude + d_lon
+    if lon_max - lon_min >= 360.0:
+        return [(lat_min, lat_max, -180.0, 180.0)]
+    if lon_min < -180.0:
+        return [(lat_min, lat_max, lon_min + 360.0, 180.0), (lat_min, lat_max, -180.0, lon_max)]
+    if lon_max > 180.0:
+        return [(lat_min, lat_max, lon_min, 180.0), (lat_min, lat_max, -180.0, lon_max - 360.0)]
+    return [(lat_min, lat_max, lon_min, lon_max)]
+
+
+def points_in_polygon(
+    latitudes: np.ndarray, longitudes: np.ndarray, polygon: Sequence[Tuple[float, float]]
+) -> np.ndarray:
+    """Mask of the points inside a (latitude, longitude) polygon, even-odd rule.
+
+    The ray casting is vectorized over the points: one pass of numpy operations per edge.
+    """
+    inside = np.zeros(len(latitudes), dtype=bool)
+    lat_j, lon_j = polygon[-1]
+    for lat_i, lon_i in polygon:
+        crosses = (lat_i > latitudes) != (lat_j > latitudes)
+        if lat_i != lat_j:
+            # longitude of the edge at the latitude of each point
+            edge_longitudes = (lon_j - lon_i) * (latitudes - lat_i) / (lat_j - lat_i) + lon_i
+            inside ^= crosses & (longitudes < edge_longitudes)
+        lat_j, lon_j = lat_i, lon_i
+    return inside
+
+
+def points_in_boxes(
+    latitudes: np.ndarray, longitudes: np.ndarray, boxes: Sequence[Tuple[float, float, float, float]]
+) -> np.ndarray:
+    # mask of the points inside any of the (lat_min, lat_max, lon_min, lon_max) boxes, bounds included
+    inside = np.zeros(len(latitudes), dtype=bool)
+    for lat_min, lat_max, lon_min, lon_max in boxes:
+        inside |= (lat_min <= latitudes) & (latitudes <= lat_max) & (lon_min <= longitudes) & (longitudes <= lon_max)
+    return inside
@@ -0,0 +1,227 @@
+"""
+Multi-resolution grid of the peaks, to serve clusters at any zoom level.
+
+At zoom z, the world is split into square cells of 180 / 2**z degrees, aligned on
+(-90, -180): each cell of a level is exactly covered by 2x2 cells of the next level.
+Each cell keeps its peaks count, the sums of their coordinates (for the centroid) and
+its highest peak, so that the clusters of a bbox only cost a walk on its cells,
+whatever the number of peaks inside.
+It is optional: it is built at startup from the "peaks" table when the env var
+PEAKS_GRID_PYRAMID is set to "YES", and kept in sync by the crud operations.
+"""
+import math
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from ..db.models import DBPeak
+from .schemas import Coords as CoordsORM, Peak as PeakORM, PeakCluster as PeakClusterORM
+
+# finest level of the pyramid, cells of about 0.04 degrees
+MAX_ZOOM = 12
+
+# (pid, name, height, latitude, longitude)
+PeakRow = Tuple[int, str, int, float, float]
+
+
+def cell_size(zoom: int) -> float:
+    # side of the cells of a zoom level, degrees unit
+    return 180.0 / (1 << zoom)
+
+
+def zoom_for_cell_size(size: float) -> int:
+    # coarsest zoom level whose cells are not larger than the given size
+    return min(MAX_ZOOM, max(0, math.ceil(math.log2(180.0 / size))))
+
+
+def cell_of(zoom: int, latitude: float, longitude: float) -> Tuple[int, int]:
+    size = cell_size(zoom)
+    # the +90 latitude and +180 longitude bounds belong to the last cells
+    return (
+        min(math.floor((latitude + 90.0) / size), (1 << zoom) - 1),
+        min(math.floor((longitude + 180.0) / size), (2 << zoom) - 1),
+    )
+
+
+class _Cell:
+    __slots__ = ("count", "latitude_sum", "longitude_sum", "highest")
+
+    def __init__(self):
+        self.count = 0
+        self.latitude_sum = 0.0
+        self.longitude_sum = 0.0
+        self.highest: Optional[int] = None
+
+
+class GridCluster:
+    __slots__ = ("zoom", "i", "j", "count", "centroid", "highest")
+
+    def __init__(self, zoom: int, i: int, j: int, count: int, centroid: Tuple[float, float], highest: PeakRow):
+        self.zoom = zoom
+        self.i = i
+        self.j = j
+        self.count = count
+        self.centroid = centroid
+        self.highest = highest
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        # latitude_min, latitude_max, longitude_min, longitude_max of the cell
+        size = cell_size(self.zoom)
+        latitude_min, longitude_min = -90.0 + self.i * size, -180.0 + self.j * size
+        return latitude_min, latitude_min + size, longitude_min, longitude_min + size
+
+
+class GridPyramid:
+    """Aggregates per cell of each zoom level, updated peak by peak"""
+
+    def __init__(self, max_zoom: int = MAX_ZOOM):
+        if not 0 <= max_zoom <= MAX_ZOOM:
+            raise ValueError(f"max_zoom shall be between 0 and {MAX_ZOOM}")
+        self.max_zoom = max_zoom
+        self._levels: List[Dict[Tuple[int, int], _Cell]] = [{} for _ in range(max_zoom + 1)]
+        # the peaks of the finest cells, to find their highest one again after a removal
+        self._members: Dict[Tuple[int, int], Set[int]] = {}
+        self._peaks: Dict[int, PeakRow] = {}
+        # routes are run in a threadpool, reads and writes have to be serialized
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._peaks)
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self._peaks
+
+    def _rank(self, pid: int) -> Tuple[int, int]:
+        # the highest peak first, the lowest pid on a tie
+        return self._peaks[pid][2], -pid
+
+    def _insert(self, peak: PeakRow) -> None:
+        pid, _, _, latitude, longitude = peak
+        self._remove(pid)
+        self._peaks[pid] = peak
+        for zoom, level in enumerate(self._levels):
+            cell = level.get(key := cell_of(zoom, latitude, longitude))
+            if cell is None:
+                cell = level[key] = _Cell()
+            cell.count += 1
+            cell.latitude_sum += latitude
+            cell.longitude_sum += longitude
+            if cell.highest is None or self._rank(pid) > self._rank(cell.highest):
+                cell.highest = pid
+        self._members.setdefault(cell_of(self.max_zoom, latitude, longitude), set()).add(pid)
+
+    def _remove(self, pid: int) -> None:
+        if pid not in self._peaks:
+            return
+        _, _, _, latitude, longitude = self._peaks[pid]
+        finest_key = cell_of(self.max_zoom, latitude, longitude)
+        members = self._members[finest_key]
+        members.discard(pid)
+        if not members:
+            del self._members[finest_key]
+        # from the finest level up: the highest peak of a cell is found again among its children
+        for zoom in range(self.max_zoom, -1, -1):
+            level = self._levels[zoom]
+            cell = level[key := cell_of(zoom, latitude, longitude)]
+            cell.count -= 1
+            if cell.count == 0:
+                del level[key]
+                continue
+            cell.latitude_sum -= latitude
+            cell.longitude_sum -= longitude
+            if cell.highest != pid:
+                continue
+            if zoom == self.max_zoom:
+                candidates = members
+            else:
+                i, j = key
+                children = self._levels[zoom + 1]
+                candidates = [
+                    child.highest
+                    for child in (children.get((2 * i + di, 2 * j + dj)) for di in (0, 1) for dj in (0, 1))
+                    if child is not None
+                ]
+            cell.highest = max(candidates, key=self._rank)
+        del self._peaks[pid]
+
+    def load(self, rows: Iterable[PeakRow]) -> "GridPyramid":
+        with self._lock:
+            for row in rows:
+                self._insert(tuple(row))
+        return self
+
+    def upsert(self, pid: int, name: str, height: int, latitude: float, longitude: float) -> None:
+        with self._lock:
+            self._insert((pid, name, height, latitude, longitude))
+
+    def remove(self, pid: int) -> None:
+        with self._lock:
+            self._remove(pid)
+
+    def clusters(
+        self, zoom: int, latitude_min: float, latitude_max: float, longitude_min: float, longitude_max: float
+    ) -> List[GridCluster]:
+        # the cells of the zoom level overlapping the bounds, with their whole content
+        if not 0 <= zoom <= self.max_zoom:
+            raise ValueError(f"zoom shall be between 0 and {self.max_zoom}")
+        i_min, j_min = cell_of(zoom, latitude_min, longitude_min)
+        i_max, j_max = cell_of(zoom, latitude_max, longitude_max)
+        level = self._levels[zoom]
+        clusters = []
+        with self._lock:
+            if (i_max - i_min + 1) * (j_max - j_min + 1) <= len(level):
+                keys = ((i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1))
+                cells = ((key, level.get(key)) for key in keys)
+            else:
+                # zoomed-out bbox: cheaper to walk the populated cells only
+                cells = (
+                    (key, cell) for key, cell in level.items()
+                    if i_min <= key[0] <= i_max and j_min <= key[1] <= j_max
+                )
+            for (i, j), cell in cells:
+                if cell is None:
+                    continue
+                centroid = (cell.latitude_sum / cell.count, cell.longitude_sum / cell.count)
+                clusters.append(GridCluster(zoom, i, j, cell.count, centroid, self._peaks[cell.highest]))
+        clusters.sort(key=lambda cluster: (cluster.i, cluster.j))
+        return clusters
+
+
+def to_peak_clusters(clusters: Iterable[GridCluster]) -> List[PeakClusterORM]:
+    peak_clusters = []
+    for cluster in clusters:
+        latitude_min, latitude_max, longitude_min, longitude_max = cluster.bounds
+        pid, name, height, latitude, longitude = cluster.highest
+        peak_clusters.append(PeakClusterORM(
+            latitude_min=latitude_min, latitude_max=latitude_max,
+            longitude_min=longitude_min, longitude_max=longitude_max,
+            count=cluster.count,
+            centroid=CoordsORM(latitude=cluster.centroid[0], longitude=cluster.centroid[1]),
+            highest=PeakORM(pid=pid, name=name, height=height, latitude=latitude, longitude=longitude),
+        ))
+    return peak_clusters
+
+
+def build_grid_pyramid(session: Session, max_zoom: int = MAX_ZOOM) -> GridPyramid:
+    # load the pyramid from the peaks table, without building any ORM object
+    rows = session.execute(
+        select(DBPeak.pid, DBPeak.name, DBPeak.height, DBPeak.latitude, DBPeak.longitude)
+        .execution_options(yield_per=10_000)
+    )
+    return GridPyramid(max_zoom=max_zoom).load(rows)
+
+
+# process-wide pyramid, None while it is disabled
+_GRID_PYRAMID: Optional[GridPyramid] = None
+
+
+def get_grid_pyramid() -> Optional[GridPyramid]:
+    return _GRID_PYRAMID
+
+
+def set_grid_pyramid(pyramid: Optional[GridPyramid]) -> None:
+    global _GRID_PYRAMID
+    _GRID_PYRAMID = pyramid
@@ -0,0 +1,119 @@
+"""
+In-process index of the peaks heights.
+
+The (height, pid) pairs are kept in a sorted array: a height range is two bisections and
+the tallest peaks are read from the end of the array, the table is never sorted.
+The positions are kept along, to filter the tallest peaks of a bbox without the database.
+It is optional: it is built at startup from the "peaks" table when the env var
+PEAKS_HEIGHT_INDEX is set to "YES", and kept in sync by the crud operations.
+"""
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from ..db.models import DBPeak
+
+
+# peaks copied under the lock at a time by the bbox filter of tallest
+_TALLEST_CHUNK = 1024
+
+
+class PeakHeightIndex:
+    """Sorted array of (height, pid), with the position of each peak"""
+
+    def __init__(self):
+        self._sorted: List[Tuple[int, int]] = []
+        self._peaks: Dict[int, Tuple[int, float, float]] = {}
+        # routes are run in a threadpool, reads and writes have to be serialized
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._peaks)
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self._peaks
+
+    def _remove(self, pid: int) -> None:
+        if (peak := self._peaks.pop(pid, None)) is None:
+            return
+        del self._sorted[bisect_left(self._sorted, (peak[0], pid))]
+
+    def load(self, items: Iterable[Tuple[int, int, float, float]]) -> "PeakHeightIndex":
+        # bulk loading: a single sort instead of one insertion per peak
+        with self._lock:
+            for pid, height, latitude, longitude in items:
+                self._remove(pid)
+                self._peaks[pid] = (height, latitude, longitude)
+            self._sorted = sorted((height, pid) for pid, (height, _, _) in self._peaks.items())
+        return self
+
+    def upsert(self, pid: int, height: int, latitude: float, longitude: float) -> None:
+        with self._lock:
+            self._remove(pid)
+            self._peaks[pid] = (height, latitude, longitude)
+            insort(self._sorted, (height, pid))
+
+    def remove(self, pid: int) -> None:
+        with self._lock:
+            self._remove(pid)
+
+    def height(self, pid: int) -> Optional[int]:
+        peak = self._peaks.get(pid)
+        return peak[0] if peak is not None else None
+
+    def height_range(self, height_min: int, height_max: int, limit: int, descending: bool = False) -> List[int]:
+        # pids of the peaks between the heights (bounds included), lowest or highest first
+        with self._lock:
+            start = bisect_left(self._sorted, (height_min, -1))
+            end = bisect_right(self._sorted, (height_max, float("inf")))
+            if descending:
+                selected = self._sorted[max(start, end - limit):end][::-1]
+            else:
+                selected = self._sorted[start:min(end, start + limit)]
+        return [pid for _, pid in selected]
+
+    def tallest(self, n: int, boxes: Optional[Sequence[Tuple[float, float, float, float]]] = None) -> List[int]:
+        # pids of the n highest peaks, inside any of the (lat_min, lat_max, lon_min, lon_max) boxes if given
+        if boxes is None:
+            with self._lock:
+                return [pid for _, pid in reversed(self._sorted[max(len(self._sorted) - n, 0):])]
+        pids, cursor = [], (float("inf"), float("inf"))
+        while len(pids) < n:
+            # a chunk below the last pair seen is copied under the lock, and filtered without it
+            with self._lock:
+                end = bisect_left(self._sorted, cursor)
+                chunk = [(pair, self._peaks[pair[1]]) for pair in self._sorted[max(end - _TALLEST_CHUNK, 0):end]]
+            if not chunk:
+                break
+            for pair, (_, latitude, longitude) in reversed(chunk):
+                if any(lat_min <= latitude <= lat_max and lon_min <= longitude <= lon_max
+                       for lat_min, lat_max, lon_min, lon_max in boxes):
+                    pids.append(pair[1])
+                    if len(pids) == n:
+                        break
+            cursor = chunk[0][0]
+        return pids
+
+
+def build_height_index(session: Session) -> PeakHeightIndex:
+    # load the index from the peaks table, without building any ORM object
+    rows = session.execute(
+        select(DBPeak.pid, DBPeak.height, DBPeak.latitude, DBPeak.longitude).execution_options(yield_per=10_000)
+    )
+    return PeakHeightIndex().load(rows)
+
+
+# process-wide index, None while the heights index is disabled
+_HEIGHT_INDEX: Optional[PeakHeightIndex] = None
+
+
+def get_height_index() -> Optional[PeakHeightIndex]:
+    return _HEIGHT_INDEX
+
+
+def set_height_index(index: Optional[PeakHeightIndex]) -> None:
+    global _HEIGHT_INDEX
+    _HEIGHT_INDEX = index
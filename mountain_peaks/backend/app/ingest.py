@@ -0,0 +1,135 @@
+"""
+Streamed bulk import of peaks from CSV or NDJSON lines.
+
+Entries are parsed and validated one by one with the PeakCreate schema, then inserted by
+batches: names are deduplicated in bulk (inside the batch and against the db), and each
+batch is inserted with a single executemany statement and committed once.
+A rejected entry is reported in the IngestReport without aborting the whole load: a batch
+failing in the db is inserted again by halves, down to the faulty entries.
+"""
+import csv
+import json
+from typing import Any, Callable, Iterable, List, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from . import crud_ops
+from .schemas import (
+    IngestError as IngestErrorORM,
+    IngestReport as IngestReportORM,
+    PeakCreate as PeakCreateORM,
+)
+
+SUPPORTED_FORMATS = ("csv", "ndjson")
+DEFAULT_BATCH_SIZE = 5000
+
+
+class PeaksIngestor:
+    """Feed it with the whole input, it inserts the valid peaks every "batch_size" entries"""
+
+    def __init__(self, session: Session, fmt: str = "ndjson", batch_size: int = DEFAULT_BATCH_SIZE):
+        if fmt not in SUPPORTED_FORMATS:
+            raise ValueError(f"Unsupported format {fmt}, expected one of {SUPPORTED_FORMATS}")
+        self.session = session
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.report = IngestReportORM()
+        self._pending: List[Tuple[int, PeakCreateORM]] = []
+
+    def _reject(self, line_no: int, error: str) -> None:
+        self.report.errors.append(IngestErrorORM(line=line_no, error=error))
+
+    def _feed(self, line_no: int, parse: Callable[[], Any]) -> None:
+        try:
+            record = parse()
+            if not isinstance(record, dict):
+                raise ValueError("a JSON object was expected")
+            peak = PeakCreateORM(**record)
+        except ValidationError as ex:
+            self._reject(line_no, "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in ex.errors()))
+            return
+        except ValueError as ex:
+            self._reject(line_no, f"Bad format entry: {ex}")
+            return
+        self._pending.append((line_no, peak))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def feed_lines(self, lines: Iterable[str]) -> None:
+        # the whole input at once, a file object or the lines with their line endings:
+        # a quoted CSV field may span several lines
+        if self.fmt == "ndjson":
+            for line_no, line in enumerate(lines, 1):
+                if line.strip():
+                    self._feed(line_no, lambda: json.loads(line))
+            return
+        reader, header, line_no = csv.reader(lines), None, 1
+        while True:
+            try:
+                values = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as ex:
+                self._reject(line_no, f"Bad format entry: {ex}")
+            else:
+                if header is None:
+                    header = [v.strip() for v in values] or None
+                elif values:
+                    self._feed(line_no, lambda: self._csv_record(header, values))
+            # the line where the next entry starts
+            line_no = reader.line_num + 1
+
+    @staticmethod
+    def _csv_record(header: List[str], values: List[str]) -> dict:
+        if len(values) != len(header):
+            raise ValueError(f"{len(header)} columns were expected, got {len(values)}")
+        return dict(zip(header, values))
+
+    def flush(self) -> None:
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        # dedupe by name, inside the batch first, then against the db in a single query
+        to_insert, seen = [], set()
+        for line_no, peak in batch:
+            if peak.name in seen:
+                self._reject(line_no, f"Duplicated peak name in the input: {peak.name}")
+            else:
+                seen.add(peak.name)
+                to_insert.append((line_no, peak))
+        existing = crud_ops.find_existing_names(session=self.session, names=[p.name for _, p in to_insert])
+        if existing:
+            for line_no, peak in to_insert:
+                if peak.name in existing:
+                    self._reject(line_no, f"This peak info already exists: {existing[peak.name]}")
+            to_insert = [(line_no, peak) for line_no, peak in to_insert if peak.name not in existing]
+        self._insert(to_insert)
+
+    def _insert(self, to_insert: List[Tuple[int, PeakCreateORM]]) -> None:
+        try:
+            added_peaks = crud_ops.add_peaks(session=self.session, peaks=[p for _, p in to_insert])
+        except SQLAlchemyError as ex:
+            # the previous batches are already committed
+            self.session.rollback()
+            if len(to_insert) > 1:
+                # inserted again by halves, so that a faulty entry is rejected alone
+                middle = len(to_insert) // 2
+                self._insert(to_insert[:middle])
+                self._insert(to_insert[middle:])
+                return
+            for line_no, _ in to_insert:
+                self._reject(line_no, f"Insertion failed: {ex.__class__.__name__}")
+            return
+        self.report.inserted += len(added_peaks)
+        if len(added_peaks) < len(to_insert):
+            # names inserted by a concurrent writer since the dedupe query
+            added_names = {peak.name for peak in added_peaks}
+            for line_no, peak in to_insert:
+                if peak.name not in added_names:
+                    self._reject(line_no, f"This peak info already exists: {peak.name}")
+
+    def close(self) -> IngestReportORM:
+        self.flush()
+        return self.report
@@ -0,0 +1,194 @@
+"""
+Per-route latency metrics and SQL query instrumentation, exposed in Prometheus text format.
+
+- MetricsMiddleware records, per route template and method, a latency histogram, the
+  response sizes, the number of SQL queries and the db time of each request, plus the
+  number of requests in flight.
+- The SQLAlchemy cursor events count the queries and their duration, globally and for
+  the current request (the request stats are carried by a context variable, which is
+  copied into the threadpool running the sync routes).
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_REQUEST_STATS: ContextVar[Optional[RequestStats]] = ContextVar("peaks_request_stats", default=None)
+
+
+class _RouteMetrics:
+    __slots__ = ("buckets", "count", "latency_sum", "size_sum", "queries_sum", "db_time_sum")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.size_sum = 0
+        self.queries_sum = 0
+        self.db_time_sum = 0.0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = Lock()
+        self._routes: Dict[Tuple[str, str, int], _RouteMetrics] = {}
+        self.in_flight = 0
+        self.queries_total = 0
+        self.db_time_total = 0.0
+
+    def request_started(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(
+        self, method: str, route: str, status: int, latency: float, size: int, stats: RequestStats
+    ) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            metrics = self._routes.setdefault((method, route, status), _RouteMetrics())
+            metrics.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+            metrics.count += 1
+            metrics.latency_sum += latency
+            metrics.size_sum += size
+            metrics.queries_sum += stats.queries
+            metrics.db_time_sum += stats.db_time
+
+    def query_executed(self, duration: float) -> None:
+        with self._lock:
+            self.queries_total += 1
+            self.db_time_total += duration
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = [
+            "# HELP peaks_http_request_duration_seconds Latency of the requests per route",
+            "# TYPE peaks_http_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            routes = sorted(self._routes.items())
+            for (method, route, status), metrics in routes:
+                labels = f'method="{method}",route="{route}",status="{status}"'
+                cumulated = 0
+                for bound, nb in zip(LATENCY_BUCKETS + (float("inf"),), metrics.buckets):
+                    cumulated += nb
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'peaks_http_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulated}')
+                lines.append(f"peaks_http_request_duration_seconds_sum{{{labels}}} {metrics.latency_sum}")
+                lines.append(f"peaks_http_request_duration_seconds_count{{{labels}}} {metrics.count}")
+            for name, help_text, attr in (
+                ("peaks_http_response_size_bytes", "Size of the response bodies per route", "size_sum"),
+                ("peaks_http_request_db_queries", "SQL queries run by the requests per route", "queries_sum"),
+                ("peaks_http_request_db_seconds", "Time spent in the db by the requests per route", "db_time_sum"),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+                for (method, route, status), metrics in routes:
+                    labels = f'method="{method}",route="{route}",status="{status}"'
+                    lines.append(f"{name}_sum{{{labels}}} {getattr(metrics, attr)}")
+                    lines.append(f"{name}_count{{{labels}}} {metrics.count}")
+            lines += [
+                "# HELP peaks_http_requests_in_flight Requests being processed",
+                "# TYPE peaks_http_requests_in_flight gauge",
+                f"peaks_http_requests_in_flight {self.in_flight}",
+                "# HELP peaks_db_queries_total SQL queries executed",
+                "# TYPE peaks_db_queries_total counter",
+                f"peaks_db_queries_total {self.queries_total}",
+                "# HELP peaks_db_query_seconds_total Time spent executing SQL queries",
+                "# TYPE peaks_db_query_seconds_total counter",
+                f"peaks_db_query_seconds_total {self.db_time_total}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("peaks_query_start", []).append(perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("peaks_query_start")
+    if not starts:
+        return
+    duration = perf_counter() - starts.pop()
+    METRICS.query_executed(duration)
+    if (stats := _REQUEST_STATS.get()) is not None:
+        stats.queries += 1
+        stats.db_time += duration
+
+
+class QueryCounter:
+    def __init__(self):
+        self.start = METRICS.queries_total
+        self.end: Optional[int] = None
+
+    @property
+    def count(self) -> int:
+        return (self.end if self.end is not None else METRICS.queries_total) - self.start
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    # number of SQL queries executed by the process inside the block
+    counter = QueryCounter()
+    try:
+        yield counter
+    finally:
+        counter.end = METRICS.queries_total
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, it also works with the streaming responses"""
+
+    def __init__(self, app, debug_headers: bool = False):
+        self.app = app
+        self.debug_headers = debug_headers
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _REQUEST_STATS.set(stats)
+        status, size = 500, 0
+        start = perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.debug_headers:
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [
+                        (b"x-db-query-count", str(stats.queries).encode()),
+                        (b"x-db-time-ms", f"{stats.db_time * 1000:.3f}".encode()),
+                    ]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        METRICS.request_started()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _REQUEST_STATS.reset(token)
+            # the route template, not the path, to keep the number of series bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            METRICS.request_finished(scope["method"], route, status, perf_counter() - start, size, stats)
@@ -0,0 +1,233 @@
+"""
+In-process index of the peaks names, for the autocomplete and the typo-tolerant search.
+
+- A prefix trie of the normalized names (case and accents folded), each node keeping the
+  top-k of the peaks below it, ranked by height: a prefix query is a walk of len(prefix)
+  nodes, whatever the number of names.
+- A trigram index, as pg_trgm does: the names sharing enough trigrams with the query are
+  fuzzy matches. The posting lists of the query trigrams are scanned rarest first, within
+  a budget of postings, and only the names sharing the most trigrams are scored: on very
+  common trigrams, the fuzzy matches are the best ones among the names scanned.
+It is optional: it is built at startup from the "peaks" table when the env var
+PEAKS_NAME_INDEX is set to "YES", and kept in sync by the crud operations.
+"""
+import heapq
+import itertools
+import unicodedata
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from ..db.models import DBPeak
+
+# number of peaks ranked in each node of the trie, the max number of results of a search
+DEFAULT_TOP_K = 20
+# min similarity of a fuzzy match, the default threshold of pg_trgm
+SIMILARITY_THRESHOLD = 0.3
+# max number of postings scanned by a fuzzy search, bounds its latency on common trigrams
+MAX_FUZZY_POSTINGS = 5000
+# number of names scored by a fuzzy search, per result asked
+FUZZY_CANDIDATES_PER_RESULT = 10
+
+
+def normalize_name(name: str) -> str:
+    # casefolded, without accents nor repeated spaces: "Mont  Blanc" and "mont blanc" are the same key
+    decomposed = unicodedata.normalize("NFKD", name.casefold())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def trigrams(name: str) -> Set[str]:
+    # trigrams of each word, padded like pg_trgm does
+    grams = set()
+    for word in normalize_name(name).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(grams_1: Set[str], grams_2: Set[str]) -> float:
+    if not grams_1 or not grams_2:
+        return 0.0
+    shared = len(grams_1 & grams_2)
+    return shared / (len(grams_1) + len(grams_2) - shared)
+
+
+class _TrieNode:
+    __slots__ = ("children", "pids", "top")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        # peaks whose normalized name ends on this node
+        self.pids: Set[int] = set()
+        # best ranked peaks of the subtree
+        self.top: List[int] = []
+
+
+class PeakNameIndex:
+    """Prefix trie with per-node top-k and trigram posting lists"""
+
+    def __init__(self, top_k: int = DEFAULT_TOP_K):
+        if top_k <= 0:
+            raise ValueError("top_k shall be strictly positive")
+        self.top_k = top_k
+        self._root = _TrieNode()
+        self._trigrams: Dict[str, Set[int]] = {}
+        self._peaks: Dict[int, Tuple[str, int]] = {}
+        self._grams_count: Dict[int, int] = {}
+        # routes are run in a threadpool, reads and writes have to be serialized
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._peaks)
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self._peaks
+
+    def _rank(self, pid: int) -> Tuple[int, str, int]:
+        # the highest peaks first, then by name
+        name, height = self._peaks[pid]
+        return -height, name, pid
+
+    def _path(self, key: str, create: bool = False) -> List[_TrieNode]:
+        nodes = [self._root]
+        for char in key:
+            child = nodes[-1].children.get(char)
+            if child is None:
+                if not create:
+                    break
+                child = nodes[-1].children[char] = _TrieNode()
+            nodes.append(child)
+        return nodes
+
+    def _insert(self, pid: int, name: str, height: int, rank_nodes: bool = True) -> None:
+        self._remove(pid)
+        self._peaks[pid] = (name, height)
+        nodes = self._path(normalize_name(name), create=True)
+        nodes[-1].pids.add(pid)
+        if rank_nodes:
+            rank = self._rank(pid)
+            for node in nodes:
+                if len(node.top) < self.top_k or rank < self._rank(node.top[-1]):
+                    node.top.append(pid)
+                    node.top.sort(key=self._rank)
+                    del node.top[self.top_k:]
+        grams = trigrams(name)
+        self._grams_count[pid] = len(grams)
+        for gram in grams:
+            self._trigrams.setdefault(gram, set()).add(pid)
+
+    def _rank_all_nodes(self) -> None:
+        # top-k of every node, children before parents
+        stack, ordered = [self._root], []
+        while stack:
+            ordered.append(node := stack.pop())
+            stack.extend(node.children.values())
+        for node in reversed(ordered):
+            candidates = list(node.pids)
+            for child in node.children.values():
+                candidates.extend(child.top)
+            node.top = heapq.nsmallest(self.top_k, candidates, key=self._rank)
+
+    def _remove(self, pid: int) -> None:
+        if pid not in self._peaks:
+            return
+        name, _ = self._peaks[pid]
+        key = normalize_name(name)
+        nodes = self._path(key)
+        nodes[-1].pids.discard(pid)
+        # from the deepest node up: the top-k of a node is rebuilt from its own peaks and its children's top-k
+        for depth in range(len(nodes) - 1, -1, -1):
+            node = nodes[depth]
+            if depth < len(nodes) - 1 and not (child := nodes[depth + 1]).pids and not child.children:
+                del node.children[key[depth]]
+            if pid in node.top:
+                candidates = set(node.pids)
+                for child in node.children.values():
+                    candidates.update(child.top)
+                candidates.discard(pid)
+                node.top = sorted(candidates, key=self._rank)[:self.top_k]
+        for gram in trigrams(name):
+            posting = self._trigrams[gram]
+            posting.discard(pid)
+            if not posting:
+                del self._trigrams[gram]
+        del self._peaks[pid]
+        del self._grams_count[pid]
+
+    def load(self, items: Iterable[Tuple[int, str, int]]) -> "PeakNameIndex":
+        # bulk loading: the nodes are ranked once all the names are inserted
+        with self._lock:
+            for pid, name, height in items:
+                self._insert(pid, name, height, rank_nodes=False)
+            self._rank_all_nodes()
+        return self
+
+    def upsert(self, pid: int, name: str, height: int) -> None:
+        with self._lock:
+            self._insert(pid, name, height)
+
+    def remove(self, pid: int) -> None:
+        with self._lock:
+            self._remove(pid)
+
+    def complete(self, prefix: str, k: int) -> List[int]:
+        # pids of the k highest peaks whose name starts with the prefix
+        key = normalize_name(prefix)
+        with self._lock:
+            nodes = self._path(key)
+            if len(nodes) != len(key) + 1:
+                return []
+            return nodes[-1].top[:k]
+
+    def fuzzy(self, query: str, k: int, threshold: float = SIMILARITY_THRESHOLD) -> List[Tuple[int, float]]:
+        # (pid, similarity) of the k names most similar to the query
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        with self._lock:
+            postings = sorted((self._trigrams.get(gram, set()) for gram in query_grams), key=len)
+            # the trigrams shared with the query, counted from the rarest ones
+            shared_counts, budget = Counter(), MAX_FUZZY_POSTINGS
+            for posting in postings:
+                if budget <= 0:
+                    break
+                shared_counts.update(posting if len(posting) <= budget else itertools.islice(posting, budget))
+                budget -= len(posting)
+            matches = []
+            for pid, _ in shared_counts.most_common(k * FUZZY_CANDIDATES_PER_RESULT):
+                shared = sum(pid in posting for posting in postings)
+                score = shared / (len(query_grams) + self._grams_count[pid] - shared)
+                if score >= threshold:
+                    matches.append((pid, score))
+            matches.sort(key=lambda match: (-match[1], self._rank(match[0])))
+        return matches[:k]
+
+    def search(self, query: str, k: int) -> List[int]:
+        # prefix matches first, completed with the fuzzy matches
+        pids = self.complete(query, k)
+        if len(pids) < k:
+            found = set(pids)
+            pids.extend(pid for pid, _ in self.fuzzy(query, k) if pid not in found)
+        return pids[:k]
+
+
+def build_name_index(session: Session, top_k: int = DEFAULT_TOP_K) -> PeakNameIndex:
+    # load the index from the peaks table, without building any ORM object
+    rows = session.execute(select(DBPeak.pid, DBPeak.name, DBPeak.height).execution_options(yield_per=10_000))
+    return PeakNameIndex(top_k=top_k).load(rows)
+
+
+# process-wide index, None while the names index is disabled
+_NAME_INDEX: Optional[PeakNameIndex] = None
+
+
+def get_name_index() -> Optional[PeakNameIndex]:
+    return _NAME_INDEX
+
+
+def set_name_index(index: Optional[PeakNameIndex]) -> None:
+    global _NAME_INDEX
+    _NAME_INDEX = index
@@ -0,0 +1,28 @@
+"""
+Number of peaks of the table, counted once then kept up to date by the committed writes of the worker.
+
+The crud operations count the written peaks, the admission control reads the count to estimate
+the size of the bboxes from their area: both import this module, not each other.
+"""
+from threading import Lock
+
+_PEAKS_COUNT = 0
+# the writes are committed by the request threads and by the write-behind thread
+_LOCK = Lock()
+
+
+def get_peaks_count() -> int:
+    return _PEAKS_COUNT
+
+
+def set_peaks_count(count: int) -> None:
+    global _PEAKS_COUNT
+    with _LOCK:
+        _PEAKS_COUNT = count
+
+
+def count_written_peaks(added: int, removed: int) -> None:
+    # called by the crud operations after each committed write
+    global _PEAKS_COUNT
+    with _LOCK:
+        _PEAKS_COUNT = max(_PEAKS_COUNT + added - removed, 0)
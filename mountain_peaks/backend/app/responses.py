@@ -0,0 +1,98 @@
+"""
+JSON bodies of the read endpoints, served with an ETag.
+
+The bodies are encoded exactly like FastAPI's JSONResponse does, so that a body built
+here (and possibly cached) is byte-identical to the one FastAPI would have rendered.
+The list endpoints use the fast path: the (pid, name, height, latitude, longitude) rows
+selected from the db are formatted directly, without ORM objects nor Pydantic models.
+With PEAKS_COMPRESSION=YES, the bodies above the size threshold are compressed with the
+encoding negotiated with the client.
+"""
+import hashlib
+import json
+import math
+from json.encoder import encode_basestring
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+from fastapi import Request, Response
+
+from .compression import compress, decoded_etag, encoded_etag, get_compression
+from .schemas import Peak as PeakORM
+
+# same options as starlette's JSONResponse.render
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"))
+
+
+def encode_json(content: Any) -> bytes:
+    return _JSON_ENCODER.encode(content).encode("utf-8")
+
+
+def peaks_to_json(peaks: Iterable[Any]) -> bytes:
+    return encode_json([PeakORM.model_validate(peak).model_dump(mode="json") for peak in peaks])
+
+
+def peak_to_json(peak: Any) -> bytes:
+    return encode_json(PeakORM.model_validate(peak).model_dump(mode="json"))
+
+
+def _json_float(value: float) -> str:
+    # what json does for a float, with allow_nan=False
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError("Out of range float values are not JSON compliant")
+    return float.__repr__(value)
+
+
+def _peak_row_json(row: Sequence) -> str:
+    pid, name, height, latitude, longitude = row
+    return '{"pid":%d,"name":%s,"height":%d,"latitude":%s,"longitude":%s}' % (
+        pid, encode_basestring(name), height, _json_float(latitude), _json_float(longitude)
+    )
+
+
+def peak_rows_to_json(rows: Iterable[Sequence]) -> bytes:
+    # same bytes as peaks_to_json, for the rows of crud operations called with as_rows=True
+    return ("[" + ",".join(map(_peak_row_json, rows)) + "]").encode("utf-8")
+
+
+def peak_row_to_json(row: Sequence) -> bytes:
+    return _peak_row_json(row).encode("utf-8")
+
+
+def peak_changes_to_json(rows: Iterable[Sequence], deleted: Sequence[int], revision: int, more: bool) -> bytes:
+    # same bytes as the PeakChanges schema rendered by FastAPI
+    return b'{"revision":%d,"more":%s,"upserted":%s,"deleted":%s}' % (
+        revision, b"true" if more else b"false", peak_rows_to_json(rows), encode_json(list(deleted))
+    )
+
+
+def compute_etag(body: bytes) -> str:
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def _compress_body(body: bytes, etag: str, encoding: str) -> bytes:
+    return compress(body, encoding)
+
+
+def etag_response(
+    request: Request, body: bytes, encode: Optional[Callable[[bytes, str, str], bytes]] = None
+) -> Response:
+    # an unchanged result costs a 304 without body, whatever its encoding: the ETag of each
+    # encoding is derived from the one of the body.
+    # encode(body, etag, encoding) gives the compressed body, possibly cached
+    etag = compute_etag(body)
+    headers = {"ETag": etag}
+    encoding = None
+    if (compression := get_compression()) is not None and len(body) >= compression.min_size:
+        headers["Vary"] = "Accept-Encoding"
+        if (encoding := compression.negotiate(request.headers.get("accept-encoding"))) is not None:
+            headers["ETag"] = encoded_etag(etag, encoding)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (
+        if_none_match.strip() == "*" or etag in (decoded_etag(t.strip()) for t in if_none_match.split(","))
+    ):
+        return Response(status_code=304, headers=headers)
+    if encoding is not None:
+        body = (encode or _compress_body)(body, etag, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, List, Literal, Optional, Tuple
 from pydantic import BaseModel, Field, model_validator
 
 
@@ -13,8 +13,13 @@ class Peak(BaseModel):
         from_attributes = True
 
 
+class PeakDistance(Peak):
+    distance_km: float = Field(ge=0.0, description="great-circle distance to the searched point, km unit")
+
+
 class PeakCreate(BaseModel):
-    name: str = Field(description="name of the peak")
+    # the names are at most 30 characters long in db
+    name: str = Field(max_length=30, description="name of the peak")
     height: int = Field(gt=0, description="height of the peak")
     latitude: float = Field(description="latitude coordinate of the peak")
     longitude: float = Field(description="longitude coordinate of the peak")
@@ -25,7 +30,7 @@ class PeakCreate(BaseModel):
 
 class PeakUpdate(BaseModel):
     # at least one of these attributes have to be given
-    name: Optional[str] = Field(None, omit_default=True, description="name of the peak")
+    name: Optional[str] = Field(None, omit_default=True, max_length=30, description="name of the peak")
     height: Optional[int] = Field(None, omit_default=True, gt=0, description="height of the peak")
     latitude: Optional[float] = Field(None, omit_default=True, description="latitude coordinate of the peak")
     longitude: Optional[float] = Field(None, omit_default=True, description="longitude coordinate of the peak")
@@ -34,15 +39,69 @@ class PeakUpdate(BaseModel):
         from_attributes = True
 
 
+class PeakBulkUpdate(PeakUpdate):
+    pid: int = Field(gt=0, description="ID number of the peak to update")
+
+
+class BulkError(BaseModel):
+    pid: int = Field(description="ID number of the rejected peak")
+    error: str = Field(description="reason of the rejection")
+
+
+class BulkReport(BaseModel):
+    peaks: List[Peak] = Field(default_factory=list, description="peaks updated or deleted")
+    errors: List[BulkError] = Field(default_factory=list, description="rejected entries")
+
+
+class PeakChanges(BaseModel):
+    revision: int = Field(description="revision to give as since to get the next changes")
+    more: bool = Field(description="more changes are left after this revision")
+    upserted: List[Peak] = Field(description="peaks inserted or updated, in revision order")
+    deleted: List[int] = Field(description="ids of the deleted peaks, in revision order")
+
+
 class PeakAttr(BaseModel):
     # at least one of these attributes have to be given
-    name: Optional[str] = Field(None, omit_default=True, description="name of the peak")
+    name: Optional[str] = Field(None, omit_default=True, max_length=30, description="name of the peak")
     height: Optional[int] = Field(None, omit_default=True, gt=0, description="height of the peak")
 
     class Config:
         from_attributes = True
 
 
+class PeakIds(BaseModel):
+    pids: List[int] = Field(min_length=1, max_length=10_000, description="ids of the peaks to fetch")
+
+
+class PeaksBatch(BaseModel):
+    found: Dict[int, Peak] = Field(description="peaks found, keyed by id")
+    missing: List[int] = Field(description="ids matching no peak")
+
+
+class PeakAttrPeaks(BaseModel):
+    attr: PeakAttr = Field(description="searched attribute")
+    peaks: List[Peak] = Field(description="peaks matching the attribute, possibly none")
+
+
+class IngestError(BaseModel):
+    line: int = Field(description="line number of the rejected entry in the input")
+    error: str = Field(description="reason of the rejection")
+
+
+class IngestReport(BaseModel):
+    inserted: int = Field(0, description="number of peaks inserted")
+    errors: List[IngestError] = Field(default_factory=list, description="rejected entries")
+
+
+class WriteTicket(BaseModel):
+    ticket: str = Field(description="ID of the deferred write, to follow its outcome")
+    status: Literal["pending", "applied", "rejected", "failed"] = Field(
+        description="pending until its batch is flushed, rejected when the write is invalid, failed on a db error"
+    )
+    peak: Optional[Peak] = Field(None, description="peak as written, once applied")
+    error: Optional[str] = Field(None, description="reason of the rejection or of the failure")
+
+
 class Coords(BaseModel):
     latitude: float = Field(ge=-90.0, le=+90.0, description="latitude coord")
     longitude: float = Field(ge=-180.0, le=+180.0, description="longitude coord")
@@ -54,6 +113,9 @@ class BBox(BaseModel):
            |           |
     1.left v           | 3.right
            |_2.bottom__^
+
+    A longitude_min greater than the longitude_max is a box crossing the antimeridian,
+    from longitude_min eastward to +180 then from -180 to longitude_max.
     """
 
     latitude_min: float = Field(
@@ -88,6 +150,61 @@ class BBox(BaseModel):
     def check_min_lower_than_max(self) -> "BBox":
         if self.latitude_max < self.latitude_min:
             raise ValueError("latitude_max shall be greater than latitude_min")
-        if self.longitude_max < self.longitude_min:
-            raise ValueError("longitude_max shall be greater than longitude_min")
+        return self
+
+    @property
+    def crosses_antimeridian(self) -> bool:
+        return self.longitude_max < self.longitude_min
+
+    def parts(self) -> List[Tuple[float, float, float, float]]:
+        # (lat_min, lat_max, lon_min, lon_max) boxes, split in two at the antimeridian
+        if self.crosses_antimeridian:
+            return [
+                (self.latitude_min, self.latitude_max, self.longitude_min, 180.0),
+                (self.latitude_min, self.latitude_max, -180.0, self.longitude_max),
+            ]
+        return [(self.latitude_min, self.latitude_max, self.longitude_min, self.longitude_max)]
+
+    def contains(self, latitude: float, longitude: float) -> bool:
+        if not self.latitude_min <= latitude <= self.latitude_max:
+            return False
+        if self.crosses_antimeridian:
+            return self.longitude_min <= longitude or longitude <= self.longitude_max
+        return self.longitude_min <= longitude <= self.longitude_max
+
+
+class BBoxPeaks(BaseModel):
+    bbox: BBox = Field(description="searched bbox")
+    peaks: List[Peak] = Field(description="peaks inside the bbox, possibly none")
+
+
+class PeakCluster(BaseModel):
+    latitude_min: float = Field(description="bottom of the grid cell, degrees unit")
+    latitude_max: float = Field(description="top of the grid cell, degrees unit")
+    longitude_min: float = Field(description="left of the grid cell, degrees unit")
+    longitude_max: float = Field(description="right of the grid cell, degrees unit")
+    count: int = Field(gt=0, description="number of peaks inside the cell")
+    centroid: Coords = Field(description="mean position of the peaks of the cell")
+    highest: Peak = Field(description="highest peak of the cell")
+
+
+class Polygon(BaseModel):
+    """Polygon in degrees, its last point is linked to the first one; it shall not cross the antimeridian"""
+
+    points: List[Coords] = Field(min_length=3, max_length=10_000, description="vertices of the polygon")
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        latitudes = [point.latitude for point in self.points]
+        longitudes = [point.longitude for point in self.points]
+        return min(latitudes), max(latitudes), min(longitudes), max(longitudes)
+
+
+class Area(BaseModel):
+    bboxes: List[BBox] = Field(default_factory=list, max_length=100, description="boxes of the area")
+    polygons: List[Polygon] = Field(default_factory=list, max_length=100, description="polygons of the area")
+
+    @model_validator(mode="after")
+    def check_not_empty(self) -> "Area":
+        if not self.bboxes and not self.polygons:
+            raise ValueError("at least a bbox or a polygon shall be given")
         return self
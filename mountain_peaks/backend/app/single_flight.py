@@ -0,0 +1,142 @@
+"""
+Coalescing of the identical read queries in flight.
+
+When a popular region is opened, many clients send the same request within a few milliseconds:
+without coalescing, each of them runs its own query and serializes its own body. Here the
+first request of a key runs the query, and the identical requests arriving while it runs wait
+for it and share its serialized body, or its exception. Nothing is kept once the query is done:
+it is not a cache, and it works with or without the response cache.
+The keys are the normalized request (a pid, a PeakAttr, a BBox) prefixed with the engine of the
+session, so that a request sent to the primary never shares the result of a replica, and with
+a write generation bumped after each committed write of the worker: a request never joins a
+query started before a write it could have seen.
+The sync routes wait in their thread, the async routes on the event loop.
+It is optional: only enabled when the env var PEAKS_SINGLE_FLIGHT is set to "YES".
+"""
+import asyncio
+from threading import Event, Lock
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# bumped after each committed write, the queries started before are not joined anymore
+_WRITE_GENERATION = 0
+
+
+def bump_write_generation() -> None:
+    # called by the crud operations after each committed write
+    global _WRITE_GENERATION
+    _WRITE_GENERATION += 1
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Calls in flight by key, of the threads and of the event loops"""
+
+    def __init__(self):
+        self.executions = 0
+        self.shared = 0
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._lock = Lock()
+
+    def do(self, key: str, produce: Callable[[], T]) -> T:
+        # the result of the call of the key in flight, else of a new call of produce
+        with self._lock:
+            leader = (call := self._calls.get(key)) is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = produce()
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key: str, produce: Callable[[], Awaitable[T]]) -> T:
+        # same for the coroutines, the call runs in a task shared by the requests of the key
+        loop = asyncio.get_running_loop()
+        task_key = (id(loop), key)
+        while True:
+            if (task := self._tasks.get(task_key)) is None:
+                task = loop.create_task(produce())
+                self._tasks[task_key] = task
+                task.add_done_callback(lambda done: self._forget(task_key, done))
+                with self._lock:
+                    self.executions += 1
+                # the first request owns the call: it is cancelled with it
+                return await task
+            with self._lock:
+                self.shared += 1
+            try:
+                # the other requests can be cancelled without cancelling the call
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                # the request owning the call was cancelled, the call is run again
+
+    def _forget(self, task_key: Tuple[int, str], task: asyncio.Task) -> None:
+        if self._tasks.get(task_key) is task:
+            del self._tasks[task_key]
+
+    def render(self) -> str:
+        # Prometheus text exposition format, appended to the other metrics
+        return (
+            "# HELP peaks_single_flight_executions_total Read queries run\n"
+            "# TYPE peaks_single_flight_executions_total counter\n"
+            f"peaks_single_flight_executions_total {self.executions}\n"
+            "# HELP peaks_single_flight_shared_total Read requests served by the query of an identical one\n"
+            "# TYPE peaks_single_flight_shared_total counter\n"
+            f"peaks_single_flight_shared_total {self.shared}\n"
+        )
+
+
+# process-wide calls in flight, None while the coalescing is disabled
+_SINGLE_FLIGHT: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> Optional[SingleFlight]:
+    return _SINGLE_FLIGHT
+
+
+def set_single_flight(single_flight: Optional[SingleFlight]) -> None:
+    global _SINGLE_FLIGHT
+    _SINGLE_FLIGHT = single_flight
+
+
+def _flight_key(bind: Any, key: str) -> str:
+    return f"{id(bind)}:{_WRITE_GENERATION}:{key}"
+
+
+def coalesce(session, key: str, produce: Callable[[], T]) -> T:
+    # run produce, or share the result of the identical call in flight on the same db
+    if (single_flight := get_single_flight()) is None:
+        return produce()
+    return single_flight.do(_flight_key(session.get_bind(), key), produce)
+
+
+async def coalesce_async(session, key: str, produce: Callable[[], Awaitable[T]]) -> T:
+    if (single_flight := get_single_flight()) is None:
+        return await produce()
+    return await single_flight.do_async(_flight_key(session.bind, key), produce)
@@ -0,0 +1,248 @@
+"""
+Read-only columnar snapshot of the peaks table, served from a memory-mapped file.
+
+The file holds fixed-width little-endian arrays, each aligned on 64 bytes:
+- pid (sorted), height, latitude, longitude: one entry per peak, at the same position,
+- the names: utf-8 heap with the offsets of each name, and the positions sorted by name,
+- the positions sorted by height, with the sorted heights,
+- a prebuilt uniform grid index in CSR form: the positions grouped by cell, with the
+  start of each cell, so that a bbox only reads the cells it overlaps.
+Opening a snapshot only parses the header: the arrays are NumPy views of the mapped
+pages, shared by all the processes mapping the same file through the page cache.
+The snapshot is written by "python -m mountain_peaks.backend.export_snapshot", and served
+by the "snapshot_server" app when the env var PEAKS_SNAPSHOT_PATH is set.
+"""
+import math
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import crud_ops
+
+MAGIC = b"PEAKSNAP"
+VERSION = 1
+# default size of a grid cell, degrees unit
+DEFAULT_CELL_SIZE = 0.5
+# alignment of the arrays in the file
+_ALIGNMENT = 64
+
+# name and dtype of the arrays, in file order
+_SECTIONS = (
+    ("pid", "<i8"),
+    ("height", "<i4"),
+    ("latitude", "<f8"),
+    ("longitude", "<f8"),
+    ("name_offsets", "<u8"),
+    ("names", "u1"),
+    ("name_order", "<u4"),
+    ("height_sorted", "<i4"),
+    ("height_order", "<u4"),
+    ("cell_starts", "<u4"),
+    ("cell_positions", "<u4"),
+)
+# magic, version, number of peaks, db revision, cell size, grid rows and columns
+_HEADER = struct.Struct("<8sIQQdII")
+# offset and size in bytes of each array
+_SECTION_ENTRY = struct.Struct("<QQ")
+
+# (pid, name, height, latitude, longitude)
+PeakRow = Tuple[int, str, int, float, float]
+
+
+def _grid_shape(cell_size: float) -> Tuple[int, int]:
+    return math.ceil(180.0 / cell_size), math.ceil(360.0 / cell_size)
+
+
+def _cells_of(latitudes: np.ndarray, longitudes: np.ndarray, cell_size: float) -> Tuple[np.ndarray, np.ndarray]:
+    # grid cells aligned on (-90, -180), out of range coordinates go to the border cells
+    nb_rows, nb_cols = _grid_shape(cell_size)
+    rows = np.clip(np.floor((latitudes + 90.0) / cell_size), 0, nb_rows - 1).astype(np.int64)
+    cols = np.clip(np.floor((longitudes + 180.0) / cell_size), 0, nb_cols - 1).astype(np.int64)
+    return rows, cols
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_snapshot(session: Session, path: str, cell_size: float = DEFAULT_CELL_SIZE) -> int:
+    # dump the peaks table into a snapshot file, returns the number of peaks
+    if cell_size <= 0:
+        raise ValueError("cell_size shall be strictly positive")
+    revision = crud_ops.get_current_revision(session)
+    pids, names, heights, latitudes, longitudes = [], [], [], [], []
+    for rows in crud_ops.iter_all_peaks(session=session, chunk_size=10_000):
+        for pid, name, height, latitude, longitude in rows:
+            pids.append(pid)
+            names.append(name.encode("utf-8"))
+            heights.append(height)
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+    count = len(pids)
+    if count >= 1 << 32:
+        raise ValueError("too many peaks for a snapshot")
+    arrays: Dict[str, np.ndarray] = {
+        "pid": np.array(pids, dtype="<i8"),
+        "height": np.array(heights, dtype="<i4"),
+        "latitude": np.array(latitudes, dtype="<f8"),
+        "longitude": np.array(longitudes, dtype="<f8"),
+    }
+    name_offsets = np.zeros(count + 1, dtype="<u8")
+    np.cumsum([len(name) for name in names], out=name_offsets[1:])
+    arrays["name_offsets"] = name_offsets
+    arrays["names"] = np.frombuffer(b"".join(names), dtype="u1")
+    arrays["name_order"] = np.array(sorted(range(count), key=names.__getitem__), dtype="<u4")
+    # stable sorts: the positions stay in pid order among the same height or cell
+    height_order = np.argsort(arrays["height"], kind="stable")
+    arrays["height_sorted"] = arrays["height"][height_order]
+    arrays["height_order"] = height_order.astype("<u4")
+    nb_rows, nb_cols = _grid_shape(cell_size)
+    rows, cols = _cells_of(arrays["latitude"], arrays["longitude"], cell_size)
+    cells = rows * nb_cols + cols
+    cell_starts = np.zeros(nb_rows * nb_cols + 1, dtype="<u4")
+    np.cumsum(np.bincount(cells, minlength=nb_rows * nb_cols), out=cell_starts[1:])
+    arrays["cell_starts"] = cell_starts
+    arrays["cell_positions"] = np.argsort(cells, kind="stable").astype("<u4")
+
+    entries, offset = [], _aligned(_HEADER.size + _SECTION_ENTRY.size * len(_SECTIONS))
+    for name, dtype in _SECTIONS:
+        arrays[name] = np.ascontiguousarray(arrays[name], dtype=dtype)
+        entries.append((offset, arrays[name].nbytes))
+        offset = _aligned(offset + arrays[name].nbytes)
+    # written aside then renamed: the servers mapping the previous file keep reading it
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(_HEADER.pack(MAGIC, VERSION, count, revision, cell_size, nb_rows, nb_cols))
+        for entry in entries:
+            snapshot_file.write(_SECTION_ENTRY.pack(*entry))
+        for (name, _), (section_offset, _) in zip(_SECTIONS, entries):
+            snapshot_file.seek(section_offset)
+            snapshot_file.write(arrays[name].tobytes())
+        snapshot_file.truncate(offset)
+    os.replace(tmp_path, path)
+    return count
+
+
+class PeakSnapshot:
+    """Zero-copy views of a snapshot file, the queries return positions in the arrays"""
+
+    def __init__(self, buffer, path: Optional[str] = None):
+        self.path = path
+        self._buffer = buffer
+        if len(buffer) < _HEADER.size:
+            raise ValueError("Not a peaks snapshot: the file is too short")
+        magic, version, count, revision, cell_size, nb_rows, nb_cols = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a peaks snapshot: bad magic number")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}, expected {VERSION}")
+        self.count = count
+        self.revision = revision
+        self.cell_size = cell_size
+        self._nb_rows, self._nb_cols = nb_rows, nb_cols
+        for i, (name, dtype) in enumerate(_SECTIONS):
+            offset, nbytes = _SECTION_ENTRY.unpack_from(buffer, _HEADER.size + i * _SECTION_ENTRY.size)
+            if offset + nbytes > len(buffer):
+                raise ValueError(f"Truncated snapshot: the {name} array is out of the file")
+            dtype = np.dtype(dtype)
+            setattr(self, name, np.frombuffer(buffer, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset))
+
+    @classmethod
+    def open(cls, path: str) -> "PeakSnapshot":
+        with open(path, "rb") as snapshot_file:
+            # read-only shared mapping: the pages are loaded on demand and shared between processes
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, path=path)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _name(self, position: int) -> bytes:
+        return self.names[self.name_offsets[position]:self.name_offsets[position + 1]].tobytes()
+
+    def rows(self, positions: Optional[np.ndarray] = None) -> List[PeakRow]:
+        # (pid, name, height, latitude, longitude) of the positions, all the peaks by default
+        if positions is None:
+            # full dump: the names heap is decoded in one pass
+            offsets, heap = self.name_offsets.tolist(), self.names.tobytes()
+            names = [heap[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+            positions = slice(None)
+        else:
+            names = [self._name(position).decode("utf-8") for position in positions.tolist()]
+        return list(zip(
+            self.pid[positions].tolist(), names, self.height[positions].tolist(),
+            self.latitude[positions].tolist(), self.longitude[positions].tolist(),
+        ))
+
+    def page(self, limit: int, after: Optional[int] = None) -> np.ndarray:
+        # positions of the page of peaks following the "after" pid
+        start = int(np.searchsorted(self.pid, after, side="right")) if after is not None else 0
+        return np.arange(start, min(start + limit, self.count))
+
+    def position_of(self, pid: int) -> Optional[int]:
+        position = int(np.searchsorted(self.pid, pid))
+        if position < self.count and self.pid[position] == pid:
+            return position
+        return None
+
+    def positions_by_name(self, name: str) -> np.ndarray:
+        # binary search among the sorted names
+        key = name.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(int(self.name_order[middle])) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._name(int(self.name_order[low])) == key:
+            return np.array([self.name_order[low]], dtype=np.int64)
+        return np.array([], dtype=np.int64)
+
+    def positions_by_height(self, height_min: int, height_max: int) -> np.ndarray:
+        # positions of the peaks between the heights (bounds included), in pid order
+        start = np.searchsorted(self.height_sorted, height_min, side="left")
+        end = np.searchsorted(self.height_sorted, height_max, side="right")
+        return np.sort(self.height_order[start:end].astype(np.int64))
+
+    def _positions_in_box(self, latitude_min: float, latitude_max: float, longitude_min: float,
+                          longitude_max: float) -> np.ndarray:
+        (row_min, row_max), (col_min, col_max) = _cells_of(
+            np.array([latitude_min, latitude_max]), np.array([longitude_min, longitude_max]), self.cell_size
+        )
+        # the cells of a grid row are contiguous: one slice of positions per row
+        row_cells = np.arange(row_min, row_max + 1) * self._nb_cols
+        starts = self.cell_starts[row_cells + col_min]
+        ends = self.cell_starts[row_cells + col_max + 1]
+        slices = [self.cell_positions[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+        if not slices:
+            return np.array([], dtype=np.int64)
+        candidates = np.concatenate(slices).astype(np.int64)
+        latitudes, longitudes = self.latitude[candidates], self.longitude[candidates]
+        inside = (
+            (latitude_min <= latitudes) & (latitudes <= latitude_max)
+            & (longitude_min <= longitudes) & (longitudes <= longitude_max)
+        )
+        return candidates[inside]
+
+    def positions_in_boxes(self, boxes: Sequence[Tuple[float, float, float, float]]) -> np.ndarray:
+        # positions inside any of the (lat_min, lat_max, lon_min, lon_max) boxes, in pid order
+        positions = [self._positions_in_box(*box) for box in boxes]
+        return np.unique(np.concatenate(positions)) if positions else np.array([], dtype=np.int64)
+
+
+# process-wide snapshot, None until the snapshot server has opened it
+_SNAPSHOT: Optional[PeakSnapshot] = None
+
+
+def get_snapshot() -> Optional[PeakSnapshot]:
+    return _SNAPSHOT
+
+
+def set_snapshot(snapshot: Optional[PeakSnapshot]) -> None:
+    global _SNAPSHOT
+    _SNAPSHOT = snapshot
@@ -0,0 +1,152 @@
+"""
+In-process spatial index over the peaks coordinates.
+
+The index only stores (pid, latitude, longitude) triplets bucketed into a uniform
+lat/lon grid, so that a bbox search is resolved in memory and the database is only
+hit to fetch the matching rows by primary key.
+It is optional: it is built at startup from the "peaks" table when the env var
+PEAKS_SPATIAL_INDEX is set to "YES", and kept in sync by the crud operations.
+"""
+import math
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from ..db.models import DBPeak
+
+# default size of a grid cell, degrees unit
+DEFAULT_CELL_SIZE = 0.5
+
+
+class PeakGridIndex:
+    """Uniform grid index: each cell maps the pids it contains to their coordinates"""
+
+    def __init__(self, cell_size: float = DEFAULT_CELL_SIZE):
+        if cell_size <= 0:
+            raise ValueError("cell_size shall be strictly positive")
+        self.cell_size = cell_size
+        self._cells: Dict[Tuple[int, int], Dict[int, Tuple[float, float]]] = {}
+        self._positions: Dict[int, Tuple[float, float]] = {}
+        # routes are run in a threadpool, reads and writes have to be serialized
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self._positions
+
+    def _cell_of(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (
+            math.floor(latitude / self.cell_size),
+            math.floor(longitude / self.cell_size),
+        )
+
+    def _insert(self, pid: int, latitude: float, longitude: float) -> None:
+        self._remove(pid)
+        self._cells.setdefault(self._cell_of(latitude, longitude), {})[pid] = (latitude, longitude)
+        self._positions[pid] = (latitude, longitude)
+
+    def _remove(self, pid: int) -> None:
+        position = self._positions.pop(pid, None)
+        if position is None:
+            return
+        cell = self._cell_of(*position)
+        members = self._cells[cell]
+        del members[pid]
+        if not members:
+            del self._cells[cell]
+
+    def load(self, items: Iterable[Tuple[int, float, float]]) -> "PeakGridIndex":
+        with self._lock:
+            for pid, latitude, longitude in items:
+                self._insert(pid, latitude, longitude)
+        return self
+
+    def upsert(self, pid: int, latitude: float, longitude: float) -> None:
+        with self._lock:
+            self._insert(pid, latitude, longitude)
+
+    def remove(self, pid: int) -> None:
+        with self._lock:
+            self._remove(pid)
+
+    def position(self, pid: int) -> Optional[Tuple[float, float]]:
+        return self._positions.get(pid)
+
+    def query(
+        self, latitude_min: float, latitude_max: float, longitude_min: float, longitude_max: float
+    ) -> List[int]:
+        # returns the sorted pids of the peaks inside the bounds (bounds included)
+        i_min, j_min = self._cell_of(latitude_min, longitude_min)
+        i_max, j_max = self._cell_of(latitude_max, longitude_max)
+        pids = []
+        with self._lock:
+            nb_cells_in_range = (i_max - i_min + 1) * (j_max - j_min + 1)
+            if nb_cells_in_range <= len(self._cells):
+                cells = (
+                    (cell, self._cells.get(cell))
+                    for cell in (
+                        (i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1)
+                    )
+                )
+            else:
+                # zoomed-out bbox: cheaper to walk the populated cells only
+                cells = (
+                    (cell, members)
+                    for cell, members in self._cells.items()
+                    if i_min <= cell[0] <= i_max and j_min <= cell[1] <= j_max
+                )
+            for (i, j), members in cells:
+                if not members:
+                    continue
+                if i_min < i < i_max and j_min < j < j_max:
+                    # inner cell, all its peaks are inside the bbox
+                    pids.extend(members)
+                    continue
+                pids.extend(
+                    pid
+                    for pid, (latitude, longitude) in members.items()
+                    if latitude_min <= latitude <= latitude_max
+                    and longitude_min <= longitude <= longitude_max
+                )
+        pids.sort()
+        return pids
+
+    def count_upper_bound(
+        self, latitude_min: float, latitude_max: float, longitude_min: float, longitude_max: float
+    ) -> int:
+        # number of peaks of the cells overlapping the bounds, without testing their coordinates
+        i_min, j_min = self._cell_of(latitude_min, longitude_min)
+        i_max, j_max = self._cell_of(latitude_max, longitude_max)
+        with self._lock:
+            if (i_max - i_min + 1) * (j_max - j_min + 1) <= len(self._cells):
+                cells = (self._cells.get((i, j)) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1))
+            else:
+                cells = (
+                    members for (i, j), members in self._cells.items() if i_min <= i <= i_max and j_min <= j <= j_max
+                )
+            return sum(len(members) for members in cells if members)
+
+
+def build_peak_index(session: Session, cell_size: float = DEFAULT_CELL_SIZE) -> PeakGridIndex:
+    # load the index from the peaks table, without building any ORM object
+    rows = session.execute(
+        select(DBPeak.pid, DBPeak.latitude, DBPeak.longitude).execution_options(yield_per=10_000)
+    )
+    return PeakGridIndex(cell_size=cell_size).load(rows)
+
+
+# process-wide index, None while the in-memory index is disabled
+_PEAK_INDEX: Optional[PeakGridIndex] = None
+
+
+def get_peak_index() -> Optional[PeakGridIndex]:
+    return _PEAK_INDEX
+
+
+def set_peak_index(index: Optional[PeakGridIndex]) -> None:
+    global _PEAK_INDEX
+    _PEAK_INDEX = index
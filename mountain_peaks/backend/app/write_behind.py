@@ -0,0 +1,274 @@
+"""
+Write-behind mode of the peak inserts and updates, for the high-rate feeds of corrections.
+
+add_a_peak and update_a_peak commit a transaction per write, so the write throughput is bound
+by the commit latency. In write-behind mode, the validated PeakCreate and PeakUpdate payloads
+are queued in memory and answered at once with a ticket. A background thread flushes them by
+batches, as soon as a batch is full or the oldest pending write waited for the max delay:
+each batch is written by crud_ops.commit_peak_writes in a single transaction, then
+crud_ops.finish_peak_writes keeps the in-memory indexes and the response cache in sync as
+any other write. Only a failing transaction is retried: a batch is never written twice. The pending updates
+of a same pid are merged into a single one.
+The queue and the tickets live in the process: the outcome of a ticket is only known by the
+worker which accepted it, and the pending writes are lost if the worker is killed.
+It is optional: only enabled when the env var PEAKS_WRITE_BEHIND is set to "YES".
+"""
+from collections import OrderedDict
+from itertools import islice
+from os import getenv
+from threading import Condition, Thread
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from sqlalchemy.orm import sessionmaker
+
+from . import crud_ops
+from .crud_ops import PeakAlreadyExistsException, WriteQueueFullException
+from .schemas import (
+    PeakBulkUpdate as PeakBulkUpdateORM,
+    PeakCreate as PeakCreateORM,
+    PeakUpdate as PeakUpdateORM,
+    WriteTicket as WriteTicketORM,
+)
+
+# pending writes per transaction
+DEFAULT_BATCH_SIZE = 500
+# max wait of a pending write before its batch is flushed, seconds unit
+DEFAULT_MAX_DELAY = 0.05
+# pending writes above which the new ones are refused
+DEFAULT_MAX_PENDING = 50_000
+# outcomes kept for the status requests, the oldest ones are forgotten first
+DEFAULT_MAX_TICKETS = 100_000
+
+# (ticket, peak) of an insert, (pid, merged changes, tickets) of an update
+_Create = Tuple[str, PeakCreateORM]
+_Update = Tuple[int, dict, List[str]]
+
+
+class WriteBehindQueue:
+    """Pending inserts and updates, written by batches by a background thread"""
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        max_tickets: int = DEFAULT_MAX_TICKETS,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_tickets = max_tickets
+        self.flushed_batches = 0
+        self._condition = Condition()
+        self._creates: List[_Create] = []
+        # the pending changes of each pid, merged in arrival order, with the tickets waiting for them
+        self._updates: Dict[int, Tuple[dict, List[str]]] = {}
+        self._tickets: "OrderedDict[str, WriteTicketORM]" = OrderedDict()
+        self._oldest_pending_at: Optional[float] = None
+        self._flush_requested = False
+        self._flushing = False
+        self._closed = False
+        self._thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._run, name="peaks-write-behind", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        # the pending writes are flushed before the thread stops
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._creates) + len(self._updates)
+
+    def _enqueue(self, add) -> WriteTicketORM:
+        with self._condition:
+            if self._closed or len(self._creates) + len(self._updates) >= self.max_pending:
+                raise WriteQueueFullException(self.max_pending)
+            ticket = WriteTicketORM(ticket=uuid4().hex, status="pending")
+            self._tickets[ticket.ticket] = ticket
+            while len(self._tickets) > self.max_tickets:
+                self._tickets.popitem(last=False)
+            add(ticket.ticket)
+            if self._oldest_pending_at is None:
+                self._oldest_pending_at = monotonic()
+            self._condition.notify_all()
+            return ticket
+
+    def submit_create(self, peak: PeakCreateORM) -> WriteTicketORM:
+        return self._enqueue(lambda ticket: self._creates.append((ticket, peak)))
+
+    def submit_update(self, pid: int, peak_data: PeakUpdateORM) -> WriteTicketORM:
+        def add(ticket: str) -> None:
+            # coalesced with the pending update of the pid, the last value of each field wins
+            changes, tickets = self._updates.get(pid, ({}, []))
+            self._updates[pid] = ({**changes, **peak_data.model_dump(exclude_none=True)}, tickets + [ticket])
+
+        return self._enqueue(add)
+
+    def status(self, ticket: str) -> Optional[WriteTicketORM]:
+        with self._condition:
+            return self._tickets.get(ticket)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # write the pending writes at once and wait for them, False on timeout
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(
+                lambda: not (self._creates or self._updates or self._flushing), timeout
+            )
+
+    def _due(self) -> bool:
+        if not (self._creates or self._updates):
+            return False
+        return (
+            self._closed
+            or self._flush_requested
+            or len(self._creates) + len(self._updates) >= self.batch_size
+            or monotonic() - self._oldest_pending_at >= self.max_delay
+        )
+
+    def _take_batch(self) -> Tuple[List[_Create], List[_Update]]:
+        creates, self._creates = self._creates[:self.batch_size], self._creates[self.batch_size:]
+        pids = list(islice(self._updates, self.batch_size - len(creates)))
+        updates = [(pid, *self._updates.pop(pid)) for pid in pids]
+        if not (self._creates or self._updates):
+            # else the time of the writes left over is kept, their batch is due at once
+            self._oldest_pending_at = None
+            self._flush_requested = False
+        return creates, updates
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._due():
+                    if self._closed:
+                        return
+                    wait = None
+                    if self._oldest_pending_at is not None:
+                        wait = max(self._oldest_pending_at + self.max_delay - monotonic(), 0.0)
+                    self._condition.wait(wait)
+                creates, updates = self._take_batch()
+                self._flushing = True
+            outcomes = self._write(creates, updates)
+            with self._condition:
+                for ticket, outcome in outcomes.items():
+                    if ticket in self._tickets:
+                        self._tickets[ticket] = outcome
+                self.flushed_batches += 1
+                self._flushing = False
+                self._condition.notify_all()
+
+    def _write(self, creates: List[_Create], updates: List[_Update]) -> Dict[str, WriteTicketORM]:
+        outcomes = {}
+        # a name given twice in the batch is only inserted once, the first time
+        to_insert, names = [], set()
+        for ticket, peak in creates:
+            if peak.name in names:
+                outcomes[ticket] = WriteTicketORM(
+                    ticket=ticket, status="rejected", error=f"Duplicated peak name in the pending writes: {peak.name}"
+                )
+            else:
+                names.add(peak.name)
+                to_insert.append((ticket, peak))
+        failure, sync_error = None, None
+        with self.session_factory() as session:
+            try:
+                added, updated_pids, errors, changed = crud_ops.commit_peak_writes(
+                    session=session,
+                    peaks=[peak for _, peak in to_insert],
+                    updates=[PeakBulkUpdateORM(pid=pid, **changes) for pid, changes, _ in updates],
+                )
+            except Exception as ex:
+                failure = ex
+            else:
+                # committed: a failure from now on must not write the batch again
+                try:
+                    updated = crud_ops.finish_peak_writes(
+                        session=session, added_peaks=added, updated_pids=updated_pids, changed=changed
+                    )
+                except Exception as ex:
+                    updated, sync_error = [], f"Written, but the indexes may be out of sync: {ex.__class__.__name__}"
+        if failure is not None:
+            if len(to_insert) + len(updates) > 1:
+                # written again by halves, so that a faulty write fails alone
+                if to_insert and updates:
+                    halves = [(to_insert, []), ([], updates)]
+                else:
+                    middle = max(len(to_insert), len(updates)) // 2
+                    halves = [(to_insert[:middle], updates[:middle]), (to_insert[middle:], updates[middle:])]
+                for half_creates, half_updates in halves:
+                    outcomes.update(self._write(half_creates, half_updates))
+                return outcomes
+            if isinstance(failure, PeakAlreadyExistsException):
+                error = "The name was taken by a concurrent write"
+            else:
+                error = f"Write failed: {failure.__class__.__name__}"
+            tickets = [ticket for ticket, _ in to_insert]
+            tickets += [ticket for *_, pid_tickets in updates for ticket in pid_tickets]
+            for ticket in tickets:
+                outcomes[ticket] = WriteTicketORM(ticket=ticket, status="failed", error=error)
+            return outcomes
+        added_peaks = {peak.name: peak for peak in added}
+        for ticket, peak in to_insert:
+            if (added_peak := added_peaks.get(peak.name)) is not None:
+                outcomes[ticket] = WriteTicketORM(ticket=ticket, status="applied", peak=added_peak, error=sync_error)
+            else:
+                outcomes[ticket] = WriteTicketORM(
+                    ticket=ticket, status="rejected", error=f"This peak info already exists: {peak.name}"
+                )
+        updated_peaks = {peak.pid: peak for peak in updated}
+        for pid, _, tickets in updates:
+            for ticket in tickets:
+                if pid in errors:
+                    outcomes[ticket] = WriteTicketORM(ticket=ticket, status="rejected", error=errors[pid])
+                else:
+                    outcomes[ticket] = WriteTicketORM(
+                        ticket=ticket, status="applied", peak=updated_peaks.get(pid), error=sync_error
+                    )
+        return outcomes
+
+    def render(self) -> str:
+        # Prometheus text exposition format, appended to the other metrics
+        with self._condition:
+            pending, batches = len(self._creates) + len(self._updates), self.flushed_batches
+        return (
+            "# HELP peaks_write_behind_pending Writes waiting for their batch\n"
+            "# TYPE peaks_write_behind_pending gauge\n"
+            f"peaks_write_behind_pending {pending}\n"
+            "# HELP peaks_write_behind_batches_total Batches of writes flushed\n"
+            "# TYPE peaks_write_behind_batches_total counter\n"
+            f"peaks_write_behind_batches_total {batches}\n"
+        )
+
+
+def build_write_behind(session_factory: sessionmaker) -> WriteBehindQueue:
+    return WriteBehindQueue(
+        session_factory=session_factory,
+        batch_size=int(getenv("PEAKS_WRITE_BEHIND_BATCH_SIZE", str(DEFAULT_BATCH_SIZE))),
+        max_delay=float(getenv("PEAKS_WRITE_BEHIND_MAX_DELAY", str(DEFAULT_MAX_DELAY))),
+        max_pending=int(getenv("PEAKS_WRITE_BEHIND_MAX_PENDING", str(DEFAULT_MAX_PENDING))),
+    )
+
+
+# process-wide queue, None while the write-behind mode is disabled
+_WRITE_BEHIND: Optional[WriteBehindQueue] = None
+
+
+def get_write_behind() -> Optional[WriteBehindQueue]:
+    return _WRITE_BEHIND
+
+
+def set_write_behind(write_behind: Optional[WriteBehindQueue]) -> None:
+    global _WRITE_BEHIND
+    _WRITE_BEHIND = write_behind
@@ -0,0 +1,373 @@
+"""
+Async versions of the CRUD and search routes, on top of AsyncSession.
+
+They replace their sync counterparts when PEAKS_ASYNC_DB is set to "YES": the requests
+then wait for the db on the event loop instead of holding a thread of the threadpool.
+As for the sync routes, the session is injected with "Depends(get_async_db)" so that
+tests can override it with "app.dependency_overrides[get_async_db]".
+The read routes serve the same bodies as the sync ones, with the ETag, the response cache and
+the coalescing of the identical queries; the async sessions always read the primary.
+"""
+from typing import Awaitable, Callable, List, Literal, Optional
+
+from fastapi import APIRouter, Body, FastAPI, HTTPException, Query, Request, Response
+from fastapi.params import Depends
+from fastapi.routing import APIRoute
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db.create import get_async_db
+from .app import crud_ops, crud_ops_async
+from .app.admission import admit_bbox, admit_bboxes, admit_peaks_list, admit_point, admit_search, admit_write
+from .app.cache import attr_key, encode_through, exact_bbox_key, read_through_async
+from .app.name_index import DEFAULT_TOP_K
+from .app.responses import etag_response, peak_changes_to_json, peak_row_to_json, peak_rows_to_json
+from .app.single_flight import coalesce_async
+from .app.grid_pyramid import MAX_ZOOM, to_peak_clusters, zoom_for_cell_size
+from .app.crud_ops import (
+    PeakNotFoundException,
+    BadFormatEntryException,
+    PeakAlreadyExistsException,
+    BulkWriteException,
+)
+from .app.schemas import (
+    Peak as PeakORM,
+    PeakCreate as PeakCreateORM,
+    PeakUpdate as PeakUpdateORM,
+    PeakBulkUpdate as PeakBulkUpdateORM,
+    PeakAttr as PeakAttrORM,
+    PeakDistance as PeakDistanceORM,
+    PeakIds as PeakIdsORM,
+    PeaksBatch as PeaksBatchORM,
+    PeakChanges as PeakChangesORM,
+    PeakAttrPeaks as PeakAttrPeaksORM,
+    BulkError as BulkErrorORM,
+    BulkReport as BulkReportORM,
+    BBox as BBoxORM,
+    BBoxPeaks as BBoxPeaksORM,
+    Area as AreaORM,
+    PeakCluster as PeakClusterORM,
+    Coords as CoordsORM,
+)
+
+async_router = APIRouter()
+
+
+async def _read_once(db: AsyncSession, key: str, produce: Callable[[], Awaitable[bytes]]) -> bytes:
+    # from the response cache, else from the identical query in flight, else produced
+    return await read_through_async(key, lambda: coalesce_async(db, key, produce))
+
+
+@async_router.get("/peaks", response_model=List[PeakORM], dependencies=[Depends(admit_peaks_list)])
+async def get_all_mountain_peaks(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, gt=0, le=10_000, description="max number of peaks of the page"),
+    after: Optional[int] = Query(None, ge=0, description="pid of the last peak of the previous page"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakORM]:
+    if limit is None:
+        # the identical requests in flight share the query and the body
+        async def produce() -> bytes:
+            return peak_rows_to_json(await crud_ops_async.get_all_peaks(session=db, as_rows=True))
+
+        return etag_response(request, await _read_once(db, "peaks:all", produce), encode=encode_through)
+    peak_items = await crud_ops_async.get_peaks_page(session=db, limit=limit, after=after)
+    if len(peak_items) == limit:
+        response.headers["X-Next-After"] = str(peak_items[-1].pid)
+    return peak_items
+
+
+@async_router.get("/peaks/search", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+async def search_mountain_peaks(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=30, description="beginning of the name, typos tolerated"),
+    k: int = Query(10, gt=0, le=DEFAULT_TOP_K, description="max number of peaks to return"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakORM]:
+    peak_items = await crud_ops_async.search_peaks_by_name(session=db, query=q, k=k, as_rows=True)
+    return etag_response(request, peak_rows_to_json(peak_items))
+
+
+@async_router.get("/peaks/changes", response_model=PeakChangesORM, dependencies=[Depends(admit_search)])
+async def get_mountain_peaks_changes(
+    request: Request,
+    since: int = Query(0, ge=0, description="revision of the last sync, 0 for a full sync"),
+    limit: int = Query(1000, gt=0, le=10_000, description="about the max number of changes to return"),
+    db: AsyncSession = Depends(get_async_db),
+) -> PeakChangesORM:
+    upserted, deleted, revision, more = await crud_ops_async.get_peak_changes(
+        session=db, since=since, limit=limit, as_rows=True
+    )
+    return etag_response(request, peak_changes_to_json(upserted, deleted, revision, more))
+
+
+def _check_height_range(height_min: int, height_max: int) -> None:
+    if height_max < height_min:
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message("height_max shall be greater than or equal to height_min"),
+        )
+
+
+@async_router.get("/peaks/height_range", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+async def get_mountain_peaks_by_height_range(
+    request: Request,
+    height_min: int = Query(..., gt=0, description="min height, included"),
+    height_max: int = Query(..., gt=0, description="max height, included"),
+    limit: int = Query(100, gt=0, le=10_000, description="max number of peaks to return"),
+    order: Literal["asc", "desc"] = Query("asc", description="lowest or highest peaks first"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakORM]:
+    _check_height_range(height_min, height_max)
+    peak_items = await crud_ops_async.find_peaks_by_height_range(
+        session=db, height_min=height_min, height_max=height_max, limit=limit, descending=order == "desc", as_rows=True
+    )
+    return etag_response(request, peak_rows_to_json(peak_items))
+
+
+@async_router.get("/peaks/{peak_id}", dependencies=[Depends(admit_point)])
+async def get_a_mountain_peak_by_id(
+    request: Request, peak_id: int, db: AsyncSession = Depends(get_async_db)
+) -> PeakORM:
+    async def produce() -> bytes:
+        return peak_row_to_json(await crud_ops_async.get_a_peak_by_id(session=db, pid=peak_id, as_rows=True))
+
+    try:
+        return etag_response(request, await _read_once(db, f"peak:{peak_id}", produce), encode=encode_through)
+    except PeakNotFoundException:
+        raise HTTPException(
+            404,
+            detail=crud_ops.error_message(f"No peak found with the id: {peak_id}"),
+        )
+
+
+@async_router.post("/peaks", response_model=PeakORM, dependencies=[Depends(admit_write)])
+async def add_a_mountain_peak(peak: PeakCreateORM, db: AsyncSession = Depends(get_async_db)) -> PeakORM:
+    try:
+        return await crud_ops_async.add_a_peak(session=db, peak=peak)
+    except PeakAlreadyExistsException as ex:
+        raise HTTPException(
+            400,
+            detail=crud_ops.error_message(f"This peak info already exists: {ex.args[0]}"),
+        )
+
+
+@async_router.post("/peaks/batch", response_model=PeaksBatchORM, dependencies=[Depends(admit_point)])
+async def get_mountain_peaks_by_ids(peak_ids: PeakIdsORM, db: AsyncSession = Depends(get_async_db)) -> PeaksBatchORM:
+    found, missing = await crud_ops_async.get_peaks_batch(session=db, pids=peak_ids.pids)
+    return PeaksBatchORM(found={pid: PeakORM.model_validate(p) for pid, p in found.items()}, missing=missing)
+
+
+def _bulk_errors(errors) -> List[BulkErrorORM]:
+    return [BulkErrorORM(pid=pid, error=error) for pid, error in errors.items()]
+
+
+def _bulk_write_rejected(ex: BulkWriteException) -> HTTPException:
+    return HTTPException(
+        400,
+        detail={
+            **crud_ops.error_message("Atomic mode, nothing was written"),
+            "errors": [error.model_dump() for error in _bulk_errors(ex.args[0])],
+        },
+    )
+
+
+@async_router.put("/peaks/bulk", response_model=BulkReportORM, dependencies=[Depends(admit_write)])
+async def update_mountain_peaks(
+    peaks_data: List[PeakBulkUpdateORM] = Body(..., min_length=1, max_length=50_000),
+    atomic: bool = Query(False, description="all or nothing: no update applied if one is rejected"),
+    db: AsyncSession = Depends(get_async_db),
+) -> BulkReportORM:
+    try:
+        peaks, errors = await crud_ops_async.update_peaks(session=db, updates=peaks_data, atomic=atomic)
+    except BulkWriteException as ex:
+        raise _bulk_write_rejected(ex)
+    except PeakAlreadyExistsException:
+        raise HTTPException(
+            409,
+            detail=crud_ops.error_message("A name was taken by a concurrent write, nothing was written"),
+        )
+    return BulkReportORM(peaks=peaks, errors=_bulk_errors(errors))
+
+
+@async_router.delete("/peaks/bulk", response_model=BulkReportORM, dependencies=[Depends(admit_write)])
+async def delete_mountain_peaks(
+    peak_ids: PeakIdsORM,
+    atomic: bool = Query(False, description="all or nothing: no peak deleted if one is missing"),
+    db: AsyncSession = Depends(get_async_db),
+) -> BulkReportORM:
+    try:
+        peaks, missing = await crud_ops_async.delete_peaks(session=db, pids=peak_ids.pids, atomic=atomic)
+    except BulkWriteException as ex:
+        raise _bulk_write_rejected(ex)
+    return BulkReportORM(peaks=peaks, errors=_bulk_errors({pid: "no peak found with this id" for pid in missing}))
+
+
+@async_router.put("/peaks/{peak_id}", response_model=PeakORM, dependencies=[Depends(admit_write)])
+async def update_a_mountain_peak(
+    peak_id: int, peak_data: PeakUpdateORM, db: AsyncSession = Depends(get_async_db)
+) -> PeakORM:
+    try:
+        return await crud_ops_async.update_a_peak(session=db, peak_id=peak_id, peak_data=peak_data)
+    except PeakNotFoundException:
+        raise HTTPException(
+            404,
+            detail=crud_ops.error_message(f"No peak found with the id: {peak_id}"),
+        )
+    except PeakAlreadyExistsException as ex:
+        raise HTTPException(
+            400,
+            detail=crud_ops.error_message(f"This peak info already exists: {ex.args[0]}"),
+        )
+
+
+@async_router.delete("/peaks/{peak_id}", dependencies=[Depends(admit_write)])
+async def delete_a_mountain_peak(peak_id: int, db: AsyncSession = Depends(get_async_db)) -> PeakORM:
+    try:
+        return await crud_ops_async.delete_a_peak(session=db, peak_id=peak_id)
+    except PeakNotFoundException:
+        raise HTTPException(
+            404,
+            detail=crud_ops.error_message(f"No peak found with the id: {peak_id}"),
+        )
+
+
+@async_router.post("/get_peaks_from_attr", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+async def get_mountain_peak_by_attribute(
+    request: Request, from_attr: PeakAttrORM, db: AsyncSession = Depends(get_async_db)
+) -> List[PeakORM]:
+    async def produce() -> bytes:
+        return peak_rows_to_json(await crud_ops_async.find_peaks_by_attr(session=db, attr=from_attr, as_rows=True))
+
+    try:
+        return etag_response(request, await _read_once(db, attr_key(from_attr), produce), encode=encode_through)
+    except PeakNotFoundException:
+        raise HTTPException(
+            404,
+            detail=crud_ops.error_message(f"No peak found with the attribute: {from_attr}"),
+        )
+    except BadFormatEntryException:
+        entry_ex = '{"name": "Everest"} or {"height": 4808}'
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message(f'Wrong entry bad format. {entry_ex} was expected'),
+        )
+
+
+@async_router.post("/get_peaks_inside_bbox", response_model=List[PeakORM], dependencies=[Depends(admit_bbox)])
+async def get_mountain_peaks_by_bbox(
+    request: Request, inside_bbox: BBoxORM, db: AsyncSession = Depends(get_async_db)
+) -> List[PeakORM]:
+    async def produce() -> bytes:
+        return peak_rows_to_json(await crud_ops_async.find_peaks_into_bbox(session=db, bbox=inside_bbox, as_rows=True))
+
+    return etag_response(request, await _read_once(db, exact_bbox_key(inside_bbox), produce), encode=encode_through)
+
+
+@async_router.post("/get_peaks_from_attrs", response_model=List[PeakAttrPeaksORM], dependencies=[Depends(admit_search)])
+async def get_mountain_peaks_by_attributes(
+    from_attrs: List[PeakAttrORM] = Body(..., min_length=1, max_length=1000),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakAttrPeaksORM]:
+    try:
+        peak_items = await crud_ops_async.find_peaks_by_attrs(session=db, attrs=from_attrs)
+    except BadFormatEntryException:
+        entry_ex = '[{"name": "Everest"}, {"height": 4808}]'
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message(f'Wrong entry bad format. {entry_ex} was expected'),
+        )
+    return [
+        PeakAttrPeaksORM(attr=attr, peaks=[PeakORM.model_validate(p) for p in peaks])
+        for attr, peaks in zip(from_attrs, peak_items)
+    ]
+
+
+@async_router.post("/get_peaks_inside_bboxes", response_model=List[BBoxPeaksORM], dependencies=[Depends(admit_bboxes)])
+async def get_mountain_peaks_by_bboxes(
+    inside_bboxes: List[BBoxORM] = Body(..., min_length=1, max_length=100),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[BBoxPeaksORM]:
+    peak_items = await crud_ops_async.find_peaks_into_bboxes(session=db, bboxes=inside_bboxes)
+    return [
+        BBoxPeaksORM(bbox=bbox, peaks=[PeakORM.model_validate(p) for p in peaks])
+        for bbox, peaks in zip(inside_bboxes, peak_items)
+    ]
+
+
+@async_router.post("/get_peaks_inside_area", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+async def get_mountain_peaks_by_area(
+    request: Request, inside_area: AreaORM, db: AsyncSession = Depends(get_async_db)
+) -> List[PeakORM]:
+    peak_items = await crud_ops_async.find_peaks_into_area(session=db, area=inside_area, as_rows=True)
+    return etag_response(request, peak_rows_to_json(peak_items))
+
+
+def _clusters_zoom(zoom: Optional[int], cell_size: Optional[float]) -> int:
+    if (zoom is None) == (cell_size is None):
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message("Either the zoom or the cell_size is expected"),
+        )
+    return zoom if zoom is not None else zoom_for_cell_size(cell_size)
+
+
+@async_router.post("/get_peaks_clusters", response_model=List[PeakClusterORM], dependencies=[Depends(admit_search)])
+async def get_mountain_peaks_clusters(
+    inside_bbox: BBoxORM,
+    zoom: Optional[int] = Query(None, ge=0, le=MAX_ZOOM, description="cells of 180 / 2**zoom degrees"),
+    cell_size: Optional[float] = Query(None, gt=0.0, le=180.0, description="max cell size, degrees unit"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakClusterORM]:
+    zoom = _clusters_zoom(zoom, cell_size)
+    return to_peak_clusters(await crud_ops_async.find_peak_clusters(session=db, bbox=inside_bbox, zoom=zoom))
+
+
+@async_router.post("/get_tallest_peaks", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+async def get_tallest_mountain_peaks(
+    request: Request,
+    inside_bbox: Optional[BBoxORM] = None,
+    n: int = Query(10, gt=0, le=1000, description="number of peaks to return"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakORM]:
+    # the highest peaks first, of the whole table or of the bbox if given
+    peak_items = await crud_ops_async.find_tallest_peaks(session=db, n=n, bbox=inside_bbox, as_rows=True)
+    return etag_response(request, peak_rows_to_json(peak_items))
+
+
+def _with_distances(peaks_distances) -> List[PeakDistanceORM]:
+    return [
+        PeakDistanceORM(**PeakORM.model_validate(peak).model_dump(), distance_km=distance)
+        for peak, distance in peaks_distances
+    ]
+
+
+@async_router.post("/get_nearest_peaks", response_model=List[PeakDistanceORM], dependencies=[Depends(admit_search)])
+async def get_nearest_mountain_peaks(
+    from_coords: CoordsORM,
+    k: int = Query(10, gt=0, le=1000, description="number of peaks to return"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakDistanceORM]:
+    return _with_distances(await crud_ops_async.find_nearest_peaks(session=db, coords=from_coords, k=k))
+
+
+@async_router.post("/get_peaks_around", response_model=List[PeakDistanceORM], dependencies=[Depends(admit_search)])
+async def get_mountain_peaks_around(
+    from_coords: CoordsORM,
+    radius_km: float = Query(..., gt=0.0, description="search radius, km unit"),
+    db: AsyncSession = Depends(get_async_db),
+) -> List[PeakDistanceORM]:
+    return _with_distances(
+        await crud_ops_async.find_peaks_around(session=db, coords=from_coords, radius_km=radius_km)
+    )
+
+
+def use_async_routes(app: FastAPI) -> None:
+    # drop the sync routes having an async counterpart, then append the async ones:
+    # the routes declared before "/peaks/{peak_id}" (like "/peaks/ndjson") keep matching first
+    overridden = {(route.path, method) for route in async_router.routes for method in route.methods}
+    app.router.routes = [
+        route for route in app.router.routes
+        if not (isinstance(route, APIRoute) and any((route.path, m) in overridden for m in route.methods))
+    ]
+    app.include_router(async_router)
@@ -2,7 +2,7 @@ from os import getenv
 from pydantic import PostgresDsn
 
 
-def get_base_uri():
+def get_base_uri(scheme: str = "postgresql"):
     _db_user_f = getenv("POSTGRES_USER_FILE")
     _db_pawd_f = getenv("POSTGRES_PASSWORD_FILE")
     if not (_db_user_f and _db_pawd_f):
@@ -16,10 +16,58 @@ def get_base_uri():
     _db_port = int(getenv("DATABASE_PORT"))
     _db_name = getenv("POSTGRES_DB")
     return str(PostgresDsn.build(
-        scheme="postgresql",
+        scheme=scheme,
         username=_db_user,
         password=_db_pass,
         host=_db_server,
         port=_db_port,
         path=_db_name,
     ))
+
+
+def get_async_base_uri():
+    # same database, reached with the asyncio driver
+    return get_base_uri(scheme="postgresql+asyncpg")
+
+
+def get_replica_uris():
+    # comma separated SQLAlchemy urls of the read replicas, none by default
+    return [uri.strip() for uri in getenv("PEAKS_DB_REPLICA_URLS", "").split(",") if uri.strip()]
+
+
+def get_replica_settings():
+    return {
+        "policy": getenv("PEAKS_DB_REPLICA_POLICY", "round_robin"),
+        "eject_seconds": float(getenv("PEAKS_DB_REPLICA_EJECT_SECONDS", "30")),
+    }
+
+
+def get_read_your_writes_seconds():
+    # how long the reads of a client which just wrote go to the primary, above the replication lag
+    return float(getenv("PEAKS_READ_YOUR_WRITES_SECONDS", "5"))
+
+
+def get_pool_settings():
+    # pool sizing of each engine, so per uvicorn worker
+    return {
+        "pool_size": int(getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(getenv("DB_POOL_RECYCLE", "-1")),
+        "pool_pre_ping": getenv("DB_POOL_PRE_PING", "NO") == "YES",
+    }
+
+
+def get_statement_timeout_ms():
+    # 0 means no timeout
+    return int(getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+
+def pg_trgm_enabled():
+    # trigram index of the names on PostgreSQL, the pg_trgm extension has to be available
+    return getenv("PEAKS_PG_TRGM", "NO") == "YES"
+
+
+def sqlite_rtree_enabled():
+    # R*Tree index of the positions on SQLite, instead of the Hilbert key ranges
+    return getenv("PEAKS_SQLITE_RTREE", "NO") == "YES"
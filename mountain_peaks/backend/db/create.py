@@ -1,23 +1,107 @@
 from os import getenv
+from threading import Lock
+from typing import Dict, Mapping, Optional
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
 
 # from backend.app.main import app, db
 # with app.app_context():
 #     db.create_all()
 
 
-from .config import get_base_uri
+from .config import (
+    get_base_uri,
+    get_async_base_uri,
+    get_pool_settings,
+    get_replica_settings,
+    get_replica_uris,
+    get_statement_timeout_ms,
+)
+from .pool import TimedQueuePool, TimedAsyncQueuePool
+from .replicas import ON_REPLICA, READS_OWN_WRITES, ReplicaSet, reads_from_primary
 
-# create the db engine instance
-_ENGINE = None
-if getenv("AUTHORIZE_PROD_DB_TABLES_CREATION", "NO") == "YES":
-    _ENGINE = create_engine(get_base_uri())
+# process-wide db engines and session factories, created lazily on first use
+_ENGINE: Optional[Engine] = None
+_ASYNC_ENGINE: Optional[AsyncEngine] = None
+_REPLICA_SET: Optional[ReplicaSet] = None
+_SESSION_FACTORIES: Dict[Engine, sessionmaker] = {}
+_ASYNC_SESSION_FACTORIES: Dict[AsyncEngine, async_sessionmaker] = {}
+_LOCK = Lock()
 
 
-def get_session(engine=_ENGINE):
-    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def _prod_db_authorized() -> bool:
+    # make sure the original database is only reached by the app, not while testing
+    return getenv("AUTHORIZE_PROD_DB_TABLES_CREATION", "NO") == "YES"
+
+
+def _statement_timeout_args(url: str) -> dict:
+    # the statement timeout is set by each driver its own way, the other dialects don't get it
+    if not (timeout_ms := get_statement_timeout_ms()):
+        return {}
+    drivername = make_url(url).drivername
+    if drivername in ("postgresql", "postgresql+psycopg2"):
+        return {"options": f"-c statement_timeout={timeout_ms}"}
+    if drivername == "postgresql+asyncpg":
+        return {"server_settings": {"statement_timeout": str(timeout_ms)}}
+    return {}
+
+
+def _create_pooled_engine(url: str) -> Engine:
+    return create_engine(
+        url, poolclass=TimedQueuePool, connect_args=_statement_timeout_args(url), **get_pool_settings()
+    )
+
+
+def get_engine() -> Optional[Engine]:
+    global _ENGINE
+    if _ENGINE is None and _prod_db_authorized():
+        with _LOCK:
+            if _ENGINE is None:
+                _ENGINE = _create_pooled_engine(get_base_uri())
+    return _ENGINE
+
+
+def get_replica_set() -> Optional[ReplicaSet]:
+    # the read replicas, only when PEAKS_DB_REPLICA_URLS is set
+    global _REPLICA_SET
+    if _REPLICA_SET is None and _prod_db_authorized() and (uris := get_replica_uris()):
+        with _LOCK:
+            if _REPLICA_SET is None:
+                _REPLICA_SET = ReplicaSet([_create_pooled_engine(uri) for uri in uris], **get_replica_settings())
+    return _REPLICA_SET
+
+
+def set_replica_set(replica_set: Optional[ReplicaSet]) -> None:
+    global _REPLICA_SET
+    _REPLICA_SET = replica_set
+
+
+def get_async_engine() -> Optional[AsyncEngine]:
+    # the async engine is only created when the async routes are enabled
+    global _ASYNC_ENGINE
+    if _ASYNC_ENGINE is None and _prod_db_authorized() and getenv("PEAKS_ASYNC_DB", "NO") == "YES":
+        with _LOCK:
+            if _ASYNC_ENGINE is None:
+                url = get_async_base_uri()
+                _ASYNC_ENGINE = create_async_engine(
+                    url, poolclass=TimedAsyncQueuePool, connect_args=_statement_timeout_args(url),
+                    **get_pool_settings(),
+                )
+    return _ASYNC_ENGINE
+
+
+def get_session(engine: Optional[Engine] = None) -> sessionmaker:
+    # the session factory is built once per engine, not at each request
+    engine = engine if engine is not None else get_engine()
+    if (factory := _SESSION_FACTORIES.get(engine)) is None:
+        factory = _SESSION_FACTORIES.setdefault(
+            engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        )
+    return factory
 
 
 def get_db():
@@ -30,13 +114,65 @@ def get_db():
         database.close()
 
 
+def get_read_session(primary: Session, cookies: Mapping[str, str]) -> Session:
+    # read-only session on a replica, the primary one when there is no healthy replica or when
+    # the client has just written: the sessions only connect on first use, the primary
+    # session costs nothing while it is not used
+    replicas = get_replica_set()
+    if replicas is None:
+        return primary
+    if reads_from_primary(cookies):
+        primary.info[READS_OWN_WRITES] = True
+        return primary
+    while (engine := replicas.choose()) is not None:
+        database = get_session(engine)()
+        try:
+            # connect now, to fall back on another replica if this one is down
+            database.connection()
+        except OperationalError:
+            database.close()
+            replicas.eject(engine)
+            continue
+        database.info[ON_REPLICA] = True
+        return database
+    return primary
+
+
+def get_async_session(engine: Optional[AsyncEngine] = None) -> async_sessionmaker:
+    engine = engine if engine is not None else get_async_engine()
+    if (factory := _ASYNC_SESSION_FACTORIES.get(engine)) is None:
+        # no expiration on commit: the attributes of the returned objects can't be lazy loaded in async
+        factory = _ASYNC_SESSION_FACTORIES.setdefault(
+            engine, async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+        )
+    return factory
+
+
+async def get_async_db():
+    # async counterpart of get_db, used by the async routes
+    async with get_async_session()() as database:
+        yield database
+
+
+def get_pool_stats() -> dict:
+    # checked-out connections, overflow and checkout wait time of the created engines
+    stats = {}
+    engines = (("sync", _ENGINE), ("async", _ASYNC_ENGINE.sync_engine if _ASYNC_ENGINE is not None else None))
+    for name, engine in engines:
+        if engine is not None and hasattr(engine.pool, "stats"):
+            stats[name] = engine.pool.stats()
+    if _REPLICA_SET is not None:
+        stats.update(_REPLICA_SET.stats())
+    return stats
+
+
 class Base(DeclarativeBase):
     @classmethod
     def create_all_tables(cls, engine=None):
         # make sure the original database is used properly
-        if (
-            engine is None
-            and getenv("AUTHORIZE_PROD_DB_TABLES_CREATION", "NO") == "YES"
-        ):
-            engine = _ENGINE
+        if engine is None and _prod_db_authorized():
+            engine = get_engine()
         cls.metadata.create_all(bind=engine)
+        # bring the tables created by a previous version up to date
+        from .migrate import upgrade_tables
+        upgrade_tables(engine=engine)
@@ -0,0 +1,159 @@
+"""
+Hilbert curve keys of the peaks positions, for the bbox searches on plain B-tree indexes.
+
+The world is split into a 2**16 x 2**16 grid (cells of about 0.0055 x 0.0027 degrees),
+numbered along a Hilbert curve: close cells mostly have close keys, so that a bbox is
+covered by a few key ranges. A bbox search is then a handful of index range scans on the
+"hkey" column, followed by the exact refine on the latitude and longitude.
+"""
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# the grid has 2**HILBERT_ORDER cells per side, the keys fit in 2 * HILBERT_ORDER bits
+HILBERT_ORDER = 16
+# max number of key ranges covering a bbox, more ranges cover it more tightly
+HILBERT_MAX_RANGES = 128
+# the descent stops once the cells are this many times smaller than the bbox: the cells crossing
+# its border then only add a few percent of extra candidates
+_MIN_CELLS_PER_SIDE = 32
+
+
+def _grid_cells(latitudes: np.ndarray, longitudes: np.ndarray, order: int) -> Tuple[np.ndarray, np.ndarray]:
+    # (x, y) cells of the positions, the out of range coordinates go to the border cells
+    side = 1 << order
+    x = np.clip(np.floor((np.asarray(longitudes, dtype=float) + 180.0) / 360.0 * side), 0, side - 1)
+    y = np.clip(np.floor((np.asarray(latitudes, dtype=float) + 90.0) / 180.0 * side), 0, side - 1)
+    return x.astype(np.int64), y.astype(np.int64)
+
+
+def _xy_to_key(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    side = 1 << order
+    x, y = x.copy(), y.copy()
+    keys = np.zeros_like(x)
+    s = side >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant, so that the curve of the next level is oriented as this one
+        flip = ~ry & rx
+        x = np.where(flip, side - 1 - x, x)
+        y = np.where(flip, side - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return keys
+
+
+def key_to_xy(key: int, order: int) -> Tuple[int, int]:
+    # cell of a key, the inverse of the keys computation
+    x = y = 0
+    s = 1
+    while s < (1 << order):
+        rx = 1 & (key >> 1)
+        ry = 1 & (key ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        key >>= 2
+        s <<= 1
+    return x, y
+
+
+def _child_offsets(prefix: int, level: int) -> Tuple[Tuple[int, int], ...]:
+    # (dx, dy) of the 4 children of a node, in the curve order: the orientation of the node
+    x, y = key_to_xy(prefix, level)
+    return tuple(
+        (child_x - 2 * x, child_y - 2 * y)
+        for child_x, child_y in (key_to_xy(4 * prefix + child, level + 1) for child in range(4))
+    )
+
+
+def _children_table() -> Dict[tuple, Tuple[Tuple[int, int, tuple], ...]]:
+    # orientation of a node -> (dx, dy, orientation) of its children, the curve having only 4 orientations
+    table = {}
+    for prefix in range(4 ** 3):
+        table.setdefault(_child_offsets(prefix, 3), tuple(
+            (dx, dy, _child_offsets(4 * prefix + child, 4))
+            for child, (dx, dy) in enumerate(_child_offsets(prefix, 3))
+        ))
+    return table
+
+
+_CHILDREN = _children_table()
+
+
+def hilbert_keys(latitudes, longitudes, order: int = HILBERT_ORDER) -> np.ndarray:
+    return _xy_to_key(*_grid_cells(latitudes, longitudes, order), order)
+
+
+def hilbert_key(latitude: float, longitude: float, order: int = HILBERT_ORDER) -> int:
+    return int(hilbert_keys([latitude], [longitude], order)[0])
+
+
+def hilbert_ranges(
+    latitude_min: float,
+    latitude_max: float,
+    longitude_min: float,
+    longitude_max: float,
+    max_ranges: int = HILBERT_MAX_RANGES,
+    order: int = HILBERT_ORDER,
+) -> List[Tuple[int, int]]:
+    # sorted (key_min, key_max) ranges, bounds included, covering all the cells of the bbox
+    (x_min, x_max), (y_min, y_max) = _grid_cells(
+        [latitude_min, latitude_max], [longitude_min, longitude_max], order
+    )
+    min_side = int(min(x_max - x_min, y_max - y_min)) + 1
+    ranges = []
+    # quadtree descent along the curve: the keys of a node at a level share the node's prefix,
+    # the nodes inside the bbox are whole ranges, the ones crossing its border are split
+    nodes = [(0, 0, 0, _child_offsets(0, 0))]
+    for level in range(order + 1):
+        side = 1 << (order - level)
+        crossing = []
+        for node in nodes:
+            prefix, x, y, _ = node
+            node_x_min, node_y_min = x * side, y * side
+            node_x_max, node_y_max = node_x_min + side - 1, node_y_min + side - 1
+            if node_x_max < x_min or x_max < node_x_min or node_y_max < y_min or y_max < node_y_min:
+                continue
+            if x_min <= node_x_min and node_x_max <= x_max and y_min <= node_y_min and node_y_max <= y_max:
+                ranges.append((prefix * side * side, (prefix + 1) * side * side - 1))
+            else:
+                crossing.append(node)
+        if (
+            level == order
+            or len(ranges) + 4 * len(crossing) > max_ranges
+            or side * _MIN_CELLS_PER_SIDE <= min_side
+        ):
+            # out of budget: the crossing nodes are kept whole, the refine step drops their extra peaks
+            ranges.extend((prefix * side * side, (prefix + 1) * side * side - 1) for prefix, _, _, _ in crossing)
+            break
+        nodes = [
+            (4 * prefix + child, 2 * x + dx, 2 * y + dy, orientation)
+            for prefix, x, y, node_orientation in crossing
+            for child, (dx, dy, orientation) in enumerate(_CHILDREN[node_orientation])
+        ]
+    return _merge_ranges(ranges)
+
+
+def hilbert_boxes_ranges(
+    boxes: Sequence[Tuple[float, float, float, float]], max_ranges: int = HILBERT_MAX_RANGES
+) -> List[Tuple[int, int]]:
+    # key ranges covering any of the (lat_min, lat_max, lon_min, lon_max) boxes
+    return _merge_ranges([key_range for box in boxes for key_range in hilbert_ranges(*box, max_ranges=max_ranges)])
+
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    # sorted ranges, the overlapping or adjacent ones merged
+    ranges = sorted(ranges)
+    merged = []
+    for key_min, key_max in ranges:
+        if merged and key_min <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], key_max))
+        else:
+            merged.append((key_min, key_max))
+    return merged
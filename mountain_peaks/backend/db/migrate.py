@@ -0,0 +1,123 @@
+"""
+Idempotent schema upgrades of the existing tables.
+
+"create_all" only creates the missing tables, the columns and indexes added to the models
+afterwards are applied here on databases created by an older version of the app.
+"""
+from sqlalchemy import BigInteger, inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from .config import pg_trgm_enabled, sqlite_rtree_enabled
+from .hilbert import hilbert_keys
+
+# (table, column, DDL) of the columns added to the existing tables
+_ADDED_COLUMNS = (
+    ("peaks", "revision", "INTEGER NOT NULL DEFAULT 1"),
+    ("peaks", "hkey", "BIGINT"),
+)
+# the revisions are transaction ids on PostgreSQL, beyond the range of INTEGER
+_BIGINT_COLUMNS = (
+    ("peaks", "revision"),
+    ("peak_tombstones", "revision"),
+)
+# rows of each statement backfilling the Hilbert keys
+_BACKFILL_BATCH_SIZE = 10_000
+
+# each step has to be safe to run again on an up-to-date database
+_UPGRADE_STEPS = (
+    # no peaks should have the same name: the duplicated names have to be fixed beforehand
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_peaks_name ON peaks (name)",
+    # height ranges and tallest peaks, within a bbox or not
+    "CREATE INDEX IF NOT EXISTS ix_peaks_height ON peaks (height)",
+    "CREATE INDEX IF NOT EXISTS ix_peaks_latitude_longitude_height ON peaks (latitude, longitude, height)",
+    # changes feed: the existing peaks are at the first revision, the next write takes the second one
+    "CREATE INDEX IF NOT EXISTS ix_peaks_revision ON peaks (revision)",
+    "INSERT INTO peaks_revision (id, revision) SELECT 1, 1 WHERE NOT EXISTS (SELECT 1 FROM peaks_revision)",
+    # bbox searches on the Hilbert key ranges, the keys are backfilled after the steps
+    "CREATE INDEX IF NOT EXISTS ix_peaks_hkey ON peaks (hkey)",
+)
+
+# fuzzy search of the names on PostgreSQL, only applied with PEAKS_PG_TRGM=YES
+_PG_TRGM_STEPS = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_peaks_name_trgm ON peaks USING gin (name gin_trgm_ops)",
+)
+
+
+# revisions on SQLite, whatever writes to the peaks table: the counter row follows the revisions
+# written by the statements, and each deletion leaves a tombstone at the next revision
+_SQLITE_REVISION_STEPS = (
+    "CREATE TRIGGER IF NOT EXISTS peaks_revision_insert AFTER INSERT ON peaks BEGIN "
+    "UPDATE peaks_revision SET revision = new.revision WHERE revision < new.revision; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS peaks_revision_update AFTER UPDATE OF revision ON peaks BEGIN "
+    "UPDATE peaks_revision SET revision = new.revision WHERE revision < new.revision; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS peaks_tombstone_delete AFTER DELETE ON peaks BEGIN "
+    "INSERT INTO peak_tombstones (pid, revision) VALUES (old.pid, (SELECT revision + 1 FROM peaks_revision)) "
+    "ON CONFLICT (pid) DO UPDATE SET revision = excluded.revision; "
+    "UPDATE peaks_revision SET revision = revision + 1; "
+    "END",
+)
+
+
+# R*Tree index of the positions on SQLite, only applied with PEAKS_SQLITE_RTREE=YES:
+# the triggers keep it in sync with the peaks table, whatever writes to it
+_SQLITE_RTREE_STEPS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS peaks_rtree USING rtree("
+    "id, latitude_min, latitude_max, longitude_min, longitude_max)",
+    "CREATE TRIGGER IF NOT EXISTS peaks_rtree_insert AFTER INSERT ON peaks BEGIN "
+    "INSERT OR REPLACE INTO peaks_rtree VALUES (new.pid, new.latitude, new.latitude, new.longitude, new.longitude); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS peaks_rtree_update AFTER UPDATE OF latitude, longitude ON peaks BEGIN "
+    "INSERT OR REPLACE INTO peaks_rtree VALUES (new.pid, new.latitude, new.latitude, new.longitude, new.longitude); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS peaks_rtree_delete AFTER DELETE ON peaks BEGIN "
+    "DELETE FROM peaks_rtree WHERE id = old.pid; "
+    "END",
+    "INSERT OR REPLACE INTO peaks_rtree SELECT pid, latitude, latitude, longitude, longitude FROM peaks "
+    "WHERE NOT EXISTS (SELECT 1 FROM peaks_rtree WHERE peaks_rtree.id = peaks.pid)",
+)
+
+
+def _backfill_hilbert_keys(connection: Connection) -> None:
+    # keys of the peaks written by an older version of the app, by batches of pids
+    after = -1
+    while True:
+        rows = connection.execute(
+            text("SELECT pid, latitude, longitude FROM peaks WHERE hkey IS NULL AND pid > :after "
+                 "ORDER BY pid LIMIT :limit"),
+            {"after": after, "limit": _BACKFILL_BATCH_SIZE},
+        ).all()
+        if not rows:
+            return
+        pids, latitudes, longitudes = zip(*rows)
+        keys = hilbert_keys(latitudes, longitudes)
+        connection.execute(
+            text("UPDATE peaks SET hkey = :hkey WHERE pid = :pid"),
+            [{"pid": pid, "hkey": int(key)} for pid, key in zip(pids, keys)],
+        )
+        after = pids[-1]
+
+
+def upgrade_tables(engine: Engine) -> None:
+    steps = _UPGRADE_STEPS
+    if engine.dialect.name == "postgresql" and pg_trgm_enabled():
+        steps += _PG_TRGM_STEPS
+    if engine.dialect.name == "sqlite":
+        steps += _SQLITE_REVISION_STEPS
+    if engine.dialect.name == "sqlite" and sqlite_rtree_enabled():
+        steps += _SQLITE_RTREE_STEPS
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table, column, ddl in _ADDED_COLUMNS:
+            if column not in {c["name"] for c in inspector.get_columns(table)}:
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        if engine.dialect.name == "postgresql":
+            for table, column in _BIGINT_COLUMNS:
+                columns = {c["name"]: c["type"] for c in inspector.get_columns(table)}
+                if not isinstance(columns[column], BigInteger):
+                    connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+        for step in steps:
+            connection.execute(text(step))
+        _backfill_hilbert_keys(connection)
@@ -1,14 +1,50 @@
-from sqlalchemy import String, Integer, Float
+from typing import Optional
+
+from sqlalchemy import BigInteger, Index, String, Integer, Float
 from sqlalchemy.orm import Mapped, mapped_column
 
 from .create import Base
+from .hilbert import hilbert_key
+
+
+def _default_hkey(context) -> Optional[int]:
+    # the peaks inserted outside of the crud operations get their key from their position too
+    parameters = context.get_current_parameters()
+    if parameters.get("latitude") is None or parameters.get("longitude") is None:
+        return None
+    return hilbert_key(parameters["latitude"], parameters["longitude"])
 
 
 class DBPeak(Base):
     __tablename__ = "peaks"
+    # the bbox searches filtering or ordering on the height are served by the index only
+    __table_args__ = (Index("ix_peaks_latitude_longitude_height", "latitude", "longitude", "height"),)
 
     pid: Mapped[int] = mapped_column(primary_key=True, index=True, autoincrement=True)
-    name: Mapped[str] = mapped_column(String(30))
-    height: Mapped[int] = mapped_column(Integer)
+    # no peaks should have the same name
+    name: Mapped[str] = mapped_column(String(30), unique=True, index=True)
+    height: Mapped[int] = mapped_column(Integer, index=True)
     latitude: Mapped[float] = mapped_column(Float)
     longitude: Mapped[float] = mapped_column(Float)
+    # revision of the last write of the peak, for the incremental sync of the clients
+    # (the id of the write transaction on PostgreSQL)
+    revision: Mapped[int] = mapped_column(BigInteger, default=1, server_default="1", index=True)
+    # Hilbert curve key of the position, the bbox searches scan a few ranges of its index
+    hkey: Mapped[Optional[int]] = mapped_column(BigInteger, default=_default_hkey, index=True)
+
+
+class DBRevision(Base):
+    # single-row counter of the writes, each write statement takes the next revision and the triggers
+    # of the peaks table move it up (not used on PostgreSQL, where the revisions are transaction ids)
+    __tablename__ = "peaks_revision"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    revision: Mapped[int] = mapped_column(Integer)
+
+
+class DBPeakTombstone(Base):
+    # deleted peaks, with the revision of their deletion
+    __tablename__ = "peak_tombstones"
+
+    pid: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    revision: Mapped[int] = mapped_column(BigInteger, index=True)
@@ -0,0 +1,56 @@
+"""
+Connection pools recording how long the checkouts wait, to size the pools per worker
+"""
+from threading import Lock
+from time import perf_counter
+
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+class _TimedPoolMixin:
+    # the time spent in _do_get includes waiting for a free connection (or opening a new one)
+    wait_stats: PoolWaitStats
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.wait_stats.record(perf_counter() - start)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": self.overflow(),
+            "checkouts": self.wait_stats.checkouts,
+            "wait_time_total_ms": round(self.wait_stats.wait_total * 1000, 3),
+            "wait_time_max_ms": round(self.wait_stats.wait_max * 1000, 3),
+        }
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
@@ -0,0 +1,152 @@
+"""
+Routing of the read-only sessions to the read replicas.
+
+- ReplicaSet picks a healthy replica for each read session, round-robin or with the least
+  checked-out connections. A replica failing a checkout or a health check is ejected for a
+  while, and the reads go to the other replicas, or to the primary if none is left.
+- Read-your-writes: the crud operations mark the request that committed a write, and
+  ReadYourWritesMiddleware then sets a cookie sending the next reads of this client to the
+  primary until the replicas have caught up (PEAKS_READ_YOUR_WRITES_SECONDS). The request
+  state is carried by a context variable, which is copied into the threadpool running the
+  sync routes.
+- The read sessions tell the response cache where their reads come from (Session.info): the
+  results of a replica are only cached for the replication lag, and the reads of a client which
+  just wrote skip the cached entries, which may predate its write.
+The replicas are only used when PEAKS_DB_REPLICA_URLS is set.
+"""
+import itertools
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic, time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+ROUTING_POLICIES = ("round_robin", "least_connections")
+# cookie holding the time until which the reads of a client go to the primary
+PRIMARY_COOKIE = "peaks_primary_until"
+# keys of Session.info set by the read sessions
+ON_REPLICA = "peaks_on_replica"
+READS_OWN_WRITES = "peaks_reads_own_writes"
+
+
+class ReplicaSet:
+    """Replica engines with their ejection deadline, the choice is thread-safe"""
+
+    def __init__(
+        self,
+        engines: Sequence[Engine],
+        policy: str = "round_robin",
+        eject_seconds: float = 30.0,
+        clock: Callable[[], float] = monotonic,
+    ):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unsupported policy {policy}, expected one of {ROUTING_POLICIES}")
+        self.engines = list(engines)
+        self.policy = policy
+        self.eject_seconds = eject_seconds
+        self._clock = clock
+        self._ejected_until: Dict[Engine, float] = {}
+        self._counter = itertools.count()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def is_healthy(self, engine: Engine) -> bool:
+        return self._ejected_until.get(engine, 0.0) <= self._clock()
+
+    def healthy(self) -> List[Engine]:
+        with self._lock:
+            return [engine for engine in self.engines if self.is_healthy(engine)]
+
+    def choose(self) -> Optional[Engine]:
+        # a healthy replica, None when all of them are ejected
+        candidates = self.healthy()
+        if not candidates:
+            return None
+        if self.policy == "least_connections":
+            return min(candidates, key=lambda engine: engine.pool.checkedout())
+        return candidates[next(self._counter) % len(candidates)]
+
+    def eject(self, engine: Engine) -> None:
+        # readmitted once the delay is over, or by the next successful health check
+        with self._lock:
+            self._ejected_until[engine] = self._clock() + self.eject_seconds
+
+    def readmit(self, engine: Engine) -> None:
+        with self._lock:
+            self._ejected_until.pop(engine, None)
+
+    def check_health(self) -> None:
+        # "SELECT 1" on each replica, the failing ones are ejected
+        for engine in self.engines:
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+            except Exception:
+                self.eject(engine)
+            else:
+                self.readmit(engine)
+
+    def stats(self) -> dict:
+        stats = {}
+        for i, engine in enumerate(self.engines):
+            pool_stats = engine.pool.stats() if hasattr(engine.pool, "stats") else {}
+            stats[f"replica_{i}"] = {**pool_stats, "healthy": self.is_healthy(engine)}
+        return stats
+
+
+class _RequestWrites:
+    __slots__ = ("wrote",)
+
+    def __init__(self):
+        self.wrote = False
+
+
+_REQUEST_WRITES: ContextVar[Optional[_RequestWrites]] = ContextVar("peaks_request_writes", default=None)
+
+
+def mark_write() -> None:
+    # called once a write is committed, no-op outside of a request
+    if (writes := _REQUEST_WRITES.get()) is not None:
+        writes.wrote = True
+
+
+def reads_from_primary(cookies: Dict[str, str]) -> bool:
+    # the client wrote recently, the replicas may not have its write yet
+    try:
+        return float(cookies.get(PRIMARY_COOKIE, "0")) > time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    """Pure ASGI middleware setting the primary cookie on the responses of the writes"""
+
+    def __init__(self, app, window_seconds: float, enabled: Callable[[], bool]):
+        self.app = app
+        self.window_seconds = window_seconds
+        # the cookie is useless while no replica is configured
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        writes = _RequestWrites()
+        token = _REQUEST_WRITES.set(writes)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and writes.wrote and self.enabled():
+                cookie = (
+                    f"{PRIMARY_COOKIE}={time() + self.window_seconds:.3f}; "
+                    f"Max-Age={int(self.window_seconds) + 1}; Path=/; HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _REQUEST_WRITES.reset(token)
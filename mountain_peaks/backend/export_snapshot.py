@@ -0,0 +1,40 @@
+"""
+Command line export of the peaks table to a read-only snapshot file.
+
+    python -m mountain_peaks.backend.export_snapshot peaks.snap
+
+The db is the one configured with the POSTGRES_* env vars, unless --db-url is given.
+The snapshot is served by the "snapshot_server" app, without any database.
+"""
+import argparse
+import sys
+
+from sqlalchemy import create_engine, inspect
+
+from .db.config import get_base_uri
+from .db.create import get_session
+from .db.models import DBPeak
+from .app.snapshot import DEFAULT_CELL_SIZE, write_snapshot
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export of the mountain peaks to a snapshot file")
+    parser.add_argument("path", help="snapshot file to write, replaced atomically if it exists")
+    parser.add_argument("--cell-size", type=float, default=DEFAULT_CELL_SIZE,
+                        help="size of the cells of the spatial index, degrees unit")
+    parser.add_argument("--db-url", default=None, help="SQLAlchemy database url")
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.db_url or get_base_uri())
+    # a read-only export: no DDL, a db without the peaks table is not exported as an empty snapshot
+    if not inspect(engine).has_table(DBPeak.__tablename__):
+        print(f"no {DBPeak.__tablename__} table in the database, nothing exported", file=sys.stderr)
+        return 1
+    with get_session(engine=engine)() as db:
+        count = write_snapshot(session=db, path=args.path, cell_size=args.cell_size)
+    print(f"{count} peaks exported to {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
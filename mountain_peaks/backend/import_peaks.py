@@ -0,0 +1,47 @@
+"""
+Command line bulk import of peaks into the database, streamed by batches.
+
+    python -m mountain_peaks.backend.import_peaks peaks.csv --format csv
+    python -m mountain_peaks.backend.import_peaks - --format ndjson < peaks.ndjson
+
+The db is the one configured with the POSTGRES_* env vars, unless --db-url is given.
+"""
+import argparse
+import sys
+
+from sqlalchemy import create_engine
+
+from .db.config import get_base_uri
+from .db.create import Base, get_session
+from .app.ingest import PeaksIngestor, SUPPORTED_FORMATS, DEFAULT_BATCH_SIZE
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import of mountain peaks")
+    parser.add_argument("path", help="CSV or NDJSON file to import, '-' for stdin")
+    parser.add_argument("--format", choices=SUPPORTED_FORMATS, default=None,
+                        help="input format, guessed from the file extension by default")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--db-url", default=None, help="SQLAlchemy database url")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    engine = create_engine(args.db_url or get_base_uri())
+    Base.create_all_tables(engine=engine)
+    input_file = sys.stdin if args.path == "-" else open(args.path, "r", encoding="utf-8", newline="")
+    try:
+        with get_session(engine=engine)() as db:
+            ingestor = PeaksIngestor(session=db, fmt=fmt, batch_size=args.batch_size)
+            ingestor.feed_lines(input_file)
+            report = ingestor.close()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+    for error in report.errors:
+        print(f"line {error.line}: {error.error}", file=sys.stderr)
+    print(f"{report.inserted} peaks inserted, {len(report.errors)} entries rejected")
+    return 0 if not report.errors else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,109 @@
-from os import environ
-from typing import List
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+from os import environ, getenv
+from typing import Callable, Iterator, List, Literal, Optional
+from anyio import from_thread
+from fastapi import Body, FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.params import Depends
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
-from .db.create import Base, get_db
+from .async_routes import use_async_routes
+from .db.config import get_read_your_writes_seconds
+from .db.create import Base, get_db, get_read_session, get_replica_set, get_session, get_pool_stats
+from .db.replicas import ON_REPLICA, READS_OWN_WRITES, ReadYourWritesMiddleware, mark_write
 from .app import crud_ops
-from .app.crud_ops import PeakNotFoundException, BadFormatEntryException
+from .app.spatial_index import build_peak_index, set_peak_index
+from .app.name_index import DEFAULT_TOP_K, build_name_index, set_name_index
+from .app.height_index import build_height_index, set_height_index
+from .app.grid_pyramid import MAX_ZOOM, build_grid_pyramid, set_grid_pyramid, to_peak_clusters, zoom_for_cell_size
+from .app.ingest import PeaksIngestor, DEFAULT_BATCH_SIZE
+from .app.write_behind import WriteBehindQueue, build_write_behind, get_write_behind, set_write_behind
+from .app.cache import (
+    attr_key,
+    bbox_key,
+    build_response_cache,
+    encode_through,
+    exact_bbox_key,
+    get_response_cache,
+    read_through,
+    set_response_cache,
+    snap_bbox,
+)
+from .app.admission import (
+    AdmissionMiddleware,
+    admit_bbox,
+    admit_bboxes,
+    admit_dump,
+    admit_peaks_list,
+    admit_point,
+    admit_search,
+    admit_write,
+    build_admission,
+    get_admission,
+    set_admission,
+)
+from .app.single_flight import SingleFlight, coalesce, get_single_flight, set_single_flight
+from .app.compression import CompressionMiddleware, build_compression, set_compression
+from .app.metrics import METRICS, MetricsMiddleware
+from .app.responses import encode_json, etag_response, peak_changes_to_json, peak_row_to_json, peak_rows_to_json
+from .app.crud_ops import (
+    PeakNotFoundException,
+    BadFormatEntryException,
+    PeakAlreadyExistsException,
+    BulkWriteException,
+    WriteQueueFullException,
+)
 from .app.schemas import (
     Peak as PeakORM,
     PeakCreate as PeakCreateORM,
     PeakUpdate as PeakUpdateORM,
+    PeakBulkUpdate as PeakBulkUpdateORM,
     PeakAttr as PeakAttrORM,
-    BBox as BBoxORM
+    PeakDistance as PeakDistanceORM,
+    PeakIds as PeakIdsORM,
+    PeaksBatch as PeaksBatchORM,
+    PeakChanges as PeakChangesORM,
+    PeakAttrPeaks as PeakAttrPeaksORM,
+    BulkError as BulkErrorORM,
+    BulkReport as BulkReportORM,
+    IngestReport as IngestReportORM,
+    WriteTicket as WriteTicketORM,
+    BBox as BBoxORM,
+    BBoxPeaks as BBoxPeaksORM,
+    Area as AreaORM,
+    PeakCluster as PeakClusterORM,
+    Coords as CoordsORM,
 )
 
 app = FastAPI()
+# slots of the admission control released once the responses are fully sent
+app.add_middleware(AdmissionMiddleware)
+# compression of the responses not compressed by the routes, the streamed ones included;
+# innermost, so that the metrics count the bytes actually sent
+app.add_middleware(CompressionMiddleware)
+# per-route latency, sizes and SQL queries, debug headers with the queries count and db time
+app.add_middleware(MetricsMiddleware, debug_headers=getenv("PEAKS_DEBUG_HEADERS", "NO") == "YES")
+# the clients which just wrote read from the primary, while the replicas catch up
+app.add_middleware(
+    ReadYourWritesMiddleware,
+    window_seconds=get_read_your_writes_seconds(),
+    enabled=lambda: get_replica_set() is not None,
+)
+# interval of the health checks of the read replicas, seconds unit
+REPLICAS_HEALTH_CHECK_INTERVAL = 5.0
+
+
+def get_read_db(request: Request, primary: Session = Depends(get_db)):
+    # session of the read-only routes, on a replica unless the client has just written
+    database = get_read_session(primary, request.cookies)
+    try:
+        yield database
+    finally:
+        if database is not primary:
+            database.close()
 
 
 @app.get("/")
@@ -29,20 +117,190 @@ async def startup():
     # will be used only here, and not for testing
     environ["AUTHORIZE_PROD_DB_TABLES_CREATION"] = "YES"
     Base.create_all_tables()
+    if getenv("PEAKS_SPATIAL_INDEX", "NO") == "YES":
+        # load the optional in-memory spatial index used by the bbox search
+        with get_session()() as db:
+            set_peak_index(build_peak_index(session=db))
+    if getenv("PEAKS_NAME_INDEX", "NO") == "YES":
+        # in-memory trie and trigram index of the names, used by the search
+        with get_session()() as db:
+            set_name_index(build_name_index(session=db))
+    if getenv("PEAKS_HEIGHT_INDEX", "NO") == "YES":
+        # in-memory sorted array of the heights, for the height ranges and the tallest peaks
+        with get_session()() as db:
+            set_height_index(build_height_index(session=db))
+    if getenv("PEAKS_GRID_PYRAMID", "NO") == "YES":
+        # precomputed clusters of the peaks at each zoom level
+        with get_session()() as db:
+            set_grid_pyramid(build_grid_pyramid(session=db))
+    if getenv("PEAKS_RESPONSE_CACHE", "NO") == "YES":
+        # read-through cache of the read endpoints responses
+        set_response_cache(build_response_cache())
+    if getenv("PEAKS_COMPRESSION", "NO") == "YES":
+        # gzip, brotli or zstd bodies, negotiated with the clients
+        set_compression(build_compression())
+    if getenv("PEAKS_SINGLE_FLIGHT", "NO") == "YES":
+        # the identical reads in flight share a single query
+        set_single_flight(SingleFlight())
+    if getenv("PEAKS_ADMISSION", "NO") == "YES":
+        # bounded in-flight requests and queues per class of route, the excess is shed with a 503
+        with get_session()() as db:
+            set_admission(build_admission(session=db))
+    if getenv("PEAKS_WRITE_BEHIND", "NO") == "YES":
+        # inserts and updates queued and written by batches, answered with a ticket
+        write_behind = build_write_behind(session_factory=get_session())
+        write_behind.start()
+        set_write_behind(write_behind)
+    if (replicas := get_replica_set()) is not None:
+        # the task is referenced by the app state, so that it is not garbage collected
+        app.state.replicas_health_check = asyncio.create_task(_check_replicas_health(replicas))
+
+
+@app.on_event("shutdown")
+def shutdown():
+    if (write_behind := get_write_behind()) is not None:
+        # the pending writes are not lost on a graceful stop
+        write_behind.close()
+
+
+async def _check_replicas_health(replicas) -> None:
+    # eject the unreachable replicas, readmit the ones which are back
+    while True:
+        await run_in_threadpool(replicas.check_health)
+        await asyncio.sleep(REPLICAS_HEALTH_CHECK_INTERVAL)
+
+
+@app.get("/pool_stats")
+def get_db_pool_stats() -> dict:
+    # connections checked out, overflow and checkout wait time of this worker's pools
+    return get_pool_stats()
+
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    # Prometheus scraping endpoint
+    body = METRICS.render()
+    if (admission := get_admission()) is not None:
+        body += admission.render()
+    if (write_behind := get_write_behind()) is not None:
+        body += write_behind.render()
+    if (single_flight := get_single_flight()) is not None:
+        body += single_flight.render()
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
-@app.get("/peaks", response_model=List[PeakORM])
-def get_all_mountain_peaks(db: Session = Depends(get_db)) -> List[PeakORM]:
+
+def _read_once(db: Session, key: str, produce: Callable[[], bytes]) -> bytes:
+    # from the response cache, else from the identical query in flight, else produced:
+    # the results of a lagging replica are cached for the replication lag only
+    return read_through(
+        key,
+        lambda: coalesce(db, key, produce),
+        lookup=not db.info.get(READS_OWN_WRITES, False),
+        ttl=get_read_your_writes_seconds() if db.info.get(ON_REPLICA, False) else None,
+    )
+
+
+@app.get("/peaks", response_model=List[PeakORM], dependencies=[Depends(admit_peaks_list)])
+def get_all_mountain_peaks(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, gt=0, le=10_000, description="max number of peaks of the page"),
+    after: Optional[int] = Query(None, ge=0, description="pid of the last peak of the previous page"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakORM]:
     # "db: Session = Depends(get_db)" is the dependency injection mechanism proposed by FastAPI
     # to inject the session into each endpoint instead of being created each time
     # It will allow to test endpoints by using another db than the "PROD" db
-    return crud_ops.get_all_peaks(session=db)
+    if limit is None:
+        body = _read_once(db, "peaks:all", lambda: peak_rows_to_json(crud_ops.get_all_peaks(session=db, as_rows=True)))
+        return etag_response(request, body, encode=encode_through)
+    peak_items = crud_ops.get_peaks_page(session=db, limit=limit, after=after)
+    if len(peak_items) == limit:
+        # cursor to give as "after" to get the next page
+        response.headers["X-Next-After"] = str(peak_items[-1].pid)
+    return peak_items
+
+
+def _ndjson_lines(bind: Engine, chunk_size: int) -> Iterator[bytes]:
+    fields = list(PeakORM.model_fields)
+    # the session of the dependency is closed once the endpoint returns, before the body is sent:
+    # the stream reads with its own session on the same db, closed once fully sent
+    with get_session(bind)() as db:
+        for rows in crud_ops.iter_all_peaks(session=db, chunk_size=chunk_size):
+            yield "".join(
+                json.dumps(dict(zip(fields, row)), ensure_ascii=False, separators=(",", ":")) + "\n"
+                for row in rows
+            ).encode("utf-8")
+
+
+@app.get("/peaks/ndjson", dependencies=[Depends(admit_dump)])
+def stream_all_mountain_peaks(
+    chunk_size: int = Query(1000, gt=0, le=10_000, description="number of rows fetched at a time"),
+    db: Session = Depends(get_read_db),
+) -> StreamingResponse:
+    # full dump, one peak per line (NDJSON), with a flat memory usage
+    # the session only picks the db to read, the primary or a replica
+    lines = _ndjson_lines(bind=db.get_bind(), chunk_size=chunk_size)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@app.get("/peaks/search", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+def search_mountain_peaks(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=30, description="beginning of the name, typos tolerated"),
+    k: int = Query(10, gt=0, le=DEFAULT_TOP_K, description="max number of peaks to return"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakORM]:
+    # autocomplete: the names starting with the query first, highest peaks first, then the similar names
+    peak_items = crud_ops.search_peaks_by_name(session=db, query=q, k=k, as_rows=True)
+    return etag_response(request, peak_rows_to_json(peak_items))
+
+
+@app.get("/peaks/changes", response_model=PeakChangesORM, dependencies=[Depends(admit_search)])
+def get_mountain_peaks_changes(
+    request: Request,
+    since: int = Query(0, ge=0, description="revision of the last sync, 0 for a full sync"),
+    limit: int = Query(1000, gt=0, le=10_000, description="about the max number of changes to return"),
+    db: Session = Depends(get_read_db),
+) -> PeakChangesORM:
+    # incremental sync: only the peaks written or deleted since the client's revision
+    upserted, deleted, revision, more = crud_ops.get_peak_changes(session=db, since=since, limit=limit, as_rows=True)
+    return etag_response(request, peak_changes_to_json(upserted, deleted, revision, more))
+
+
+def _check_height_range(height_min: int, height_max: int) -> None:
+    if height_max < height_min:
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message("height_max shall be greater than or equal to height_min"),
+        )
+
+
+@app.get("/peaks/height_range", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+def get_mountain_peaks_by_height_range(
+    request: Request,
+    height_min: int = Query(..., gt=0, description="min height, included"),
+    height_max: int = Query(..., gt=0, description="max height, included"),
+    limit: int = Query(100, gt=0, le=10_000, description="max number of peaks to return"),
+    order: Literal["asc", "desc"] = Query("asc", description="lowest or highest peaks first"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakORM]:
+    _check_height_range(height_min, height_max)
+    peak_items = crud_ops.find_peaks_by_height_range(
+        session=db, height_min=height_min, height_max=height_max, limit=limit, descending=order == "desc", as_rows=True
+    )
+    return etag_response(request, peak_rows_to_json(peak_items))
 
 
-@app.get("/peaks/{peak_id}")
-def get_a_mountain_peak_by_id(peak_id: int, db: Session = Depends(get_db)) -> PeakORM:
+@app.get("/peaks/{peak_id}", response_model=PeakORM, dependencies=[Depends(admit_point)])
+def get_a_mountain_peak_by_id(request: Request, peak_id: int, db: Session = Depends(get_read_db)) -> PeakORM:
     try:
-        return crud_ops.get_a_peak_by_id(session=db, pid=peak_id)
+        body = _read_once(
+            db,
+            f"peak:{peak_id}",
+            lambda: peak_row_to_json(crud_ops.get_a_peak_by_id(session=db, pid=peak_id, as_rows=True)),
+        )
+        return etag_response(request, body, encode=encode_through)
     except PeakNotFoundException:
         raise HTTPException(
             404,
@@ -50,18 +308,105 @@ def get_a_mountain_peak_by_id(peak_id: int, db: Session = Depends(get_db)) -> Pe
         )
 
 
-@app.post("/peaks", response_model=PeakORM)
+@app.post("/peaks", response_model=PeakORM, dependencies=[Depends(admit_write)])
 def add_a_mountain_peak(peak: PeakCreateORM, db: Session = Depends(get_db)) -> PeakORM:
-    if peak_in_db := crud_ops.check_peak_exists(session=db, peak_data=peak):
+    try:
+        return crud_ops.add_a_peak(db, peak)
+    except PeakAlreadyExistsException as ex:
         raise HTTPException(
             400,
-            detail=crud_ops.error_message(f"This peak info already exists: {peak_in_db.pid}"),
+            detail=crud_ops.error_message(f"This peak info already exists: {ex.args[0]}"),
         )
-    else:
-        return crud_ops.add_a_peak(db, peak)
 
 
-@app.put("/peaks/{peak_id}", response_model=PeakORM)
+@app.post("/peaks/batch", response_model=PeaksBatchORM, dependencies=[Depends(admit_point)])
+def get_mountain_peaks_by_ids(peak_ids: PeakIdsORM, db: Session = Depends(get_read_db)) -> PeaksBatchORM:
+    # many ids in a single request and a single query, the unknown ids are reported instead of a 404
+    found, missing = crud_ops.get_peaks_batch(session=db, pids=peak_ids.pids, as_rows=True)
+    return PeaksBatchORM(found={pid: PeakORM.model_validate(row) for pid, row in found.items()}, missing=missing)
+
+
+def _body_lines(request: Request) -> Iterator[str]:
+    # lines of the streamed body with their line endings, read from a thread of the threadpool
+    chunks, remainder = request.stream().__aiter__(), b""
+    while True:
+        try:
+            chunk = from_thread.run(chunks.__anext__)
+        except StopAsyncIteration:
+            break
+        *complete_lines, remainder = (remainder + chunk).split(b"\n")
+        for line in complete_lines:
+            yield (line + b"\n").decode("utf-8", errors="replace")
+    if remainder:
+        yield remainder.decode("utf-8", errors="replace")
+
+
+@app.post("/peaks/import", response_model=IngestReportORM, dependencies=[Depends(admit_write)])
+async def import_mountain_peaks(
+    request: Request,
+    fmt: str = Query("ndjson", alias="format", pattern="^(csv|ndjson)$", description="csv or ndjson"),
+    batch_size: int = Query(DEFAULT_BATCH_SIZE, gt=0, le=50_000, description="peaks inserted per transaction"),
+    db: Session = Depends(get_db),
+) -> IngestReportORM:
+    # the body is ingested in the threadpool, so that the db calls don't block the event loop,
+    # while it is still streamed: the thread pulls the chunks as it reads the lines
+    ingestor = PeaksIngestor(session=db, fmt=fmt, batch_size=batch_size)
+
+    def ingest() -> IngestReportORM:
+        ingestor.feed_lines(_body_lines(request))
+        return ingestor.close()
+
+    return await run_in_threadpool(ingest)
+
+
+def _bulk_errors(errors) -> List[BulkErrorORM]:
+    return [BulkErrorORM(pid=pid, error=error) for pid, error in errors.items()]
+
+
+def _bulk_write_rejected(ex: BulkWriteException) -> HTTPException:
+    return HTTPException(
+        400,
+        detail={
+            **crud_ops.error_message("Atomic mode, nothing was written"),
+            "errors": [error.model_dump() for error in _bulk_errors(ex.args[0])],
+        },
+    )
+
+
+# the bulk routes are declared before the "/peaks/{peak_id}" ones, which would capture them
+@app.put("/peaks/bulk", response_model=BulkReportORM, dependencies=[Depends(admit_write)])
+def update_mountain_peaks(
+    peaks_data: List[PeakBulkUpdateORM] = Body(..., min_length=1, max_length=50_000),
+    atomic: bool = Query(False, description="all or nothing: no update applied if one is rejected"),
+    db: Session = Depends(get_db),
+) -> BulkReportORM:
+    # many updates with set-based statements in a single transaction
+    try:
+        peaks, errors = crud_ops.update_peaks(session=db, updates=peaks_data, atomic=atomic)
+    except BulkWriteException as ex:
+        raise _bulk_write_rejected(ex)
+    except PeakAlreadyExistsException:
+        raise HTTPException(
+            409,
+            detail=crud_ops.error_message("A name was taken by a concurrent write, nothing was written"),
+        )
+    return BulkReportORM(peaks=peaks, errors=_bulk_errors(errors))
+
+
+@app.delete("/peaks/bulk", response_model=BulkReportORM, dependencies=[Depends(admit_write)])
+def delete_mountain_peaks(
+    peak_ids: PeakIdsORM,
+    atomic: bool = Query(False, description="all or nothing: no peak deleted if one is missing"),
+    db: Session = Depends(get_db),
+) -> BulkReportORM:
+    try:
+        peaks, missing = crud_ops.delete_peaks(session=db, pids=peak_ids.pids, atomic=atomic)
+    except BulkWriteException as ex:
+        raise _bulk_write_rejected(ex)
+    return BulkReportORM(peaks=peaks, errors=_bulk_errors({pid: "no peak found with this id" for pid in missing}))
+
+
+@app.put("/peaks/{peak_id}", response_model=PeakORM, dependencies=[Depends(admit_write)])
 def update_a_mountain_peak(
     peak_id: int, peak_data: PeakUpdateORM, db: Session = Depends(get_db)
 ) -> PeakORM:
@@ -72,9 +417,14 @@ def update_a_mountain_peak(
             404,
             detail=crud_ops.error_message(f"No peak found with the id: {peak_id}"),
         )
+    except PeakAlreadyExistsException as ex:
+        raise HTTPException(
+            400,
+            detail=crud_ops.error_message(f"This peak info already exists: {ex.args[0]}"),
+        )
 
 
-@app.delete("/peaks/{peak_id}")
+@app.delete("/peaks/{peak_id}", dependencies=[Depends(admit_write)])
 def delete_a_mountain_peak(peak_id: int, db: Session = Depends(get_db)) -> PeakORM:
     try:
         peak_to_del = crud_ops.delete_a_peak(session=db, peak_id=peak_id)
@@ -86,10 +436,73 @@ def delete_a_mountain_peak(peak_id: int, db: Session = Depends(get_db)) -> PeakO
         )
 
 
-@app.post("/get_peaks_from_attr", response_model=List[PeakORM])
-def get_mountain_peak_by_attribute(from_attr: PeakAttrORM, db: Session = Depends(get_db)) -> List[PeakORM]:
+def _write_behind() -> WriteBehindQueue:
+    if (write_behind := get_write_behind()) is None:
+        raise HTTPException(
+            404,
+            detail=crud_ops.error_message("The write-behind mode is disabled, write with /peaks"),
+        )
+    return write_behind
+
+
+def _write_queue_full() -> HTTPException:
+    return HTTPException(
+        503,
+        detail=crud_ops.error_message("Too many pending writes, retry later"),
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.post(
+    "/peaks/write_behind", response_model=WriteTicketORM, status_code=202, dependencies=[Depends(admit_write)]
+)
+async def add_a_mountain_peak_behind(peak: PeakCreateORM) -> WriteTicketORM:
+    # accepted at once and inserted with the next batch, GET /peaks/write_behind/{ticket} gives the outcome
+    try:
+        ticket = _write_behind().submit_create(peak)
+    except WriteQueueFullException:
+        raise _write_queue_full()
+    mark_write()
+    return ticket
+
+
+@app.put(
+    "/peaks/write_behind/{peak_id}",
+    response_model=WriteTicketORM,
+    status_code=202,
+    dependencies=[Depends(admit_write)],
+)
+async def update_a_mountain_peak_behind(peak_id: int, peak_data: PeakUpdateORM) -> WriteTicketORM:
+    # merged with the pending update of the same peak if any, applied with the next batch
+    try:
+        ticket = _write_behind().submit_update(peak_id, peak_data)
+    except WriteQueueFullException:
+        raise _write_queue_full()
+    mark_write()
+    return ticket
+
+
+@app.get("/peaks/write_behind/{ticket}", response_model=WriteTicketORM, dependencies=[Depends(admit_point)])
+async def get_write_behind_ticket(ticket: str) -> WriteTicketORM:
+    if (status := _write_behind().status(ticket)) is None:
+        raise HTTPException(
+            404,
+            detail=crud_ops.error_message(f"Unknown ticket {ticket}, forgotten or accepted by another worker"),
+        )
+    return status
+
+
+@app.post("/get_peaks_from_attr", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+def get_mountain_peak_by_attribute(
+    request: Request, from_attr: PeakAttrORM, db: Session = Depends(get_read_db)
+) -> List[PeakORM]:
     try:
-        return crud_ops.find_peaks_by_attr(session=db, attr=from_attr)
+        body = _read_once(
+            db,
+            attr_key(from_attr),
+            lambda: peak_rows_to_json(crud_ops.find_peaks_by_attr(session=db, attr=from_attr, as_rows=True)),
+        )
+        return etag_response(request, body, encode=encode_through)
     except PeakNotFoundException:
         raise HTTPException(
             404,
@@ -97,10 +510,61 @@ def get_mountain_peak_by_attribute(from_attr: PeakAttrORM, db: Session = Depends
         )
 
 
-@app.post("/get_peaks_inside_bbox", response_model=List[PeakORM])
-def get_mountain_peaks_by_bbox(inside_bbox: BBoxORM, db: Session = Depends(get_db)) -> List[PeakORM]:
+@app.post("/get_peaks_from_attrs", response_model=List[PeakAttrPeaksORM], dependencies=[Depends(admit_search)])
+def get_mountain_peaks_by_attributes(
+    from_attrs: List[PeakAttrORM] = Body(..., min_length=1, max_length=1000),
+    db: Session = Depends(get_read_db),
+) -> List[PeakAttrPeaksORM]:
+    # many names or heights resolved with a single query, the results follow the given order
     try:
-        return crud_ops.find_peaks_into_bbox(session=db, bbox=inside_bbox)
+        peak_items = crud_ops.find_peaks_by_attrs(session=db, attrs=from_attrs, as_rows=True)
+    except BadFormatEntryException:
+        entry_ex = '[{"name": "Everest"}, {"height": 4808}]'
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message(f'Wrong entry bad format. {entry_ex} was expected'),
+        )
+    return [
+        PeakAttrPeaksORM(attr=attr, peaks=[PeakORM.model_validate(row) for row in rows])
+        for attr, rows in zip(from_attrs, peak_items)
+    ]
+
+
+@app.post("/get_peaks_inside_bbox", response_model=List[PeakORM], dependencies=[Depends(admit_bbox)])
+def get_mountain_peaks_by_bbox(
+    request: Request, inside_bbox: BBoxORM, db: Session = Depends(get_read_db)
+) -> List[PeakORM]:
+    try:
+        if get_response_cache() is None:
+            body = coalesce(
+                db,
+                exact_bbox_key(inside_bbox),
+                lambda: peak_rows_to_json(crud_ops.find_peaks_into_bbox(session=db, bbox=inside_bbox, as_rows=True)),
+            )
+            return etag_response(request, body)
+        # the shared entry is the result of the bbox snapped on the grid
+        snapped_bbox = snap_bbox(inside_bbox)
+
+        def snapped_body() -> bytes:
+            return _read_once(
+                db,
+                bbox_key(inside_bbox),
+                lambda: peak_rows_to_json(crud_ops.find_peaks_into_bbox(session=db, bbox=snapped_bbox, as_rows=True)),
+            )
+
+        if snapped_bbox == inside_bbox:
+            body = snapped_body()
+        else:
+            # refined to the exact bounds once, then served from its own entry as is
+            body = _read_once(
+                db,
+                exact_bbox_key(inside_bbox),
+                lambda: encode_json([
+                    peak for peak in json.loads(snapped_body())
+                    if inside_bbox.contains(peak["latitude"], peak["longitude"])
+                ]),
+            )
+        return etag_response(request, body, encode=encode_through)
     except PeakNotFoundException:
         raise HTTPException(
             404,
@@ -112,3 +576,90 @@ def get_mountain_peaks_by_bbox(inside_bbox: BBoxORM, db: Session = Depends(get_d
             422,
             detail=crud_ops.error_message(f'Wrong entry bad format. {entry_ex} was expected'),
         )
+
+
+@app.post("/get_peaks_inside_bboxes", response_model=List[BBoxPeaksORM], dependencies=[Depends(admit_bboxes)])
+def get_mountain_peaks_by_bboxes(
+    inside_bboxes: List[BBoxORM] = Body(..., min_length=1, max_length=100),
+    db: Session = Depends(get_read_db),
+) -> List[BBoxPeaksORM]:
+    # many bboxes evaluated with a single query (or index pass), the results follow the given order
+    peak_items = crud_ops.find_peaks_into_bboxes(session=db, bboxes=inside_bboxes, as_rows=True)
+    return [
+        BBoxPeaksORM(bbox=bbox, peaks=[PeakORM.model_validate(row) for row in rows])
+        for bbox, rows in zip(inside_bboxes, peak_items)
+    ]
+
+
+def _clusters_zoom(zoom: Optional[int], cell_size: Optional[float]) -> int:
+    if (zoom is None) == (cell_size is None):
+        raise HTTPException(
+            422,
+            detail=crud_ops.error_message("Either the zoom or the cell_size is expected"),
+        )
+    return zoom if zoom is not None else zoom_for_cell_size(cell_size)
+
+
+@app.post("/get_peaks_inside_area", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+def get_mountain_peaks_by_area(
+    request: Request, inside_area: AreaORM, db: Session = Depends(get_read_db)
+) -> List[PeakORM]:
+    # peaks inside any of the bboxes (possibly across the antimeridian) or polygons, in a single query
+    return etag_response(
+        request, peak_rows_to_json(crud_ops.find_peaks_into_area(session=db, area=inside_area, as_rows=True))
+    )
+
+
+@app.post("/get_peaks_clusters", response_model=List[PeakClusterORM], dependencies=[Depends(admit_search)])
+def get_mountain_peaks_clusters(
+    inside_bbox: BBoxORM,
+    zoom: Optional[int] = Query(None, ge=0, le=MAX_ZOOM, description="cells of 180 / 2**zoom degrees"),
+    cell_size: Optional[float] = Query(None, gt=0.0, le=180.0, description="max cell size, degrees unit"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakClusterORM]:
+    # aggregated view of a zoomed-out bbox: one entry per grid cell instead of one per peak
+    clusters = crud_ops.find_peak_clusters(session=db, bbox=inside_bbox, zoom=_clusters_zoom(zoom, cell_size))
+    return to_peak_clusters(clusters)
+
+
+@app.post("/get_tallest_peaks", response_model=List[PeakORM], dependencies=[Depends(admit_search)])
+def get_tallest_mountain_peaks(
+    request: Request,
+    inside_bbox: Optional[BBoxORM] = None,
+    n: int = Query(10, gt=0, le=1000, description="number of peaks to return"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakORM]:
+    # the highest peaks first, of the whole table or of the bbox if given
+    return etag_response(
+        request, peak_rows_to_json(crud_ops.find_tallest_peaks(session=db, n=n, bbox=inside_bbox, as_rows=True))
+    )
+
+
+def _with_distances(peaks_distances) -> List[PeakDistanceORM]:
+    return [
+        PeakDistanceORM(**PeakORM.model_validate(peak).model_dump(), distance_km=distance)
+        for peak, distance in peaks_distances
+    ]
+
+
+@app.post("/get_nearest_peaks", response_model=List[PeakDistanceORM], dependencies=[Depends(admit_search)])
+def get_nearest_mountain_peaks(
+    from_coords: CoordsORM,
+    k: int = Query(10, gt=0, le=1000, description="number of peaks to return"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakDistanceORM]:
+    return _with_distances(crud_ops.find_nearest_peaks(session=db, coords=from_coords, k=k))
+
+
+@app.post("/get_peaks_around", response_model=List[PeakDistanceORM], dependencies=[Depends(admit_search)])
+def get_mountain_peaks_around(
+    from_coords: CoordsORM,
+    radius_km: float = Query(..., gt=0.0, description="search radius, km unit"),
+    db: Session = Depends(get_read_db),
+) -> List[PeakDistanceORM]:
+    return _with_distances(crud_ops.find_peaks_around(session=db, coords=from_coords, radius_km=radius_km))
+
+
+if getenv("PEAKS_ASYNC_DB", "NO") == "YES":
+    # serve the CRUD and search routes with the async db stack
+    use_async_routes(app)
@@ -0,0 +1,117 @@
+"""
+Read-only app serving the read endpoints from a snapshot file, without any database.
+
+    python -m mountain_peaks.backend.export_snapshot peaks.snap
+    PEAKS_SNAPSHOT_PATH=peaks.snap uvicorn mountain_peaks.backend.snapshot_server:app --workers 4
+
+The snapshot is memory-mapped at startup, which only reads its header: the workers share
+the pages of the file through the page cache. The responses are the same as the ones of
+the main app for the same data.
+"""
+from os import getenv
+from typing import List, Optional
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.params import Depends
+from fastapi.responses import PlainTextResponse
+
+from .app.compression import CompressionMiddleware, build_compression, set_compression
+from .app.crud_ops import error_message
+from .app.metrics import METRICS, MetricsMiddleware
+from .app.responses import etag_response, peak_row_to_json, peak_rows_to_json
+from .app.snapshot import PeakSnapshot, get_snapshot, set_snapshot
+from .app.schemas import (
+    Peak as PeakORM,
+    PeakAttr as PeakAttrORM,
+    BBox as BBoxORM,
+)
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware, debug_headers=getenv("PEAKS_DEBUG_HEADERS", "NO") == "YES")
+
+
+@app.on_event("startup")
+async def startup():
+    if (path := getenv("PEAKS_SNAPSHOT_PATH")) is not None:
+        set_snapshot(PeakSnapshot.open(path))
+    if getenv("PEAKS_COMPRESSION", "NO") == "YES":
+        set_compression(build_compression())
+
+
+def snapshot() -> PeakSnapshot:
+    # the snapshot opened at startup, injected so that tests can override it
+    if (opened := get_snapshot()) is None:
+        raise HTTPException(503, detail=error_message("No snapshot loaded, set PEAKS_SNAPSHOT_PATH"))
+    return opened
+
+
+@app.get("/")
+def root(peaks: PeakSnapshot = Depends(snapshot)):
+    return {"snapshot": peaks.path, "peaks": len(peaks), "revision": peaks.revision}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/peaks", response_model=List[PeakORM])
+def get_all_mountain_peaks(
+    request: Request,
+    limit: Optional[int] = Query(None, gt=0, le=10_000, description="max number of peaks of the page"),
+    after: Optional[int] = Query(None, ge=0, description="pid of the last peak of the previous page"),
+    peaks: PeakSnapshot = Depends(snapshot),
+) -> List[PeakORM]:
+    if limit is None:
+        return etag_response(request, peak_rows_to_json(peaks.rows()))
+    rows = peaks.rows(peaks.page(limit=limit, after=after))
+    response = etag_response(request, peak_rows_to_json(rows))
+    if len(rows) == limit:
+        # cursor to give as "after" to get the next page
+        response.headers["X-Next-After"] = str(rows[-1][0])
+    return response
+
+
+@app.get("/peaks/{peak_id}", response_model=PeakORM)
+def get_a_mountain_peak_by_id(
+    request: Request, peak_id: int, peaks: PeakSnapshot = Depends(snapshot)
+) -> PeakORM:
+    if (position := peaks.position_of(peak_id)) is None:
+        raise HTTPException(
+            404,
+            detail=error_message(f"No peak found with the id: {peak_id}"),
+        )
+    return etag_response(request, peak_row_to_json(peaks.rows(np.array([position]))[0]))
+
+
+@app.post("/get_peaks_from_attr", response_model=List[PeakORM])
+def get_mountain_peak_by_attribute(
+    request: Request, from_attr: PeakAttrORM, peaks: PeakSnapshot = Depends(snapshot)
+) -> List[PeakORM]:
+    if from_attr.name:
+        positions = peaks.positions_by_name(from_attr.name)
+    elif from_attr.height:
+        # same height tolerance of 1 meter as the db search
+        positions = peaks.positions_by_height(from_attr.height - 1, from_attr.height + 1)
+    else:
+        entry_ex = '{"name": "Everest"} or {"height": 4808}'
+        raise HTTPException(
+            422,
+            detail=error_message(f'Wrong entry bad format. {entry_ex} was expected'),
+        )
+    if len(positions) == 0:
+        raise HTTPException(
+            404,
+            detail=error_message(f"No peak found with the attribute: {from_attr}"),
+        )
+    return etag_response(request, peak_rows_to_json(peaks.rows(positions)))
+
+
+@app.post("/get_peaks_inside_bbox", response_model=List[PeakORM])
+def get_mountain_peaks_by_bbox(
+    request: Request, inside_bbox: BBoxORM, peaks: PeakSnapshot = Depends(snapshot)
+) -> List[PeakORM]:
+    # left-bottom-right-top given, possibly across the antimeridian
+    return etag_response(request, peak_rows_to_json(peaks.rows(peaks.positions_in_boxes(inside_bbox.parts()))))
@@ -0,0 +1,23 @@
+"""
+Test helpers shared by the test modules
+"""
+import os
+
+import pytest
+
+# the responses of the app carry the number of SQL queries run by their own request,
+# read before the app module builds its middlewares
+os.environ.setdefault("PEAKS_DEBUG_HEADERS", "YES")
+
+
+def _assert_max_queries(response, max_queries: int):
+    # fails if the request ran more SQL queries than expected (N+1, extra refresh, ...): the queries
+    # are counted by the request itself, not by the process, the other threads are left out
+    count = int(response.headers["x-db-query-count"])
+    assert count <= max_queries, f"{count} SQL queries run, {max_queries} at most expected"
+    return response
+
+
+@pytest.fixture
+def assert_max_queries():
+    return _assert_max_queries
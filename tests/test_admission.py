@@ -0,0 +1,215 @@
+"""
+Tests of the admission control: the limiters of the classes of route, the 503s shedding the
+excess of requests and the classification of the bbox searches by their estimated size
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.main import app
+from mountain_peaks.backend.db.create import Base, get_db, get_session
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.app.admission import (
+    AdmissionController,
+    RouteClassLimiter,
+    build_admission,
+    estimate_bbox_peaks,
+    set_admission,
+)
+from mountain_peaks.backend.app.peaks_count import count_written_peaks
+from mountain_peaks.backend.app.grid_pyramid import build_grid_pyramid, set_grid_pyramid
+from mountain_peaks.backend.app.spatial_index import build_peak_index, set_peak_index
+from mountain_peaks.backend.app.schemas import BBox
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+# 20 x 20 peaks, one per 0.5 degree between 0 and 10 degrees of latitude and longitude
+GRID = [(i / 2, j / 2) for i in range(20) for j in range(20)]
+
+
+@pytest.fixture
+def client():
+    Base.create_all_tables(engine=test_engine)
+    with get_session(engine=test_engine)() as db:
+        db.add_all(
+            DBPeak(name=f"Admitted Peak {n}", height=1000 + n, latitude=latitude, longitude=longitude)
+            for n, (latitude, longitude) in enumerate(GRID)
+        )
+        db.commit()
+
+    def override_get_db():
+        db = get_session(engine=test_engine)()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    yield TestClient(app)
+    set_admission(None)
+    set_peak_index(None)
+    set_grid_pyramid(None)
+    if previous_override is not None:
+        app.dependency_overrides[get_db] = previous_override
+    else:
+        del app.dependency_overrides[get_db]
+    Base.metadata.drop_all(bind=test_engine)
+
+
+class TestRouteClassLimiter:
+
+    def test_queue_and_handoff(self):
+        async def scenario():
+            limiter = RouteClassLimiter("search", max_in_flight=1, max_queued=2, queue_timeout=1.0)
+            assert await limiter.acquire()
+            waiters = [asyncio.create_task(limiter.acquire()) for _ in range(2)]
+            await asyncio.sleep(0)
+            # the queue is full, the next request is shed at once
+            assert not await limiter.acquire()
+            assert limiter.stats() == {
+                "in_flight": 1, "queued": 2, "rejected": 1, "max_in_flight": 1, "max_queued": 2
+            }
+            # each release hands the slot over to the first waiter, in order
+            limiter.release()
+            assert await waiters[0] and not waiters[1].done()
+            limiter.release()
+            assert await waiters[1]
+            limiter.release()
+            assert limiter.stats()["in_flight"] == 0 and limiter.stats()["queued"] == 0
+
+        asyncio.run(scenario())
+
+    def test_timeout_and_cancellation(self):
+        async def scenario():
+            limiter = RouteClassLimiter("dump", max_in_flight=1, max_queued=4, queue_timeout=0.05)
+            assert await limiter.acquire()
+            # waited longer than the queue timeout
+            assert not await limiter.acquire()
+            assert limiter.stats()["queued"] == 0 and limiter.stats()["rejected"] == 1
+            # a request cancelled while queued leaves the queue
+            cancelled = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            assert limiter.stats()["queued"] == 0 and limiter.stats()["in_flight"] == 1
+            limiter.release()
+            assert await limiter.acquire()
+
+        asyncio.run(scenario())
+
+
+class TestAdmission:
+
+    def test_excess_requests_shed(self, client):
+        admission = AdmissionController(limits={"point": (1, 0)}, retry_after=3)
+        set_admission(admission)
+        assert client.get("/peaks/1").status_code == 200
+        # a point read holding the only slot
+        admission.limiters["point"].in_flight = 1
+        resp = client.get("/peaks/1")
+        assert resp.status_code == 503 and resp.headers["Retry-After"] == "3"
+        # the other classes are not affected
+        assert client.get("/peaks", params={"limit": 5}).status_code == 200
+        admission.limiters["point"].in_flight = 0
+        assert client.get("/peaks/1").status_code == 200
+        assert all(limiter.stats()["in_flight"] == 0 for limiter in admission.limiters.values())
+        metrics = client.get("/metrics").text
+        assert 'peaks_admission_rejected_total{route_class="point"} 1' in metrics
+        assert 'peaks_admission_in_flight{route_class="dump"} 0' in metrics
+
+    def test_streamed_responses_hold_their_slot(self, client):
+        admission = AdmissionController(limits={"dump": (1, 0)})
+        set_admission(admission)
+        in_flight, requests = [], [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # no disconnection of the client
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                in_flight.append(admission.limiters["dump"].stats()["in_flight"])
+
+        # the TestClient reads the whole body before returning, the app is called as is
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+            "path": "/peaks/ndjson", "raw_path": b"/peaks/ndjson", "root_path": "", "query_string": b"chunk_size=10",
+            "headers": [], "client": ("test", 1), "server": ("test", 80),
+        }
+        asyncio.run(app(scope, receive, send))
+        # each chunk of the stream is sent while holding the slot
+        assert len(in_flight) > len(GRID) // 10 and set(in_flight) == {1}
+        assert admission.limiters["dump"].stats()["in_flight"] == 0
+        assert len(client.get("/peaks").json()) == len(GRID)
+
+    def test_bbox_searches_classified(self, client):
+        with get_session(engine=test_engine)() as db:
+            admission = build_admission(session=db)
+        # without the in-memory indexes, the estimates assume the peaks spread over the whole earth
+        admission.total_peaks, admission.bbox_demote, admission.bbox_reject = 200_000, 50, 200
+        set_admission(admission)
+        # the large bboxes are dumps, the dumps class is full
+        admission.limiters["dump"].in_flight = admission.limiters["dump"].max_in_flight
+        admission.limiters["dump"].max_queued = 0
+        small = {"latitude_min": 0, "latitude_max": 1, "longitude_min": 0, "longitude_max": 1}
+        large = {"latitude_min": 0, "latitude_max": 4, "longitude_min": 0, "longitude_max": 4}
+        huge = {"latitude_min": -90, "latitude_max": 90, "longitude_min": -180, "longitude_max": 180}
+        for set_indexes in (False, True):
+            if set_indexes:
+                with get_session(engine=test_engine)() as db:
+                    set_peak_index(build_peak_index(session=db))
+                    set_grid_pyramid(build_grid_pyramid(session=db))
+            assert client.post("/get_peaks_inside_bbox", json=small).status_code == 200
+            assert client.post("/get_peaks_inside_bbox", json=large).status_code == 503
+            resp = client.post("/get_peaks_inside_bbox", json=huge)
+            assert resp.status_code == 422 and "narrow it" in resp.json()["detail"]["error"]
+            assert client.post("/get_peaks_inside_bboxes", json=[small, small]).status_code == 200
+            assert client.post("/get_peaks_inside_bboxes", json=[small] * 12).status_code == 503
+        # malformed bodies are left to the validation of the route
+        assert client.post("/get_peaks_inside_bbox", json={"latitude_min": 0}).status_code == 422
+
+    def test_estimates(self, client):
+        bbox = BBox(latitude_min=0, latitude_max=5, longitude_min=0, longitude_max=5)
+        exact = sum(bbox.contains(latitude, longitude) for latitude, longitude in GRID)
+        # from the bbox area only, the peaks being spread over the whole earth
+        assert estimate_bbox_peaks(bbox, total_peaks=len(GRID)) <= exact
+        assert estimate_bbox_peaks(BBox(latitude_min=-90, latitude_max=90, longitude_min=-180, longitude_max=180),
+                                   total_peaks=len(GRID)) == len(GRID)
+        with get_session(engine=test_engine)() as db:
+            set_peak_index(build_peak_index(session=db))
+            # upper bounds from the cells of the index, then of the pyramid
+            assert exact <= estimate_bbox_peaks(bbox) <= len(GRID)
+            set_grid_pyramid(build_grid_pyramid(session=db))
+            assert exact <= estimate_bbox_peaks(bbox) <= len(GRID)
+
+    def test_writes_counted_and_classified(self, client):
+        with get_session(engine=test_engine)() as db:
+            admission = build_admission(session=db)
+        set_admission(admission)
+        assert admission.total_peaks == len(GRID)
+        in_data = {"name": "Counted Peak", "height": 1000, "latitude": 1.0, "longitude": 1.0}
+        peak_id = client.post("/peaks", json=in_data).json()["pid"]
+        assert client.put(f"/peaks/{peak_id}", json={"height": 2000}).status_code == 200
+        assert admission.total_peaks == len(GRID) + 1
+        assert client.delete(f"/peaks/{peak_id}").status_code == 200
+        assert admission.total_peaks == len(GRID)
+        # the counts of the concurrent writers are not lost
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda _: count_written_peaks(added=2, removed=1), range(8000)))
+        assert admission.total_peaks == len(GRID) + 8000
+        # the deferred writes are writes too
+        admission.limiters["write"].in_flight = admission.limiters["write"].max_in_flight
+        admission.limiters["write"].max_queued = 0
+        assert client.put("/peaks/write_behind/1", json={"height": 7}).status_code == 503
+        assert client.post("/peaks/write_behind", json=in_data).status_code == 503
+        assert client.get("/peaks/1").status_code == 200
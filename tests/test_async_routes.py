@@ -0,0 +1,105 @@
+"""
+Tests of the async routes, with an aiosqlite database overriding the async session injection
+"""
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from mountain_peaks.backend.async_routes import use_async_routes
+from mountain_peaks.backend.app.cache import LocalResponseCache, get_response_cache, set_response_cache
+from mountain_peaks.backend.db.create import Base, get_async_db, get_async_session
+
+
+@pytest.fixture
+def async_client(tmp_path):
+    # a file db: the async connections are opened on the event loop of the test client
+    db_path = tmp_path / "peaks.db"
+    sync_engine = create_engine(f"sqlite:///{db_path}")
+    Base.create_all_tables(engine=sync_engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool)
+
+    async def override_get_async_db():
+        async with get_async_session(engine=async_engine)() as test_db:
+            yield test_db
+
+    async_app = FastAPI()
+    use_async_routes(async_app)
+    async_app.dependency_overrides[get_async_db] = override_get_async_db
+    with TestClient(async_app) as client:
+        yield client
+    sync_engine.dispose()
+
+
+class TestAsyncRoutes:
+
+    def test_crud_and_search(self, async_client):
+        in_data = {"name": "Async Peak", "height": 1234, "latitude": 45.0, "longitude": 6.0}
+        resp = async_client.post("/peaks", json=in_data)
+        assert resp.status_code == 200, resp.text
+        peak_id = resp.json()["pid"]
+        assert async_client.post("/peaks", json=in_data).status_code == 400
+        resp = async_client.get(f"/peaks/{peak_id}")
+        assert resp.status_code == 200, resp.text
+        assert resp.json() == {"pid": peak_id, **in_data}
+        resp = async_client.put(f"/peaks/{peak_id}", json={"height": 2000})
+        assert resp.status_code == 200, resp.text
+        assert resp.json()["height"] == 2000
+        bbox = {"latitude_min": 40, "latitude_max": 50, "longitude_min": 0, "longitude_max": 10}
+        assert [p["pid"] for p in async_client.post("/get_peaks_inside_bbox", json=bbox).json()] == [peak_id]
+        resp = async_client.post("/get_peaks_from_attr", json={"name": "Async Peak"})
+        assert resp.status_code == 200, resp.text
+        resp = async_client.post("/get_nearest_peaks?k=1", json={"latitude": 45.0, "longitude": 6.1})
+        assert resp.json()[0]["pid"] == peak_id
+        assert len(async_client.get("/peaks", params={"limit": 1}).json()) == 1
+        resp = async_client.post("/peaks/batch", json={"pids": [peak_id, peak_id + 1]})
+        assert resp.json()["missing"] == [peak_id + 1]
+        resp = async_client.post("/get_peaks_from_attrs", json=[{"name": "Async Peak"}, {"height": 10}])
+        assert [len(item["peaks"]) for item in resp.json()] == [1, 0]
+        resp = async_client.post("/get_peaks_clusters?zoom=3", json=bbox)
+        assert [c["count"] for c in resp.json()] == [1]
+        assert [p["pid"] for p in async_client.get("/peaks/search", params={"q": "async"}).json()] == [peak_id]
+        resp = async_client.get("/peaks/changes", params={"since": 0})
+        assert [p["pid"] for p in resp.json()["upserted"]] == [peak_id]
+        resp = async_client.get("/peaks/height_range", params={"height_min": 2000, "height_max": 2000})
+        assert [p["pid"] for p in resp.json()] == [peak_id]
+        assert [p["pid"] for p in async_client.post("/get_tallest_peaks?n=1", json=bbox).json()] == [peak_id]
+        resp = async_client.post("/get_peaks_inside_bboxes", json=[bbox])
+        assert [p["pid"] for p in resp.json()[0]["peaks"]] == [peak_id]
+        resp = async_client.put("/peaks/bulk", json=[{"pid": peak_id, "height": 2100}])
+        assert resp.json()["peaks"][0]["height"] == 2100
+        resp = async_client.delete(f"/peaks/{peak_id}")
+        assert resp.status_code == 200, resp.text
+        assert async_client.get(f"/peaks/{peak_id}").status_code == 404
+        assert async_client.delete(f"/peaks/{peak_id}").status_code == 404
+        resp = async_client.request("DELETE", "/peaks/bulk", json={"pids": [peak_id]})
+        assert resp.json()["errors"] == [{"pid": peak_id, "error": "no peak found with this id"}]
+
+    def test_etag_and_response_cache(self, async_client):
+        in_data = {"name": "Tagged Peak", "height": 1500, "latitude": 45.0, "longitude": 6.0}
+        peak_id = async_client.post("/peaks", json=in_data).json()["pid"]
+        area = {"bboxes": [{"latitude_min": 40, "latitude_max": 50, "longitude_min": 0, "longitude_max": 10}]}
+        requests = [
+            ("GET", "/peaks/search", {"params": {"q": "tagged"}}),
+            ("GET", "/peaks/changes", {"params": {"since": 0}}),
+            ("GET", "/peaks/height_range", {"params": {"height_min": 1000, "height_max": 2000}}),
+            ("POST", "/get_peaks_inside_area", {"json": area}),
+            ("POST", "/get_tallest_peaks", {"json": area["bboxes"][0]}),
+        ]
+        # same ETag and 304 as the sync routes
+        for method, url, kwargs in requests:
+            resp = async_client.request(method, url, **kwargs)
+            assert resp.status_code == 200 and resp.json(), resp.text
+            resp_304 = async_client.request(method, url, headers={"If-None-Match": resp.headers["ETag"]}, **kwargs)
+            assert resp_304.status_code == 304
+        set_response_cache(LocalResponseCache())
+        try:
+            assert async_client.get(f"/peaks/{peak_id}").json()["height"] == 1500
+            assert any(key.endswith(f"peak:{peak_id}") for key in get_response_cache()._entries)
+            # a write is never hidden by the cache
+            async_client.put(f"/peaks/{peak_id}", json={"height": 1600})
+            assert async_client.get(f"/peaks/{peak_id}").json()["height"] == 1600
+        finally:
+            set_response_cache(None)
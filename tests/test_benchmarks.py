@@ -0,0 +1,28 @@
+"""
+Smoke tests of the benchmark suite, so that it keeps running with the app
+"""
+import json
+
+from benchmarks import run
+from benchmarks.dataset import generate_peaks
+
+
+def test_dataset_reproducible_and_valid():
+    peaks = list(generate_peaks(2000, seed=1))
+    assert peaks == list(generate_peaks(2000, seed=1))
+    assert len({p["name"] for p in peaks}) == 2000
+    assert all(len(p["name"]) <= 30 for p in peaks)
+    assert all(-90 <= p["latitude"] <= 90 and -180 <= p["longitude"] <= 180 for p in peaks)
+    assert all(p["height"] > 0 for p in peaks)
+
+
+def test_run_writes_results(tmp_path):
+    output = tmp_path / "bench.json"
+    assert run.main(["--sizes", "300", "--repeat", "3", "--output", str(output)]) == 0
+    results = json.loads(output.read_text())
+    (size_run,) = results["runs"]
+    assert size_run["size"] == 300
+    assert {"find_peaks_into_bbox_alps", "add_a_peak", "delete_a_peak"} <= set(size_run["crud_ops"])
+    assert {"GET /peaks", "POST /get_peaks_inside_bbox"} <= set(size_run["routes"])
+    for case in size_run["routes"].values():
+        assert case["p50_ms"] <= case["p95_ms"] <= case["p99_ms"]
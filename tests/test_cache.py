@@ -0,0 +1,85 @@
+"""
+Tests of the response cache and of its keys normalization
+"""
+import random
+
+from mountain_peaks.backend.app import cache
+from mountain_peaks.backend.app.cache import LocalResponseCache, snap_bbox, bbox_key, attr_key, read_through
+from mountain_peaks.backend.app.schemas import BBox, PeakAttr
+
+
+class TestLocalResponseCache:
+
+    def test_lru_eviction(self):
+        local_cache = LocalResponseCache(max_entries=2)
+        local_cache.set("a", b"1")
+        local_cache.set("b", b"2")
+        assert local_cache.get("a") == b"1"  # "a" is now the most recently used
+        local_cache.set("c", b"3")
+        assert local_cache.get("b") is None
+        assert local_cache.get("a") == b"1"
+        assert local_cache.get("c") == b"3"
+
+    def test_ttl(self, monkeypatch):
+        local_cache = LocalResponseCache(ttl=10)
+        now = [100.0]
+        monkeypatch.setattr(cache, "monotonic", lambda: now[0])
+        local_cache.set("a", b"1")
+        now[0] = 105.0
+        assert local_cache.get("a") == b"1"
+        now[0] = 111.0
+        assert local_cache.get("a") is None
+
+    def test_read_through_versioned(self):
+        calls = []
+
+        def produce():
+            calls.append(1)
+            return b"[]"
+
+        cache.set_response_cache(LocalResponseCache())
+        try:
+            assert read_through("k", produce) == b"[]"
+            assert read_through("k", produce) == b"[]"
+            assert len(calls) == 1
+            cache.bump_data_version()
+            read_through("k", produce)
+            assert len(calls) == 2
+        finally:
+            cache.set_response_cache(None)
+        # without cache, always produced
+        read_through("k", produce)
+        assert len(calls) == 3
+
+
+class TestKeys:
+
+    def test_snapped_bbox_contains_the_bbox(self):
+        rnd = random.Random(3)
+        for _ in range(1000):
+            lat_min, lat_max = sorted(rnd.uniform(-89.9, 89.9) for _ in range(2))
+            lon_min, lon_max = sorted(rnd.uniform(-179.9, 179.9) for _ in range(2))
+            bbox = BBox(latitude_min=lat_min, latitude_max=lat_max, longitude_min=lon_min, longitude_max=lon_max)
+            snapped = snap_bbox(bbox)
+            assert snapped.latitude_min <= lat_min and lat_max <= snapped.latitude_max
+            assert snapped.longitude_min <= lon_min and lon_max <= snapped.longitude_max
+
+    def test_snapped_wrapped_bbox_contains_the_bbox(self):
+        rnd = random.Random(4)
+        for _ in range(1000):
+            lon_max, lon_min = sorted(rnd.uniform(-179.9, 179.9) for _ in range(2))
+            bbox = BBox(latitude_min=-10, latitude_max=10, longitude_min=lon_min, longitude_max=lon_max)
+            snapped = snap_bbox(bbox)
+            for lon in (lon_min, 179.95, 180.0, -180.0, -179.95, lon_max):
+                assert snapped.contains(0.0, lon)
+        # both parts grown until they meet
+        assert snap_bbox(BBox(latitude_min=0, latitude_max=1, longitude_min=10.05, longitude_max=10.02)).parts() == \
+            [(0.0, 1.0, -180.0, 180.0)]
+
+    def test_keys(self):
+        bbox_1 = BBox(latitude_min=45.01, latitude_max=45.88, longitude_min=6.02, longitude_max=6.93)
+        bbox_2 = BBox(latitude_min=45.03, latitude_max=45.81, longitude_min=6.05, longitude_max=6.99)
+        assert bbox_key(bbox_1) == bbox_key(bbox_2)
+        assert attr_key(PeakAttr(name="Mont Blanc")) != attr_key(PeakAttr(height=4808))
+        wrapped = BBox(latitude_min=45.01, latitude_max=45.88, longitude_min=6.93, longitude_max=6.02)
+        assert bbox_key(wrapped) != bbox_key(bbox_1)
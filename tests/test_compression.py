@@ -0,0 +1,115 @@
+"""
+Tests of the content negotiation, of the compressed read responses and of their cached variants
+"""
+import zlib
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.main import app
+from mountain_peaks.backend.db.create import Base, get_db, get_session
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.app import cache
+from mountain_peaks.backend.app.cache import LocalResponseCache, set_response_cache
+from mountain_peaks.backend.app.compression import CompressionSettings, StreamCompressor, set_compression
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def client():
+    Base.create_all_tables(engine=test_engine)
+    with get_session(engine=test_engine)() as db:
+        db.add_all(
+            DBPeak(pid=pid, name=f"Compressed Peak {pid}", height=1000 + pid, latitude=pid / 10, longitude=-pid / 10)
+            for pid in range(1, 201)
+        )
+        db.commit()
+
+    def override_get_db():
+        db = get_session(engine=test_engine)()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    set_compression(CompressionSettings(min_size=512, encodings=("gzip",)))
+    yield TestClient(app)
+    set_compression(None)
+    set_response_cache(None)
+    if previous_override is not None:
+        app.dependency_overrides[get_db] = previous_override
+    else:
+        del app.dependency_overrides[get_db]
+    Base.metadata.drop_all(bind=test_engine)
+
+
+def test_negotiation():
+    settings = CompressionSettings(encodings=("zstd", "br", "gzip"))
+    assert settings.negotiate(None) is None
+    assert settings.negotiate("identity") is None
+    assert settings.negotiate("gzip, deflate") == "gzip"
+    assert settings.negotiate("gzip, br, zstd") == "zstd"
+    assert settings.negotiate("gzip;q=1.0, br;q=0.5, zstd;q=0") == "gzip"
+    assert settings.negotiate("*;q=0.1, gzip;q=0") == "zstd"
+    assert settings.negotiate("BR;q=0.8, gzip;q=bad") == "br"
+    assert CompressionSettings(encodings=("gzip",)).negotiate("br, zstd") is None
+
+
+def test_stream_compressor_flushes_each_chunk():
+    compressor = StreamCompressor("gzip")
+    decompressor = zlib.decompressobj(wbits=31)
+    for chunk in (b'{"pid":1}\n' * 50, b'{"pid":2}\n', b""):
+        # each compressed chunk is decoded at once by the client, without waiting for the end
+        assert decompressor.decompress(compressor.compress(chunk)) == chunk
+    decompressor.decompress(compressor.finish())
+    assert decompressor.eof
+
+
+def test_compressed_read_responses(client):
+    resp = client.get("/peaks", headers={"Accept-Encoding": "identity"})
+    identity_body, identity_etag = resp.content, resp.headers["ETag"]
+    assert "content-encoding" not in resp.headers and resp.headers["Vary"] == "Accept-Encoding"
+    resp = client.get("/peaks", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    # httpx decodes the body, the raw one is much smaller
+    assert resp.content == identity_body and int(resp.headers["Content-Length"]) < len(identity_body) / 3
+    assert resp.headers["ETag"] == identity_etag[:-1] + '-gzip"'
+    # an ETag of any encoding of the body revalidates it
+    for etag in (identity_etag, resp.headers["ETag"]):
+        resp = client.get("/peaks", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        assert resp.status_code == 304 and resp.headers["ETag"].endswith('-gzip"')
+    # small bodies are sent as is
+    resp = client.get("/peaks/1", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in resp.headers and resp.json()["name"] == "Compressed Peak 1"
+
+
+def test_cached_bodies_compressed_once(client, monkeypatch):
+    set_response_cache(LocalResponseCache())
+    calls = []
+    compress = cache.compress
+    monkeypatch.setattr(cache, "compress", lambda body, encoding: calls.append(encoding) or compress(body, encoding))
+    bbox = {"latitude_min": 0, "latitude_max": 10, "longitude_min": -10, "longitude_max": 0}
+    bodies = [
+        client.post("/get_peaks_inside_bbox", json=bbox, headers={"Accept-Encoding": "gzip"}) for _ in range(3)
+    ] + [client.get("/peaks", headers={"Accept-Encoding": "gzip"}) for _ in range(3)]
+    assert all(resp.headers["Content-Encoding"] == "gzip" for resp in bodies)
+    assert [len(resp.json()) for resp in bodies] == [100] * 3 + [200] * 3
+    assert calls == ["gzip", "gzip"]
+
+
+def test_middleware_compresses_the_other_responses(client):
+    resp = client.get("/peaks", params={"limit": 150}, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip" and len(resp.json()) == 150
+    resp = client.get("/peaks/ndjson", params={"chunk_size": 50}, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip" and "content-length" not in resp.headers
+    assert len(resp.text.splitlines()) == 200
+    resp = client.get("/peaks/ndjson", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in resp.headers and len(resp.text.splitlines()) == 200
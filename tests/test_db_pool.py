@@ -0,0 +1,58 @@
+"""
+Tests of the engine pool configuration and of the pool stats
+"""
+from sqlalchemy import create_engine, text
+
+from mountain_peaks.backend.db import config
+from mountain_peaks.backend.db.create import _create_pooled_engine, _statement_timeout_args, get_session
+from mountain_peaks.backend.db.pool import TimedQueuePool
+
+
+def test_pool_settings_from_env(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "YES")
+    monkeypatch.setenv("DB_POOL_RECYCLE", "1800")
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "5000")
+    settings = config.get_pool_settings()
+    assert settings["pool_size"] == 20
+    assert settings["max_overflow"] == 0
+    assert settings["pool_pre_ping"] is True
+    assert settings["pool_recycle"] == 1800
+    assert config.get_statement_timeout_ms() == 5000
+
+
+def test_statement_timeout_by_driver(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "5000")
+    assert _statement_timeout_args("postgresql://u@host/peaks") == {"options": "-c statement_timeout=5000"}
+    assert _statement_timeout_args("postgresql+psycopg2://u@host/peaks") == {"options": "-c statement_timeout=5000"}
+    assert _statement_timeout_args("postgresql+asyncpg://u@host/peaks") == {
+        "server_settings": {"statement_timeout": "5000"}
+    }
+    # the other drivers would refuse the unknown connect arguments
+    assert _statement_timeout_args("sqlite+aiosqlite:///peaks.db") == {}
+    with _create_pooled_engine(f"sqlite:///{tmp_path / 'peaks.db'}").connect() as conn:
+        assert conn.execute(text("SELECT 1")).scalar() == 1
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "0")
+    assert _statement_timeout_args("postgresql://u@host/peaks") == {}
+
+
+def test_session_factory_reused(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'peaks.db'}")
+    assert get_session(engine=engine) is get_session(engine=engine)
+    assert get_session(engine=engine).kw["bind"] is engine
+
+
+def test_timed_pool_stats(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'peaks.db'}", poolclass=TimedQueuePool, pool_size=2, max_overflow=1)
+    with engine.connect() as conn_1, engine.connect() as conn_2, engine.connect() as conn_3:
+        for conn in (conn_1, conn_2, conn_3):
+            conn.execute(text("SELECT 1"))
+        stats = engine.pool.stats()
+        assert stats["checked_out"] == 3
+        assert stats["overflow"] == 1
+    stats = engine.pool.stats()
+    assert stats["checked_out"] == 0
+    assert stats["checkouts"] == 3
+    assert stats["wait_time_max_ms"] >= 0
+    engine.dispose()
@@ -0,0 +1,108 @@
+"""
+Tests of the grid pyramid, standalone and plugged to the crud operations
+"""
+import random
+
+import pytest
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.db.create import Base, get_session
+from mountain_peaks.backend.app.crud_ops import add_a_peak, update_a_peak, delete_a_peak, find_peak_clusters
+from mountain_peaks.backend.app.schemas import PeakCreate, PeakUpdate, BBox
+from mountain_peaks.backend.app.grid_pyramid import (
+    GridPyramid,
+    build_grid_pyramid,
+    cell_of,
+    cell_size,
+    get_grid_pyramid,
+    set_grid_pyramid,
+    zoom_for_cell_size,
+)
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def t_session():
+    Base.create_all_tables(engine=test_engine)
+    db_session = get_session(engine=test_engine)()
+    yield db_session
+    db_session.close()
+    set_grid_pyramid(None)
+    Base.metadata.drop_all(bind=test_engine)
+
+
+def _brute_force(peaks, zoom, bounds):
+    # (i, j) -> (count, highest pid) of the cells overlapping the bounds
+    i_min, j_min = cell_of(zoom, bounds[0], bounds[2])
+    i_max, j_max = cell_of(zoom, bounds[1], bounds[3])
+    cells = {}
+    for pid, _, height, latitude, longitude in peaks.values():
+        i, j = cell_of(zoom, latitude, longitude)
+        if i_min <= i <= i_max and j_min <= j <= j_max:
+            count, best = cells.get((i, j), (0, None))
+            if best is None or (height, -pid) > (peaks[best][2], -best):
+                best = pid
+            cells[(i, j)] = (count + 1, best)
+    return cells
+
+
+class TestGridPyramid:
+
+    def test_clusters_match_brute_force_after_updates(self):
+        rnd = random.Random(1)
+        peaks = {
+            pid: (pid, f"p{pid}", rnd.randint(100, 300), rnd.uniform(40, 50), rnd.uniform(0, 10))
+            for pid in range(1, 2001)
+        }
+        pyramid = GridPyramid(max_zoom=8).load(peaks.values())
+        for pid in rnd.sample(sorted(peaks), 500):
+            if rnd.random() < 0.5:
+                pyramid.remove(pid)
+                del peaks[pid]
+            else:
+                peaks[pid] = (pid, f"p{pid}", rnd.randint(100, 300), rnd.uniform(40, 50), rnd.uniform(0, 10))
+                pyramid.upsert(*peaks[pid])
+        assert len(pyramid) == len(peaks)
+        for zoom in (0, 3, 6, 8):
+            bounds = (42.0, 47.5, 1.0, 8.0)
+            clusters = pyramid.clusters(zoom, *bounds)
+            assert {(c.i, c.j): (c.count, c.highest[0]) for c in clusters} == _brute_force(peaks, zoom, bounds)
+        assert sum(c.count for c in pyramid.clusters(0, -90, 90, -180, 180)) == len(peaks)
+
+    def test_cells(self):
+        assert cell_size(0) == 180.0
+        assert cell_of(0, 90.0, 180.0) == (0, 1)
+        assert cell_of(2, -90.0, -180.0) == (0, 0)
+        assert zoom_for_cell_size(180.0) == 0
+        assert zoom_for_cell_size(1.0) == 8
+        assert cell_size(zoom_for_cell_size(1.0)) <= 1.0
+        cluster = GridPyramid(max_zoom=1).load([(1, "a", 10, 10.0, 10.0)]).clusters(1, 0, 20, 0, 20)[0]
+        assert cluster.bounds == (0.0, 90.0, 0.0, 90.0)
+        assert cluster.centroid == (10.0, 10.0)
+        with pytest.raises(ValueError):
+            GridPyramid(max_zoom=13)
+
+    def test_pyramid_in_sync_with_crud_ops(self, t_session):
+        peak_1 = add_a_peak(session=t_session,
+                            peak=PeakCreate(name="Mont Blanc", height=4808, latitude=45.83, longitude=6.86))
+        alps = BBox(latitude_min=45, latitude_max=46, longitude_min=6, longitude_max=7)
+        # without a pyramid, the clusters are aggregated from the rows of the cells
+        on_the_fly = find_peak_clusters(session=t_session, bbox=alps, zoom=4)
+        set_grid_pyramid(build_grid_pyramid(session=t_session))
+        assert [(c.i, c.j, c.count) for c in find_peak_clusters(session=t_session, bbox=alps, zoom=4)] == \
+            [(c.i, c.j, c.count) for c in on_the_fly]
+        peak_2 = add_a_peak(session=t_session,
+                            peak=PeakCreate(name="Dom", height=4545, latitude=46.09, longitude=7.86))
+        [cluster] = find_peak_clusters(session=t_session, bbox=alps, zoom=2)
+        assert cluster.count == 2 and cluster.highest[1] == "Mont Blanc"
+        update_a_peak(session=t_session, peak_id=peak_2.pid, peak_data=PeakUpdate(height=4900))
+        assert find_peak_clusters(session=t_session, bbox=alps, zoom=2)[0].highest[1] == "Dom"
+        delete_a_peak(session=t_session, peak_id=peak_2.pid)
+        [cluster] = find_peak_clusters(session=t_session, bbox=alps, zoom=2)
+        assert (cluster.count, cluster.highest[0]) == (1, peak_1.pid)
+        assert peak_2.pid not in get_grid_pyramid()
@@ -0,0 +1,106 @@
+"""
+Tests of the in-memory heights index, standalone and plugged to the crud operations
+"""
+import random
+
+import pytest
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.db.create import Base, get_session
+from mountain_peaks.backend.app import height_index
+from mountain_peaks.backend.app.crud_ops import (
+    add_a_peak,
+    update_a_peak,
+    delete_a_peak,
+    find_peaks_by_height_range,
+    find_tallest_peaks,
+)
+from mountain_peaks.backend.app.schemas import BBox, PeakCreate, PeakUpdate
+from mountain_peaks.backend.app.spatial_index import build_peak_index, set_peak_index
+from mountain_peaks.backend.app.height_index import (
+    PeakHeightIndex,
+    build_height_index,
+    get_height_index,
+    set_height_index,
+)
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def t_session():
+    Base.create_all_tables(engine=test_engine)
+    db_session = get_session(engine=test_engine)()
+    yield db_session
+    db_session.close()
+    set_height_index(None)
+    set_peak_index(None)
+    Base.metadata.drop_all(bind=test_engine)
+
+
+class TestPeakHeightIndex:
+
+    def test_queries_match_brute_force_after_updates(self, monkeypatch):
+        rnd = random.Random(3)
+        peaks = {pid: (rnd.randint(1, 100), rnd.uniform(-10, 10), rnd.uniform(-10, 10)) for pid in range(1, 2001)}
+        index = PeakHeightIndex().load((pid, *peak) for pid, peak in peaks.items())
+        for pid in rnd.sample(sorted(peaks), 500):
+            if rnd.random() < 0.5:
+                index.remove(pid)
+                del peaks[pid]
+            else:
+                peaks[pid] = (rnd.randint(1, 100), rnd.uniform(-10, 10), rnd.uniform(-10, 10))
+                index.upsert(pid, *peaks[pid])
+        assert len(index) == len(peaks)
+        ascending = sorted(peaks, key=lambda pid: (peaks[pid][0], pid))
+        for height_min, height_max in ((1, 100), (20, 20), (30, 60), (101, 200)):
+            expected = [pid for pid in ascending if height_min <= peaks[pid][0] <= height_max]
+            assert index.height_range(height_min, height_max, limit=50) == expected[:50]
+            assert index.height_range(height_min, height_max, limit=50, descending=True) == expected[::-1][:50]
+        assert index.tallest(10) == ascending[::-1][:10]
+        boxes = [(0.0, 5.0, 0.0, 5.0), (-10.0, -8.0, -10.0, 10.0)]
+        expected = [
+            pid for pid in ascending[::-1]
+            if any(a <= peaks[pid][1] <= b and c <= peaks[pid][2] <= d for a, b, c, d in boxes)
+        ]
+        assert index.tallest(15, boxes=boxes) == expected[:15]
+        # filtered by chunks, across their bounds, until the whole array is walked
+        monkeypatch.setattr(height_index, "_TALLEST_CHUNK", 7)
+        assert index.tallest(15, boxes=boxes) == expected[:15]
+        assert index.tallest(len(peaks), boxes=boxes) == expected
+
+
+class TestHeightIndexOperations:
+
+    def test_crud_operations_keep_the_index_in_sync(self, t_session):
+        peaks = [
+            add_a_peak(session=t_session, peak=PeakCreate(name=f"P{i}", height=1000 + i, latitude=float(i),
+                                                         longitude=float(i)))
+            for i in range(10)
+        ]
+        bbox = BBox(latitude_min=2.0, latitude_max=6.0, longitude_min=2.0, longitude_max=6.0)
+        without_index = (
+            [p.pid for p in find_peaks_by_height_range(session=t_session, height_min=1002, height_max=1008, limit=4)],
+            [p.pid for p in find_tallest_peaks(session=t_session, n=3, bbox=bbox)],
+        )
+        set_height_index(build_height_index(session=t_session))
+        with_index = (
+            [p.pid for p in find_peaks_by_height_range(session=t_session, height_min=1002, height_max=1008, limit=4)],
+            [p.pid for p in find_tallest_peaks(session=t_session, n=3, bbox=bbox)],
+        )
+        assert with_index == without_index == ([p.pid for p in peaks[2:6]], [peaks[6].pid, peaks[5].pid, peaks[4].pid])
+        # the bbox candidates given by the spatial index
+        set_peak_index(build_peak_index(session=t_session))
+        assert [p.pid for p in find_tallest_peaks(session=t_session, n=3, bbox=bbox)] == with_index[1]
+        update_a_peak(session=t_session, peak_id=peaks[0].pid, peak_data=PeakUpdate(height=5000))
+        delete_a_peak(session=t_session, peak_id=peaks[9].pid)
+        assert peaks[9].pid not in get_height_index()
+        assert [p.pid for p in find_tallest_peaks(session=t_session, n=2)] == [peaks[0].pid, peaks[8].pid]
+        assert [
+            p.pid for p in find_peaks_by_height_range(session=t_session, height_min=1, height_max=10_000, limit=2,
+                                                      descending=True)
+        ] == [peaks[0].pid, peaks[8].pid]
@@ -0,0 +1,168 @@
+"""
+Tests of the Hilbert keys of the positions, of their migration and of the db bbox searches using them
+"""
+import random
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, text
+
+from mountain_peaks.backend.db.create import Base, get_session
+from mountain_peaks.backend.db.hilbert import (
+    HILBERT_ORDER,
+    hilbert_boxes_ranges,
+    hilbert_key,
+    hilbert_keys,
+    hilbert_ranges,
+    key_to_xy,
+)
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.app.crud_ops import (
+    add_a_peak,
+    add_peaks,
+    find_peaks_into_bbox,
+    find_peaks_into_bboxes,
+    update_a_peak,
+    update_peaks,
+)
+from mountain_peaks.backend.app.schemas import BBox, PeakBulkUpdate, PeakCreate, PeakUpdate
+
+BBOXES = [
+    BBox(latitude_min=-10, latitude_max=30, longitude_min=-50.5, longitude_max=20),
+    BBox(latitude_min=-80, latitude_max=80, longitude_min=6, longitude_max=6.5),
+    BBox(latitude_min=-90, latitude_max=90, longitude_min=170, longitude_max=-170),
+    BBox(latitude_min=89, latitude_max=90, longitude_min=179, longitude_max=180),
+    BBox(latitude_min=0, latitude_max=0.001, longitude_min=0, longitude_max=0.001),
+]
+
+
+def _in_ranges(keys: np.ndarray, ranges) -> np.ndarray:
+    starts = np.array([key_min for key_min, _ in ranges])
+    ends = np.array([key_max for _, key_max in ranges])
+    i = np.searchsorted(starts, keys, side="right") - 1
+    return (i >= 0) & (keys <= ends[np.maximum(i, 0)])
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'peaks.db'}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def t_session(engine):
+    Base.create_all_tables(engine=engine)
+    rnd = random.Random(5)
+    db_session = get_session(engine=engine)()
+    add_peaks(session=db_session, peaks=[
+        PeakCreate(name=f"Peak {i}", height=rnd.randint(1, 8000),
+                   latitude=rnd.uniform(-90, 90), longitude=rnd.uniform(-180, 180))
+        for i in range(2000)
+    ])
+    yield db_session
+    db_session.close()
+
+
+class TestHilbertKeys:
+
+    def test_keys_are_a_curve(self):
+        # each cell has its own key, consecutive keys are neighbour cells
+        order = 4
+        cells = {key_to_xy(key, order) for key in range(4 ** order)}
+        assert len(cells) == 4 ** order
+        for key in range(4 ** order - 1):
+            (x1, y1), (x2, y2) = key_to_xy(key, order), key_to_xy(key + 1, order)
+            assert abs(x1 - x2) + abs(y1 - y2) == 1
+        # the key of a cell at a coarser level is the prefix of the keys of its sub-cells
+        rnd = random.Random(1)
+        for _ in range(200):
+            latitude, longitude = rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+            key = hilbert_key(latitude, longitude)
+            assert hilbert_key(latitude, longitude, order=8) == key >> (2 * (HILBERT_ORDER - 8))
+        assert 0 <= hilbert_key(-90, -180) and hilbert_key(90, 180) < 4 ** HILBERT_ORDER
+
+    def test_ranges_cover_the_bboxes(self):
+        rnd = random.Random(2)
+        for bbox in BBOXES:
+            for max_ranges in (4, 32, 128):
+                ranges = hilbert_boxes_ranges(bbox.parts(), max_ranges=max_ranges * len(bbox.parts()))
+                assert all(key_max < next_min for (_, key_max), (next_min, _) in zip(ranges, ranges[1:]))
+                for lat_min, lat_max, lon_min, lon_max in bbox.parts():
+                    assert len(hilbert_ranges(lat_min, lat_max, lon_min, lon_max, max_ranges=max_ranges)) <= max_ranges
+                    latitudes = [rnd.uniform(lat_min, lat_max) for _ in range(500)] + [lat_min, lat_max]
+                    longitudes = [rnd.uniform(lon_min, lon_max) for _ in range(500)] + [lon_min, lon_max]
+                    assert _in_ranges(hilbert_keys(latitudes, longitudes), ranges).all()
+        # more ranges, fewer false candidates
+        rnd_latitudes = np.array([rnd.uniform(-90, 90) for _ in range(20000)])
+        rnd_longitudes = np.array([rnd.uniform(-180, 180) for _ in range(20000)])
+        keys = hilbert_keys(rnd_latitudes, rnd_longitudes)
+        candidates = [_in_ranges(keys, hilbert_ranges(-80, 80, 6, 6.5, max_ranges=n)).sum() for n in (4, 32, 128)]
+        assert candidates[0] > candidates[1] > candidates[2]
+
+
+class TestDbBboxSearch:
+
+    def test_keys_written_by_the_crud_operations(self, t_session):
+        added = add_a_peak(session=t_session, peak=PeakCreate(name="Added", height=10, latitude=45.5, longitude=6.5))
+        update_a_peak(session=t_session, peak_id=1, peak_data=PeakUpdate(longitude=-3.25))
+        update_peaks(session=t_session, updates=[PeakBulkUpdate(pid=2, latitude=12.5), PeakBulkUpdate(pid=3, height=5)])
+        t_session.add(DBPeak(name="Added by the ORM", height=10, latitude=-45.5, longitude=-6.5))
+        t_session.commit()
+        t_session.expire_all()
+        for peak in t_session.query(DBPeak):
+            assert peak.hkey == hilbert_key(peak.latitude, peak.longitude), peak.pid
+        assert t_session.get(DBPeak, added.pid).hkey == hilbert_key(45.5, 6.5)
+
+    def test_results_match_the_exact_filter(self, t_session):
+        positions = [(p.pid, p.latitude, p.longitude) for p in t_session.query(DBPeak).order_by(DBPeak.pid)]
+        for bbox in BBOXES:
+            expected = [pid for pid, latitude, longitude in positions if bbox.contains(latitude, longitude)]
+            assert sorted(p.pid for p in find_peaks_into_bbox(session=t_session, bbox=bbox, as_rows=True)) == expected
+        found = find_peaks_into_bboxes(session=t_session, bboxes=BBOXES[:2], as_rows=True)
+        assert [len(peaks) for peaks in found] == [
+            sum(bbox.contains(latitude, longitude) for _, latitude, longitude in positions) for bbox in BBOXES[:2]
+        ]
+
+    def test_sqlite_rtree(self, engine, monkeypatch):
+        monkeypatch.setenv("PEAKS_SQLITE_RTREE", "YES")
+        Base.create_all_tables(engine=engine)
+        db_session = get_session(engine=engine)()
+        rnd = random.Random(6)
+        add_peaks(session=db_session, peaks=[
+            PeakCreate(name=f"Peak {i}", height=100, latitude=rnd.uniform(-90, 90), longitude=rnd.uniform(-180, 180))
+            for i in range(500)
+        ])
+        update_a_peak(session=db_session, peak_id=1, peak_data=PeakUpdate(latitude=0.0005, longitude=0.0005))
+        db_session.query(DBPeak).filter(DBPeak.pid == 2).delete()
+        db_session.commit()
+        assert db_session.execute(text("SELECT count(*) FROM peaks_rtree")).scalar() == 499
+        positions = [(p.pid, p.latitude, p.longitude) for p in db_session.query(DBPeak)]
+        for bbox in BBOXES:
+            expected = sorted(pid for pid, latitude, longitude in positions if bbox.contains(latitude, longitude))
+            found = find_peaks_into_bbox(session=db_session, bbox=bbox, as_rows=True)
+            assert sorted(p.pid for p in found) == expected
+        assert [p.pid for p in find_peaks_into_bbox(session=db_session, bbox=BBOXES[-1])] == [1]
+        db_session.close()
+
+
+def test_migration_backfills_the_keys(engine):
+    # a peaks table created by a version of the app without the revisions nor the keys
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE peaks (pid INTEGER PRIMARY KEY, name VARCHAR(30), height INTEGER, "
+            "latitude FLOAT, longitude FLOAT)"
+        ))
+        connection.execute(
+            text("INSERT INTO peaks (name, height, latitude, longitude) VALUES (:name, 100, :latitude, :longitude)"),
+            [{"name": f"Old {i}", "latitude": i / 10, "longitude": -i / 5} for i in range(25)],
+        )
+    Base.create_all_tables(engine=engine)
+    Base.create_all_tables(engine=engine)
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT latitude, longitude, hkey, revision FROM peaks")).all()
+        indexes = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars().all()
+    assert len(rows) == 25
+    for latitude, longitude, hkey, revision in rows:
+        assert hkey == hilbert_key(latitude, longitude) and revision == 1
+    assert "ix_peaks_hkey" in indexes
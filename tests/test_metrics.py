@@ -0,0 +1,61 @@
+"""
+Tests of the metrics middleware and of the SQL instrumentation
+"""
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text, StaticPool
+
+from mountain_peaks.backend.app.metrics import MetricsMiddleware, MetricsRegistry, RequestStats, count_queries
+
+engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+metrics_app = FastAPI()
+metrics_app.add_middleware(MetricsMiddleware, debug_headers=True)
+
+
+@metrics_app.get("/two_queries/{value}")
+def two_queries(value: int):
+    # sync route, run in the threadpool
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        return conn.execute(text("SELECT :v"), {"v": value}).scalar_one()
+
+
+@metrics_app.get("/stream")
+def stream():
+    return StreamingResponse(iter([b"ab", b"cd"]))
+
+
+def test_debug_headers_and_route_template():
+    client = TestClient(metrics_app)
+    resp = client.get("/two_queries/3")
+    assert resp.json() == 3
+    assert resp.headers["x-db-query-count"] == "2"
+    assert float(resp.headers["x-db-time-ms"]) >= 0
+    assert client.get("/stream").content == b"abcd"
+    assert client.get("/not_a_route").status_code == 404
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    stats = RequestStats()
+    stats.queries, stats.db_time = 3, 0.002
+    registry.request_started()
+    registry.request_finished("GET", "/peaks", 200, 0.003, 120, stats)
+    registry.query_executed(0.001)
+    text_format = registry.render()
+    labels = 'method="GET",route="/peaks",status="200"'
+    assert f'peaks_http_request_duration_seconds_bucket{{{labels},le="0.001"}} 0' in text_format
+    assert f'peaks_http_request_duration_seconds_bucket{{{labels},le="0.005"}} 1' in text_format
+    assert f'peaks_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in text_format
+    assert f"peaks_http_response_size_bytes_sum{{{labels}}} 120" in text_format
+    assert f"peaks_http_request_db_queries_sum{{{labels}}} 3" in text_format
+    assert "peaks_http_requests_in_flight 0" in text_format
+    assert "peaks_db_queries_total 1" in text_format
+
+
+def test_count_queries():
+    with count_queries() as counter:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    assert counter.count == 1
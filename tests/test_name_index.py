@@ -0,0 +1,100 @@
+"""
+Tests of the in-memory names index, standalone and plugged to the crud operations
+"""
+import random
+import string
+
+import pytest
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.db.create import Base, get_session
+from mountain_peaks.backend.app.crud_ops import add_a_peak, update_a_peak, delete_a_peak, search_peaks_by_name
+from mountain_peaks.backend.app.schemas import PeakCreate, PeakUpdate
+from mountain_peaks.backend.app.name_index import (
+    PeakNameIndex,
+    build_name_index,
+    get_name_index,
+    normalize_name,
+    set_name_index,
+    similarity,
+    trigrams,
+)
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def t_session():
+    Base.create_all_tables(engine=test_engine)
+    db_session = get_session(engine=test_engine)()
+    yield db_session
+    db_session.close()
+    set_name_index(None)
+    Base.metadata.drop_all(bind=test_engine)
+
+
+class TestPeakNameIndex:
+
+    def test_complete_matches_brute_force_after_updates(self):
+        rnd = random.Random(2)
+        peaks = {
+            pid: ("".join(rnd.choice("abc ") for _ in range(rnd.randint(1, 6))).strip() or "a", rnd.randint(1, 50))
+            for pid in range(1, 1001)
+        }
+        index = PeakNameIndex(top_k=5).load((pid, name, height) for pid, (name, height) in peaks.items())
+        for pid in rnd.sample(sorted(peaks), 300):
+            if rnd.random() < 0.5:
+                index.remove(pid)
+                del peaks[pid]
+            else:
+                peaks[pid] = (rnd.choice(string.ascii_lowercase[:3]) * rnd.randint(1, 4), rnd.randint(1, 50))
+                index.upsert(pid, *peaks[pid])
+        assert len(index) == len(peaks)
+        for prefix in ("", "a", "b", "ab", "c c", "aaa", "zz"):
+            expected = sorted(
+                (pid for pid, (name, _) in peaks.items() if normalize_name(name).startswith(prefix)),
+                key=lambda pid: (-peaks[pid][1], peaks[pid][0], pid),
+            )[:5]
+            assert index.complete(prefix, 5) == expected
+
+    def test_fuzzy_matches_brute_force(self):
+        names = ["Mont Blanc", "Mont Blanc du Tacul", "Monte Rosa", "Blanc Mont", "Dom", "Mont Maudit", "Matterhorn"]
+        index = PeakNameIndex().load((pid, name, 4000) for pid, name in enumerate(names, start=1))
+        for query in ("mont blnc", "Monte", "Materhorn", "xyz"):
+            expected = {
+                pid for pid, name in enumerate(names, start=1) if similarity(trigrams(query), trigrams(name)) >= 0.3
+            }
+            assert {pid for pid, _ in index.fuzzy(query, 20)} == expected
+        assert index.fuzzy("Materhorn", 1)[0][0] == names.index("Matterhorn") + 1
+
+    def test_normalization_and_search(self):
+        index = PeakNameIndex().load([(1, "Mönch", 4107), (2, "Mont Blanc", 4808), (3, "Montagne Noire", 1210)])
+        assert normalize_name("  MÖNCH  ") == "monch"
+        assert index.search("monc", 10)[0] == 1
+        # prefix matches first, then the fuzzy ones
+        assert index.search("Mont Bl", 10) == [2]
+        assert index.search("Mont", 10)[:2] == [2, 3]
+        assert index.search("Mont Blank", 10) == [2]
+        with pytest.raises(ValueError):
+            PeakNameIndex(top_k=0)
+
+    def test_index_in_sync_with_crud_ops(self, t_session):
+        peak_1 = add_a_peak(session=t_session,
+                            peak=PeakCreate(name="Mont Blanc", height=4808, latitude=45.8, longitude=6.9))
+        peak_2 = add_a_peak(session=t_session,
+                            peak=PeakCreate(name="Mont Maudit", height=4465, latitude=45.8, longitude=6.9))
+        # without the index, prefix matches only
+        assert [p.pid for p in search_peaks_by_name(session=t_session, query="mont", k=10)] == [peak_1.pid, peak_2.pid]
+        assert search_peaks_by_name(session=t_session, query="Mont Blnc", k=10) == []
+        assert search_peaks_by_name(session=t_session, query="Mont%", k=10) == []
+        set_name_index(build_name_index(session=t_session))
+        assert [p.pid for p in search_peaks_by_name(session=t_session, query="Mont Blnc", k=10)][0] == peak_1.pid
+        update_a_peak(session=t_session, peak_id=peak_2.pid, peak_data=PeakUpdate(height=5000))
+        assert [p.pid for p in search_peaks_by_name(session=t_session, query="mont", k=10)] == [peak_2.pid, peak_1.pid]
+        delete_a_peak(session=t_session, peak_id=peak_2.pid)
+        assert peak_2.pid not in get_name_index()
+        assert [p.pid for p in search_peaks_by_name(session=t_session, query="mont", k=10)] == [peak_1.pid]
@@ -0,0 +1,142 @@
+"""
+Tests of the read replicas choice and of the read-your-writes routing of the read sessions
+"""
+from time import monotonic, time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.main import app
+from mountain_peaks.backend.app.cache import LocalResponseCache, set_response_cache
+from mountain_peaks.backend.db import config
+from mountain_peaks.backend.db.create import Base, get_db, get_session, set_replica_set
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.db.pool import TimedQueuePool
+from mountain_peaks.backend.db.replicas import PRIMARY_COOKIE, ReplicaSet
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _memory_engine():
+    return create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+
+def test_replica_settings_from_env(monkeypatch):
+    monkeypatch.setenv("PEAKS_DB_REPLICA_URLS", "postgresql://r1/db, postgresql://r2/db,")
+    monkeypatch.setenv("PEAKS_DB_REPLICA_POLICY", "least_connections")
+    assert config.get_replica_uris() == ["postgresql://r1/db", "postgresql://r2/db"]
+    assert config.get_replica_settings()["policy"] == "least_connections"
+    with pytest.raises(ValueError):
+        ReplicaSet([], policy="random")
+
+
+def test_round_robin_and_ejection():
+    clock = FakeClock()
+    engines = [_memory_engine() for _ in range(3)]
+    replicas = ReplicaSet(engines, eject_seconds=10, clock=clock)
+    assert [replicas.choose() for _ in range(4)] == [engines[0], engines[1], engines[2], engines[0]]
+    replicas.eject(engines[1])
+    assert {replicas.choose() for _ in range(6)} == {engines[0], engines[2]}
+    assert replicas.stats()["replica_1"]["healthy"] is False
+    clock.now = 11
+    assert engines[1] in {replicas.choose() for _ in range(6)}
+    for engine in engines:
+        replicas.eject(engine)
+    assert replicas.choose() is None
+    # the health check readmits the reachable replicas
+    replicas.check_health()
+    assert replicas.healthy() == engines
+
+
+def test_least_connections(tmp_path):
+    engines = [
+        create_engine(f"sqlite:///{tmp_path / f'replica_{i}.db'}", poolclass=TimedQueuePool, pool_size=2)
+        for i in range(2)
+    ]
+    replicas = ReplicaSet(engines, policy="least_connections")
+    with engines[0].connect():
+        assert replicas.choose() is engines[1]
+        with engines[1].connect(), engines[1].connect():
+            assert replicas.choose() is engines[0]
+    for engine in engines:
+        engine.dispose()
+
+
+@pytest.fixture
+def primary_and_replica():
+    # a replica lagging behind the primary: it has none of the peaks
+    primary_engine, replica_engine = _memory_engine(), _memory_engine()
+    for engine in (primary_engine, replica_engine):
+        Base.create_all_tables(engine=engine)
+    with get_session(engine=primary_engine)() as db:
+        db.add(DBPeak(pid=1, name="On the primary", height=1000, latitude=1.0, longitude=1.0))
+        db.commit()
+
+    def override_get_db():
+        db = get_session(engine=primary_engine)()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    set_replica_set(ReplicaSet([replica_engine]))
+    yield primary_engine, replica_engine
+    set_replica_set(None)
+    if previous_override is not None:
+        app.dependency_overrides[get_db] = previous_override
+    else:
+        del app.dependency_overrides[get_db]
+
+
+def test_reads_routed_to_the_replica(primary_and_replica):
+    client = TestClient(app)
+    assert client.get("/peaks").json() == []
+    assert client.post("/get_peaks_from_attr", json={"name": "On the primary"}).status_code == 404
+    # the writes go to the primary, then the reads of the writer too
+    resp = client.post("/peaks", json={"name": "Written", "height": 2000, "latitude": 2.0, "longitude": 2.0})
+    assert resp.status_code == 200, resp.text
+    assert PRIMARY_COOKIE in resp.cookies
+    assert [p["name"] for p in client.get("/peaks").json()] == ["On the primary", "Written"]
+    # the other clients keep reading from the replica
+    assert TestClient(app).get("/peaks").json() == []
+
+
+def test_cached_replica_reads(primary_and_replica):
+    primary_engine, _ = primary_and_replica
+    cache = LocalResponseCache(ttl=300)
+    set_response_cache(cache)
+    try:
+        assert TestClient(app).get("/peaks").json() == []
+        # the result of the replica expires with the replication lag, not with the cache ttl
+        assert all(expires_at <= monotonic() + config.get_read_your_writes_seconds()
+                   for expires_at, _ in cache._entries.values())
+        # a write of another worker: the data version of this worker is not bumped
+        with get_session(engine=primary_engine)() as db:
+            db.add(DBPeak(pid=2, name="Written", height=2000, latitude=2.0, longitude=2.0))
+            db.commit()
+        writer = TestClient(app, cookies={PRIMARY_COOKIE: str(time() + 60)})
+        # the writer skips the cached entry, its write is read from the primary
+        assert [p["name"] for p in writer.get("/peaks").json()] == ["On the primary", "Written"]
+        # and the entry is replaced with the result of the primary
+        assert len(TestClient(app).get("/peaks").json()) == 2
+    finally:
+        set_response_cache(None)
+
+
+def test_unreachable_replica_ejected(primary_and_replica):
+    _, replica_engine = primary_and_replica
+    replica_engine.dispose()
+    set_replica_set(ReplicaSet([create_engine("sqlite:////nonexistent/dir/replica.db")]))
+    client = TestClient(app)
+    # the read falls back on the primary
+    assert [p["pid"] for p in client.get("/peaks").json()] == [1]
+    assert client.get("/pool_stats").json()["replica_0"]["healthy"] is False
@@ -0,0 +1,53 @@
+"""
+Tests of the fast serialization path: it has to stay byte-compatible with FastAPI's rendering
+"""
+from typing import List
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from mountain_peaks.backend.app.responses import (
+    peak_changes_to_json, peak_row_to_json, peak_rows_to_json, peaks_to_json
+)
+from mountain_peaks.backend.app.schemas import Peak, PeakChanges
+
+ROWS = [
+    (1, "Mont Blanc", 4808, 45.832622, 6.865175),
+    (2, 'Pic "du" Midi\\', 2877, 42.936, 0.1411),
+    (3, "Ōtāhuhu ⛰ 山", 1, -0.0, -180.0),
+    (4, "Tiny", 12, 1e-07, 123456789.123456789),
+    (5, "Integer coords", 1000, 60, -5),
+]
+
+reference_app = FastAPI()
+
+
+@reference_app.get("/peaks", response_model=List[Peak])
+def reference_peaks():
+    return [dict(zip(Peak.model_fields, row)) for row in ROWS]
+
+
+@reference_app.get("/peak", response_model=Peak)
+def reference_peak():
+    return dict(zip(Peak.model_fields, ROWS[1]))
+
+
+@reference_app.get("/changes", response_model=PeakChanges)
+def reference_changes():
+    return {"revision": 42, "more": True, "upserted": [dict(zip(Peak.model_fields, row)) for row in ROWS],
+            "deleted": [7, 3]}
+
+
+def test_byte_compatible_with_fastapi():
+    client = TestClient(reference_app)
+    assert peak_rows_to_json(ROWS) == client.get("/peaks").content
+    assert peak_row_to_json(ROWS[1]) == client.get("/peak").content
+    assert peak_rows_to_json(ROWS) == peaks_to_json(dict(zip(Peak.model_fields, row)) for row in ROWS)
+    assert peak_rows_to_json([]) == b"[]"
+    assert peak_changes_to_json(ROWS, [7, 3], 42, True) == client.get("/changes").content
+
+
+def test_nan_rejected():
+    with pytest.raises(ValueError):
+        peak_rows_to_json([(1, "Nan", 1, float("nan"), 0.0)])
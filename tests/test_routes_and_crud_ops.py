@@ -4,26 +4,44 @@ Near-to integration tests for the API that interacts with a database isolated fr
 - Override the injection of the nominal session by using the "Session = Depends(db)" mechanism
 - test all the endpoints with various tests
 """
+import io
+import json
 import pytest
 from typing import Generator
 
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine, StaticPool
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+from mountain_peaks.backend import import_peaks, main
 from mountain_peaks.backend.main import app
 from mountain_peaks.backend.db.create import Base, get_db, get_session
+from mountain_peaks.backend.app import crud_ops
+from mountain_peaks.backend.app.ingest import PeaksIngestor
 from mountain_peaks.backend.app.crud_ops import (
     add_a_peak,
     delete_a_peak,
     get_a_peak_by_id,
     find_peaks_into_bbox,
+    find_peaks_into_bboxes,
     find_peaks_by_attr,
-    PeakNotFoundException
+    find_peaks_by_attrs,
+    get_peaks_batch,
+    get_peak_changes,
+    add_peaks,
+    delete_peaks,
+    update_peaks,
+    find_nearest_peaks,
+    find_peaks_around,
+    update_a_peak,
+    PeakNotFoundException,
+    PeakAlreadyExistsException,
 )
 
 from mountain_peaks.backend.db.models import DBPeak
-from mountain_peaks.backend.app.schemas import PeakCreate, PeakAttr, BBox
+from mountain_peaks.backend.app.cache import LocalResponseCache, set_response_cache
+from mountain_peaks.backend.app.schemas import PeakCreate, PeakUpdate, PeakBulkUpdate, PeakAttr, BBox, Coords
 
 # Setup the TestClient
 test_client = TestClient(app)
@@ -161,6 +179,12 @@ class TestRoutes:
         # update original dict
         up_data.update(up_data_partial)
         self.compare_peaks(out_data=resp_p.json(), in_data=up_data, peak_id=peak_id)
+        # rename it with the name of another peak
+        resp_dup = test_client.put(f"/peaks/{peak_id}", json={"name": "Test Peak 2"})
+        assert resp_dup.status_code == 400, resp_dup.text
+        # update a none existing peak
+        resp_ko = test_client.put("/peaks/9999", json={"height": 1000})
+        assert resp_ko.status_code == 404, resp_ko.text
 
 
     def test_endpoint_5_delete_peak(self):
@@ -214,6 +238,294 @@ class TestRoutes:
         assert resp_bad_bound.status_code == 422, resp_bad_bound.text
 
 
+    def test_endpoint_8_get_nearest_peaks(self):
+        point = {"latitude": 0, "longitude": 0}
+        resp = test_client.post("/get_nearest_peaks?k=2", json=point)
+        assert resp.status_code == 200, resp.text
+        out_data = resp.json()
+        assert len(out_data) == 2
+        assert out_data[0]["name"] == "Test Peak 1"
+        assert out_data[0]["distance_km"] <= out_data[1]["distance_km"]
+        resp_around = test_client.post("/get_peaks_around?radius_km=1000", json=point)
+        assert resp_around.status_code == 200, resp_around.text
+        assert [p["name"] for p in resp_around.json()] == ["Test Peak 1"]
+        # check a point out of the coordinates bounds
+        resp_bad = test_client.post("/get_nearest_peaks", json={"latitude": 91, "longitude": 0})
+        assert resp_bad.status_code == 422, resp_bad.text
+
+
+    def test_endpoint_9_paginate_and_stream_peaks(self):
+        all_peaks = test_client.get("/peaks").json()
+        assert len(all_peaks) == 3
+        # walk through the pages with the cursor
+        pages, after = [], None
+        while True:
+            params = {"limit": 2} if after is None else {"limit": 2, "after": after}
+            resp = test_client.get("/peaks", params=params)
+            assert resp.status_code == 200, resp.text
+            pages.extend(resp.json())
+            after = resp.headers.get("X-Next-After")
+            if after is None:
+                break
+        assert pages == all_peaks
+        # stream all the peaks as NDJSON
+        resp = test_client.get("/peaks/ndjson", params={"chunk_size": 2})
+        assert resp.status_code == 200, resp.text
+        assert resp.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(line) for line in resp.text.splitlines()] == all_peaks
+
+
+    def test_endpoint_10_import_peaks(self):
+        csv_data = "\n".join([
+            "name,height,latitude,longitude",
+            "Imported Peak 1,1000,10.5,20.5",
+            "Test Peak 2,1000,10.5,20.5",  # already in db
+            "Imported Peak 2,-5,10.5,20.5",  # bad height
+            "Imported Peak 1,2000,11.5,21.5",  # duplicated in the input
+            "Imported Peak 3,3000,12.5,22.5",
+        ])
+        resp = test_client.post("/peaks/import?format=csv&batch_size=2", content=csv_data)
+        assert resp.status_code == 200, resp.text
+        report = resp.json()
+        assert report["inserted"] == 2
+        assert sorted(e["line"] for e in report["errors"]) == [3, 4, 5]
+        ndjson_data = '{"name": "Imported Peak 4", "height": 4000, "latitude": 1, "longitude": 2}\nnot json\n'
+        resp = test_client.post("/peaks/import", content=ndjson_data)
+        assert resp.status_code == 200, resp.text
+        assert resp.json()["inserted"] == 1
+        assert [e["line"] for e in resp.json()["errors"]] == [2]
+        names = [p["name"] for p in test_client.get("/peaks").json()]
+        assert {"Imported Peak 1", "Imported Peak 3", "Imported Peak 4"} <= set(names)
+        assert len(names) == 6
+        resp_bad = test_client.post("/peaks/import?format=xml", content=csv_data)
+        assert resp_bad.status_code == 422, resp_bad.text
+
+
+    def test_endpoint_11_response_cache(self, monkeypatch):
+        set_response_cache(LocalResponseCache())
+        try:
+            resp_1 = test_client.get("/peaks")
+            etag = resp_1.headers["ETag"]
+            # same data, same ETag, and a 304 when the client already has it
+            assert test_client.get("/peaks").content == resp_1.content
+            resp_304 = test_client.get("/peaks", headers={"If-None-Match": etag})
+            assert resp_304.status_code == 304
+            assert resp_304.content == b""
+            # a write is never hidden by the cache
+            in_data = {"name": "Cached Peak", "height": 1500, "latitude": 5.01, "longitude": -5.01}
+            peak_id = test_client.post("/peaks", json=in_data).json()["pid"]
+            resp_2 = test_client.get("/peaks", headers={"If-None-Match": etag})
+            assert resp_2.status_code == 200
+            assert len(resp_2.json()) == len(resp_1.json()) + 1
+            # the bbox entries are shared between close bboxes, and refined to the exact bounds
+            bbox = {"latitude_min": 5.005, "latitude_max": 5.02, "longitude_min": -5.02, "longitude_max": -5.005}
+            resp_bbox = test_client.post("/get_peaks_inside_bbox", json=bbox)
+            assert [p["name"] for p in resp_bbox.json()] == ["Cached Peak"]
+            bbox["latitude_max"] = 5.009
+            assert test_client.post("/get_peaks_inside_bbox", json=bbox).json() == []
+            # the refined result has its own entry, served without decoding the shared one again
+            monkeypatch.setattr(main, "json", None)
+            assert test_client.post("/get_peaks_inside_bbox", json=bbox).content == b"[]"
+            monkeypatch.undo()
+            assert test_client.get(f"/peaks/{peak_id}").status_code == 200
+            assert test_client.post("/get_peaks_from_attr", json={"name": "Cached Peak"}).status_code == 200
+            test_client.delete(f"/peaks/{peak_id}")
+            assert test_client.get(f"/peaks/{peak_id}").status_code == 404
+            assert test_client.post("/get_peaks_from_attr", json={"name": "Cached Peak"}).status_code == 404
+            bbox["latitude_max"] = 5.02
+            assert test_client.post("/get_peaks_inside_bbox", json=bbox).json() == []
+        finally:
+            set_response_cache(None)
+
+
+    def test_endpoint_12_queries_per_route(self, assert_max_queries):
+        in_data = {"name": "Counted Peak", "height": 1500, "latitude": 7.5, "longitude": 8.5}
+        # the writes take their revision, and the deletions write their tombstone, in the same statement
+        peak_id = assert_max_queries(test_client.post("/peaks", json=in_data), 1).json()["pid"]
+        assert assert_max_queries(test_client.get(f"/peaks/{peak_id}"), 1).status_code == 200
+        assert assert_max_queries(test_client.put(f"/peaks/{peak_id}", json={"height": 1600}), 1).status_code == 200
+        assert_max_queries(test_client.get("/peaks"), 1)
+        assert_max_queries(test_client.post("/get_peaks_inside_bbox", json={
+            "latitude_min": 7, "latitude_max": 8, "longitude_min": 8, "longitude_max": 9}), 1)
+        assert assert_max_queries(test_client.delete(f"/peaks/{peak_id}"), 1).status_code == 200
+        metrics = test_client.get("/metrics")
+        assert metrics.status_code == 200, metrics.text
+        assert 'peaks_http_request_duration_seconds_count{method="GET",route="/peaks/{peak_id}",status="200"}' \
+            in metrics.text
+        assert "peaks_db_queries_total" in metrics.text
+
+    def test_endpoint_13_batch_lookups(self, assert_max_queries):
+        pids = [
+            test_client.post("/peaks", json={"name": f"Batch Peak {i}", "height": 3000 + i,
+                                             "latitude": 60.0 + i, "longitude": 20.0 + i}).json()["pid"]
+            for i in range(3)
+        ]
+        resp = assert_max_queries(test_client.post("/peaks/batch", json={"pids": [pids[2], 99999, pids[0]]}), 1)
+        assert resp.status_code == 200, resp.text
+        assert sorted(resp.json()["found"]) == sorted(str(pid) for pid in (pids[0], pids[2]))
+        assert resp.json()["found"][str(pids[2])]["name"] == "Batch Peak 2"
+        assert resp.json()["missing"] == [99999]
+        assert test_client.post("/peaks/batch", json={"pids": []}).status_code == 422
+        resp = assert_max_queries(test_client.post("/get_peaks_from_attrs", json=[
+            {"name": "Batch Peak 1"}, {"height": 3002}, {"name": "Unknown Batch Peak"}]), 1)
+        assert resp.status_code == 200, resp.text
+        assert [[p["pid"] for p in item["peaks"]] for item in resp.json()] == [[pids[1]], pids[1:], []]
+        assert test_client.post("/get_peaks_from_attrs", json=[{}]).status_code == 422
+        resp = assert_max_queries(test_client.post("/get_peaks_inside_bboxes", json=[
+            {"latitude_min": 59.5, "latitude_max": 61.5, "longitude_min": 19.5, "longitude_max": 21.5},
+            {"latitude_min": 61.5, "latitude_max": 62.5, "longitude_min": 21.5, "longitude_max": 22.5},
+            {"latitude_min": -1, "latitude_max": -0.5, "longitude_min": -1, "longitude_max": -0.5},
+        ]), 1)
+        assert resp.status_code == 200, resp.text
+        assert [[p["pid"] for p in item["peaks"]] for item in resp.json()] == [pids[:2], pids[2:], []]
+        assert resp.json()[1]["bbox"]["latitude_min"] == 61.5
+        for pid in pids:
+            test_client.delete(f"/peaks/{pid}")
+
+
+    def test_endpoint_14_bulk_update_and_delete(self, assert_max_queries):
+        pids = [
+            test_client.post("/peaks", json={"name": f"Bulk Peak {i}", "height": 2000 + i,
+                                             "latitude": -60.0 - i, "longitude": -20.0 - i}).json()["pid"]
+            for i in range(3)
+        ]
+        # atomic mode: one unknown pid rejects the whole request
+        resp = test_client.put("/peaks/bulk?atomic=true", json=[
+            {"pid": pids[0], "height": 2100}, {"pid": 99999, "height": 10}])
+        assert resp.status_code == 400, resp.text
+        assert resp.json()["detail"]["errors"] == [{"pid": 99999, "error": "no peak found with this id"}]
+        assert test_client.get(f"/peaks/{pids[0]}").json()["height"] == 2000
+        # default mode: the valid updates are applied, the others reported
+        resp = assert_max_queries(test_client.put("/peaks/bulk", json=[
+            {"pid": pids[0], "height": 2100},
+            {"pid": pids[1], "name": "Bulk Peak renamed", "latitude": -61.5},
+            {"pid": pids[2], "name": "Bulk Peak 0"},
+            {"pid": 99999, "height": 10},
+        ]), 5)
+        assert resp.status_code == 200, resp.text
+        assert [(p["pid"], p["height"], p["name"]) for p in resp.json()["peaks"]] == [
+            (pids[0], 2100, "Bulk Peak 0"), (pids[1], 2001, "Bulk Peak renamed")]
+        assert {e["pid"] for e in resp.json()["errors"]} == {pids[2], 99999}
+        assert test_client.get(f"/peaks/{pids[1]}").json()["latitude"] == -61.5
+        # bulk delete
+        resp = test_client.request("DELETE", "/peaks/bulk?atomic=true", json={"pids": [pids[0], 99999]})
+        assert resp.status_code == 400, resp.text
+        assert test_client.get(f"/peaks/{pids[0]}").status_code == 200
+        resp = assert_max_queries(test_client.request("DELETE", "/peaks/bulk", json={"pids": pids + [99999]}), 1)
+        assert resp.status_code == 200, resp.text
+        assert [p["pid"] for p in resp.json()["peaks"]] == pids
+        assert resp.json()["errors"] == [{"pid": 99999, "error": "no peak found with this id"}]
+        assert test_client.post("/peaks/batch", json={"pids": pids}).json()["missing"] == pids
+
+
+    def test_endpoint_15_get_peaks_clusters(self):
+        pids = [
+            test_client.post("/peaks", json={"name": f"Cluster Peak {i}", "height": 1000 + i,
+                                             "latitude": 30.0 + i / 10, "longitude": 100.0 + i / 10}).json()["pid"]
+            for i in range(3)
+        ]
+        bbox = {"latitude_min": 29, "latitude_max": 31, "longitude_min": 99, "longitude_max": 101}
+        resp = test_client.post("/get_peaks_clusters?zoom=2", json=bbox)
+        assert resp.status_code == 200, resp.text
+        [cluster] = resp.json()
+        assert cluster["count"] == 3
+        assert cluster["highest"]["pid"] == pids[2]
+        assert cluster["centroid"] == {"latitude": pytest.approx(30.1), "longitude": pytest.approx(100.1)}
+        assert (cluster["latitude_min"], cluster["longitude_min"]) == (0.0, 90.0)
+        resp = test_client.post("/get_peaks_clusters?cell_size=0.1", json=bbox)
+        assert [c["count"] for c in resp.json()] == [1, 1, 1]
+        assert test_client.post("/get_peaks_clusters", json=bbox).status_code == 422
+        for pid in pids:
+            test_client.delete(f"/peaks/{pid}")
+
+
+    def test_endpoint_16_antimeridian_and_area(self):
+        pids = [
+            test_client.post("/peaks", json={"name": f"Pacific Peak {i}", "height": 900 + i,
+                                             "latitude": -17.0, "longitude": longitude}).json()["pid"]
+            for i, longitude in enumerate((179.5, -179.5, 170.0))
+        ]
+        across = {"latitude_min": -18, "latitude_max": -16, "longitude_min": 179, "longitude_max": -179}
+        resp = test_client.post("/get_peaks_inside_bbox", json=across)
+        assert resp.status_code == 200, resp.text
+        assert [p["pid"] for p in resp.json()] == pids[:2]
+        area = {
+            "bboxes": [across],
+            "polygons": [{"points": [{"latitude": -20, "longitude": 169}, {"latitude": -15, "longitude": 169},
+                                     {"latitude": -15, "longitude": 171}]}],
+        }
+        resp = test_client.post("/get_peaks_inside_area", json=area)
+        assert resp.status_code == 200, resp.text
+        assert [p["pid"] for p in resp.json()] == pids
+        assert test_client.post("/get_peaks_inside_area", json={"bboxes": []}).status_code == 422
+        # the response cache refines the snapped entry across the antimeridian too
+        set_response_cache(LocalResponseCache())
+        try:
+            cached = test_client.post("/get_peaks_inside_bbox", json=across)
+            assert [p["pid"] for p in cached.json()] == pids[:2]
+        finally:
+            set_response_cache(None)
+        for pid in pids:
+            test_client.delete(f"/peaks/{pid}")
+
+
+    def test_endpoint_17_search_peaks(self):
+        pids = [
+            test_client.post("/peaks", json={"name": name, "height": height, "latitude": 1.0,
+                                             "longitude": 1.0}).json()["pid"]
+            for name, height in (("Search Blanc", 4808), ("Search Blue", 5000), ("Other Search", 6000))
+        ]
+        resp = test_client.get("/peaks/search", params={"q": "search b"})
+        assert resp.status_code == 200, resp.text
+        assert [p["pid"] for p in resp.json()] == [pids[1], pids[0]]
+        assert [p["pid"] for p in test_client.get("/peaks/search", params={"q": "search", "k": 1}).json()] == [pids[1]]
+        assert test_client.get("/peaks/search", params={"q": ""}).status_code == 422
+        for pid in pids:
+            test_client.delete(f"/peaks/{pid}")
+
+    def test_endpoint_18_height_range_and_tallest_peaks(self):
+        pids = [
+            test_client.post("/peaks", json={"name": f"Tall {longitude}", "height": height, "latitude": 60.5,
+                                             "longitude": longitude}).json()["pid"]
+            for height, longitude in ((9001, -150.5), (9002, -150.4), (9003, -140.0), (9003, -150.3))
+        ]
+        resp = test_client.get("/peaks/height_range", params={"height_min": 9001, "height_max": 9003, "limit": 3})
+        assert resp.status_code == 200, resp.text
+        assert [p["pid"] for p in resp.json()] == pids[:3]
+        resp = test_client.get("/peaks/height_range",
+                               params={"height_min": 9002, "height_max": 9100, "order": "desc"})
+        assert [p["pid"] for p in resp.json()] == [pids[3], pids[2], pids[1]]
+        resp = test_client.get("/peaks/height_range", params={"height_min": 9003, "height_max": 9001})
+        assert resp.status_code == 422
+        bbox = {"latitude_min": 60.0, "latitude_max": 61.0, "longitude_min": -151.0, "longitude_max": -150.0}
+        resp = test_client.post("/get_tallest_peaks", params={"n": 2}, json=bbox)
+        assert resp.status_code == 200, resp.text
+        assert [p["pid"] for p in resp.json()] == [pids[3], pids[1]]
+        resp = test_client.post("/get_tallest_peaks", params={"n": 3})
+        assert [p["pid"] for p in resp.json()][:3] == [pids[3], pids[2], pids[1]]
+        for pid in pids:
+            test_client.delete(f"/peaks/{pid}")
+
+    def test_endpoint_19_changes_feed(self):
+        revision = test_client.get("/peaks/changes", params={"since": 0}).json()["revision"]
+        pid_1 = test_client.post("/peaks", json={"name": "Feed 1", "height": 1000, "latitude": 1.0,
+                                                 "longitude": 1.0}).json()["pid"]
+        pid_2 = test_client.post("/peaks", json={"name": "Feed 2", "height": 1000, "latitude": 1.0,
+                                                 "longitude": 1.0}).json()["pid"]
+        test_client.put(f"/peaks/{pid_1}", json={"height": 1100})
+        test_client.delete(f"/peaks/{pid_2}")
+        resp = test_client.get("/peaks/changes", params={"since": revision})
+        assert resp.status_code == 200, resp.text
+        changes = resp.json()
+        assert changes["revision"] == revision + 4 and not changes["more"]
+        assert [(p["pid"], p["height"]) for p in changes["upserted"]] == [(pid_1, 1100)]
+        assert changes["deleted"] == [pid_2]
+        # the next sync only transfers what changed since
+        resp = test_client.get("/peaks/changes", params={"since": changes["revision"]})
+        assert resp.json() == {"revision": changes["revision"], "more": False, "upserted": [], "deleted": []}
+        test_client.delete(f"/peaks/{pid_1}")
+
+
 @pytest.fixture
 def t_session() -> Generator[Session, None, None]:
     # Same utility than setup and teardown but in a single method
@@ -327,3 +639,100 @@ class TestOperations:
         # check if ValueError is correctly raised when max lower than min for a bbox
         with pytest.raises(ValueError):
             _ = BBox(latitude_min=89, latitude_max=-89, longitude_min=0, longitude_max=1)
+
+    def test_operation_8_find_nearest_peaks(self, t_session: Session):
+        # Add peaks on both sides of the antimeridian (already one in db lat:0, lon:0)
+        for i, (lat, lon) in enumerate([(-17.0, 179.9), (-17.0, -179.9), (-18.0, 178.0), (10.0, 10.0)]):
+            add_a_peak(session=t_session,
+                       peak=PeakCreate(name=f"Test Peak {i}", height=1000 + i, latitude=lat, longitude=lon))
+        near = find_nearest_peaks(session=t_session, coords=Coords(latitude=-17.0, longitude=180.0), k=3)
+        assert [p.name for p, _ in near] == ["Test Peak 0", "Test Peak 1", "Test Peak 2"]
+        assert near[0][1] == pytest.approx(10.6, abs=0.1)
+        # more peaks asked than existing ones
+        assert len(find_nearest_peaks(session=t_session, coords=Coords(latitude=0, longitude=0), k=10)) == 5
+        around = find_peaks_around(session=t_session, coords=Coords(latitude=-17.0, longitude=-180.0), radius_km=50)
+        assert sorted(p.name for p, _ in around) == ["Test Peak 0", "Test Peak 1"]
+        assert find_peaks_around(session=t_session, coords=Coords(latitude=89, longitude=0), radius_km=50) == []
+
+    def test_operation_10_import_peaks_cli(self, tmp_path, capsys):
+        input_file = tmp_path / "peaks.ndjson"
+        input_file.write_text(
+            '{"name": "Cli Peak 1", "height": 1000, "latitude": 1.5, "longitude": 2.5}\n'
+            '{"name": "Cli Peak 2", "height": 2000, "latitude": 3.5, "longitude": 4.5}\n'
+        )
+        db_url = f"sqlite:///{tmp_path / 'peaks.db'}"
+        assert import_peaks.main([str(input_file), "--db-url", db_url, "--batch-size", "1"]) == 0
+        assert "2 peaks inserted" in capsys.readouterr().out
+        # importing the same file again rejects all the entries
+        assert import_peaks.main([str(input_file), "--db-url", db_url]) == 1
+
+    def test_operation_11_unique_names(self, t_session: Session):
+        peak = PeakCreate(name="Default Peak 000", height=1000, latitude=1.0, longitude=1.0)
+        with pytest.raises(PeakAlreadyExistsException) as ex:
+            add_a_peak(session=t_session, peak=peak)
+        assert ex.value.args[0] == 123
+        other = add_a_peak(session=t_session, peak=PeakCreate(name="Other", height=1, latitude=1., longitude=1.))
+        with pytest.raises(PeakAlreadyExistsException):
+            update_a_peak(session=t_session, peak_id=other.pid, peak_data=PeakUpdate(name="Default Peak 000"))
+        with pytest.raises(PeakNotFoundException):
+            update_a_peak(session=t_session, peak_id=9999, peak_data=PeakUpdate(height=10))
+        with pytest.raises(PeakNotFoundException):
+            delete_a_peak(session=t_session, peak_id=9999)
+        # the session is still usable after the failures
+        assert get_a_peak_by_id(session=t_session, pid=other.pid).name == "Other"
+        assert update_a_peak(session=t_session, peak_id=other.pid, peak_data=PeakUpdate()).name == "Other"
+
+    def test_operation_12_batch_lookups(self, t_session: Session):
+        other = add_a_peak(session=t_session, peak=PeakCreate(name="Other", height=1235, latitude=45., longitude=6.))
+        found, missing = get_peaks_batch(session=t_session, pids=[other.pid, 5, 123, other.pid])
+        assert sorted(found) == [123, other.pid] and missing == [5]
+        by_attrs = find_peaks_by_attrs(session=t_session, attrs=[PeakAttr(height=1234), PeakAttr(name="None")])
+        assert [[p.pid for p in peaks] for peaks in by_attrs] == [[123, other.pid], []]
+        by_bboxes = find_peaks_into_bboxes(session=t_session, bboxes=[
+            BBox(latitude_min=-1, latitude_max=1, longitude_min=-1, longitude_max=1),
+            BBox(latitude_min=-1, latitude_max=50, longitude_min=-1, longitude_max=10),
+        ])
+        assert [[p.pid for p in peaks] for peaks in by_bboxes] == [[123], [123, other.pid]]
+
+    def test_operation_13_changes_feed(self, t_session: Session):
+        upserted, deleted, revision, more = get_peak_changes(session=t_session, since=0, limit=10)
+        assert [p.pid for p in upserted] == [123] and deleted == [] and revision == 1 and not more
+        peaks = add_peaks(session=t_session, peaks=[
+            PeakCreate(name=f"Feed {i}", height=1000 + i, latitude=1., longitude=1.) for i in range(3)
+        ])
+        update_peaks(session=t_session, updates=[PeakBulkUpdate(pid=peaks[0].pid, height=2000)])
+        delete_peaks(session=t_session, pids=[peaks[1].pid, 999])
+        delete_a_peak(session=t_session, peak_id=123)
+        # revision 2: the 3 inserts, 3: the update of the first one, 4 and 5: the deletions
+        upserted, deleted, revision, more = get_peak_changes(session=t_session, since=1, limit=1)
+        assert [p.pid for p in upserted] == [peaks[2].pid] and deleted == [] and revision == 2 and more
+        upserted, deleted, revision, more = get_peak_changes(session=t_session, since=2, limit=2)
+        assert [p.pid for p in upserted] == [peaks[0].pid] and deleted == [peaks[1].pid]
+        assert revision == 4 and more
+        upserted, deleted, revision, more = get_peak_changes(session=t_session, since=4, limit=100)
+        assert upserted == [] and deleted == [123] and revision == 5 and not more
+        assert get_peak_changes(session=t_session, since=5, limit=100) == ([], [], 5, False)
+
+    def test_operation_14_import_rejections(self, t_session: Session, monkeypatch):
+        insert_peaks = crud_ops.add_peaks
+
+        def failing_add_peaks(session, peaks):
+            if any(peak.name == "Faulty" for peak in peaks):
+                raise IntegrityError("INSERT", {}, Exception("faulty peak"))
+            return insert_peaks(session=session, peaks=peaks)
+
+        monkeypatch.setattr(crud_ops, "add_peaks", failing_add_peaks)
+        ingestor = PeaksIngestor(session=t_session, fmt="csv", batch_size=10)
+        ingestor.feed_lines(io.StringIO(
+            'name,height,latitude,longitude\r\n'
+            '"Twin\r\nPeak",1000,1.5,2.5\r\n'  # quoted line break
+            'A name much longer than thirty characters,1000,1.5,2.5\r\n'
+            'Faulty,1000,1.5,2.5\r\n'
+            'Fine,1000,1.5,2.5\r\n',
+            newline="",
+        ))
+        report = ingestor.close()
+        # the faulty entry is rejected alone, the rest of its batch is inserted
+        assert report.inserted == 2
+        assert [(e.line, e.error.split(":")[0]) for e in report.errors] == [(4, "name"), (5, "Insertion failed")]
+        assert find_peaks_by_attr(session=t_session, attr=PeakAttr(name="Twin\r\nPeak"))[0].height == 1000
@@ -0,0 +1,168 @@
+"""
+Tests of the coalescing of the identical read queries in flight, for the threads and the event loops
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.main import app
+from mountain_peaks.backend.db.create import Base, get_db, get_session
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.app import crud_ops
+from mountain_peaks.backend.app.single_flight import SingleFlight, set_single_flight
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def client():
+    Base.create_all_tables(engine=test_engine)
+    with get_session(engine=test_engine)() as db:
+        db.add_all(
+            DBPeak(pid=pid, name=f"Flying Peak {pid}", height=1000 + pid, latitude=pid, longitude=pid)
+            for pid in range(1, 21)
+        )
+        db.commit()
+
+    def override_get_db():
+        db = get_session(engine=test_engine)()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    single_flight = SingleFlight()
+    set_single_flight(single_flight)
+    yield TestClient(app), single_flight
+    set_single_flight(None)
+    if previous_override is not None:
+        app.dependency_overrides[get_db] = previous_override
+    else:
+        del app.dependency_overrides[get_db]
+    Base.metadata.drop_all(bind=test_engine)
+
+
+class TestSingleFlight:
+
+    def test_threads_share_one_call(self):
+        single_flight, calls, barrier = SingleFlight(), [], threading.Barrier(8)
+
+        def produce():
+            calls.append(1)
+            time.sleep(0.2)
+            return object()
+
+        def request(key):
+            barrier.wait()
+            return single_flight.do(key, produce)
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(request, ["a"] * 6 + ["b"] * 2))
+        assert len(calls) == 2 and len({id(result) for result in results}) == 2
+        assert single_flight.executions == 2 and single_flight.shared == 6
+        # nothing is kept once the call is done
+        assert single_flight.do("a", lambda: "again") == "again"
+
+    def test_threads_share_the_exception(self):
+        single_flight, barrier = SingleFlight(), threading.Barrier(4)
+
+        def produce():
+            time.sleep(0.1)
+            raise crud_ops.PeakNotFoundException
+
+        def request(_):
+            barrier.wait()
+            with pytest.raises(crud_ops.PeakNotFoundException):
+                single_flight.do("missing", produce)
+
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(request, range(4)))
+        assert single_flight.executions == 1
+
+    def test_coroutines_share_one_call(self):
+        single_flight, calls = SingleFlight(), []
+
+        async def produce():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return b"body"
+
+        async def scenario():
+            results = await asyncio.gather(*(single_flight.do_async("bbox", produce) for _ in range(20)))
+            assert results == [b"body"] * 20 and len(calls) == 1
+            # a waiter cancelled does not cancel the call
+            first = asyncio.create_task(single_flight.do_async("bbox", produce))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(single_flight.do_async("bbox", produce))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            assert await first == b"body" and waiter.cancelled() and len(calls) == 2
+            # the owner cancelled, the waiter runs the call again
+            first = asyncio.create_task(single_flight.do_async("bbox", produce))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(single_flight.do_async("bbox", produce))
+            await asyncio.sleep(0)
+            first.cancel()
+            assert await waiter == b"body" and first.cancelled() and len(calls) == 4
+
+        asyncio.run(scenario())
+
+
+def test_identical_requests_share_one_query(client, monkeypatch):
+    test_client, single_flight = client
+    find_peaks_into_bbox, calls = crud_ops.find_peaks_into_bbox, []
+
+    def slow_find_peaks_into_bbox(session, bbox, as_rows=False):
+        calls.append(bbox)
+        time.sleep(0.2)
+        return find_peaks_into_bbox(session=session, bbox=bbox, as_rows=as_rows)
+
+    monkeypatch.setattr(crud_ops, "find_peaks_into_bbox", slow_find_peaks_into_bbox)
+    bbox = {"latitude_min": 2, "latitude_max": 10.0, "longitude_min": 0, "longitude_max": 5}
+    barrier = threading.Barrier(6)
+
+    def request(_):
+        barrier.wait()
+        return test_client.post("/get_peaks_inside_bbox", json=bbox)
+
+    with ThreadPoolExecutor(6) as pool:
+        responses = list(pool.map(request, range(6)))
+    assert len(calls) == 1 and single_flight.shared == 5
+    assert {resp.content for resp in responses} == {responses[0].content}
+    assert [peak["pid"] for peak in responses[0].json()] == [2, 3, 4, 5]
+
+
+def test_writes_split_the_flights(client, monkeypatch):
+    test_client, single_flight = client
+    get_a_peak_by_id = crud_ops.get_a_peak_by_id
+    started, resume = threading.Event(), threading.Event()
+
+    def paused_get_a_peak_by_id(session, pid, as_rows=False):
+        peak = get_a_peak_by_id(session=session, pid=pid, as_rows=as_rows)
+        if not started.is_set():
+            # the first read got the peak before the write
+            started.set()
+            resume.wait(5)
+        return peak
+
+    monkeypatch.setattr(crud_ops, "get_a_peak_by_id", paused_get_a_peak_by_id)
+    with ThreadPoolExecutor(1) as pool:
+        before = pool.submit(test_client.get, "/peaks/3")
+        started.wait(5)
+        assert test_client.put("/peaks/3", json={"height": 3}).status_code == 200
+        # a read arriving after the write does not join the read in flight started before it
+        assert test_client.get("/peaks/3").json()["height"] == 3
+        resume.set()
+        assert before.result().json()["height"] == 1003
+    assert single_flight.shared == 0 and single_flight.executions == 2
@@ -0,0 +1,125 @@
+"""
+Tests of the snapshot export and of the read-only snapshot server, against the db searches
+"""
+import random
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, StaticPool
+
+from mountain_peaks.backend import export_snapshot
+from mountain_peaks.backend.db.create import Base, get_session
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.app.crud_ops import find_peaks_by_attr, find_peaks_into_bbox, get_all_peaks
+from mountain_peaks.backend.app.responses import peak_rows_to_json
+from mountain_peaks.backend.app.schemas import BBox, PeakAttr
+from mountain_peaks.backend.app.snapshot import PeakSnapshot, set_snapshot, write_snapshot
+from mountain_peaks.backend.snapshot_server import app as snapshot_app
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def t_session():
+    Base.create_all_tables(engine=test_engine)
+    db_session = get_session(engine=test_engine)()
+    rnd = random.Random(4)
+    db_session.add_all(
+        DBPeak(pid=pid, name=f"Peak {pid} {'é' * (pid % 3)}", height=rnd.randint(1, 50),
+               latitude=rnd.uniform(-90, 90), longitude=rnd.uniform(-180, 180))
+        for pid in range(1, 3001, 3)
+    )
+    db_session.add(DBPeak(pid=5000, name="Corner", height=10, latitude=90.0, longitude=180.0))
+    db_session.commit()
+    yield db_session
+    db_session.close()
+    set_snapshot(None)
+    Base.metadata.drop_all(bind=test_engine)
+
+
+@pytest.fixture
+def snapshot(t_session, tmp_path):
+    path = str(tmp_path / "peaks.snap")
+    assert write_snapshot(session=t_session, path=path, cell_size=2.0) == 1001
+    return PeakSnapshot.open(path)
+
+
+class TestPeakSnapshot:
+
+    def test_queries_match_the_db(self, t_session, snapshot):
+        assert snapshot.rows() == [tuple(row) for row in get_all_peaks(session=t_session, as_rows=True)]
+        bboxes = [
+            BBox(latitude_min=-10, latitude_max=30, longitude_min=-50.5, longitude_max=20),
+            BBox(latitude_min=-90, latitude_max=90, longitude_min=170, longitude_max=-170),
+            BBox(latitude_min=89, latitude_max=90, longitude_min=179, longitude_max=180),
+            BBox(latitude_min=0, latitude_max=0.001, longitude_min=0, longitude_max=0.001),
+        ]
+        for bbox in bboxes:
+            expected = sorted(tuple(row) for row in find_peaks_into_bbox(session=t_session, bbox=bbox, as_rows=True))
+            assert snapshot.rows(snapshot.positions_in_boxes(bbox.parts())) == expected
+        for height in (1, 25, 50, 51):
+            expected = sorted(
+                tuple(row) for row in get_all_peaks(session=t_session, as_rows=True) if abs(row.height - height) <= 1
+            )
+            assert snapshot.rows(snapshot.positions_by_height(height - 1, height + 1)) == expected
+        for pid in (1, 2998, 5000):
+            name = f"Peak {pid} {'é' * (pid % 3)}" if pid != 5000 else "Corner"
+            rows = find_peaks_by_attr(session=t_session, attr=PeakAttr(name=name), as_rows=True)
+            assert snapshot.rows(snapshot.positions_by_name(name)) == [tuple(row) for row in rows]
+            assert snapshot.rows(np.array([snapshot.position_of(pid)]))[0][0] == pid
+        assert len(snapshot.positions_by_name("Peak 2")) == 0
+        assert snapshot.position_of(2) is None
+        assert snapshot.rows(snapshot.page(limit=2, after=4))[0][0] == 7
+
+    def test_bad_files_rejected(self, tmp_path):
+        path = tmp_path / "bad.snap"
+        path.write_bytes(b"NOTASNAPSHOT" * 10)
+        with pytest.raises(ValueError):
+            PeakSnapshot.open(str(path))
+
+
+class TestSnapshotServer:
+
+    def test_read_endpoints(self, t_session, snapshot):
+        client = TestClient(snapshot_app)
+        assert client.get("/peaks").status_code == 503
+        set_snapshot(snapshot)
+        resp = client.get("/peaks")
+        assert resp.status_code == 200, resp.text
+        assert resp.content == peak_rows_to_json(get_all_peaks(session=t_session, as_rows=True))
+        assert client.get("/peaks", headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+        resp = client.get("/peaks", params={"limit": 2})
+        assert [p["pid"] for p in resp.json()] == [1, 4] and resp.headers["X-Next-After"] == "4"
+        assert client.get("/peaks/4").json()["name"] == "Peak 4 é"
+        assert client.get("/peaks/2").status_code == 404
+        assert [p["pid"] for p in client.post("/get_peaks_from_attr", json={"name": "Corner"}).json()] == [5000]
+        assert client.post("/get_peaks_from_attr", json={"name": "Unknown"}).status_code == 404
+        assert client.post("/get_peaks_from_attr", json={}).status_code == 422
+        bbox = {"latitude_min": 80, "latitude_max": 90, "longitude_min": 179, "longitude_max": -179}
+        resp = client.post("/get_peaks_inside_bbox", json=bbox)
+        expected = find_peaks_into_bbox(session=t_session, bbox=BBox(**bbox), as_rows=True)
+        assert resp.content == peak_rows_to_json(sorted(expected))
+
+    def test_export_command(self, t_session, tmp_path, capsys):
+        path = str(tmp_path / "exported.snap")
+        db_path = tmp_path / "peaks.db"
+        engine = create_engine(f"sqlite:///{db_path}")
+        Base.create_all_tables(engine=engine)
+        with get_session(engine=engine)() as db:
+            db.add(DBPeak(name="Exported", height=100, latitude=1.0, longitude=2.0))
+            db.commit()
+        assert export_snapshot.main([path, "--db-url", f"sqlite:///{db_path}"]) == 0
+        assert "1 peaks exported" in capsys.readouterr().out
+        assert PeakSnapshot.open(path).rows() == [(1, "Exported", 100, 1.0, 2.0)]
+        engine.dispose()
+        # the tables are not created by the export
+        empty_path = tmp_path / "empty.db"
+        assert export_snapshot.main([str(tmp_path / "empty.snap"), "--db-url", f"sqlite:///{empty_path}"]) == 1
+        assert "no peaks table" in capsys.readouterr().err
+        assert not (tmp_path / "empty.snap").exists()
+        assert not inspect(create_engine(f"sqlite:///{empty_path}")).has_table("peaks")
@@ -0,0 +1,162 @@
+"""
+Tests of the in-memory spatial index, standalone and plugged to the crud operations
+"""
+import random
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.db.create import Base, get_session
+from mountain_peaks.backend.app.crud_ops import (
+    add_a_peak, update_a_peak, delete_a_peak, find_peaks_into_area, find_peaks_into_bbox, find_peaks_into_bboxes
+)
+from mountain_peaks.backend.app.schemas import PeakCreate, PeakUpdate, Area, BBox, Coords, Polygon
+from mountain_peaks.backend.app.geo import circle_bounds, haversine_km, points_in_boxes, points_in_polygon
+from mountain_peaks.backend.app.spatial_index import (
+    PeakGridIndex,
+    build_peak_index,
+    get_peak_index,
+    set_peak_index,
+)
+
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def t_session():
+    Base.create_all_tables(engine=test_engine)
+    db_session = get_session(engine=test_engine)()
+    yield db_session
+    db_session.close()
+    set_peak_index(None)
+    Base.metadata.drop_all(bind=test_engine)
+
+
+class TestPeakGridIndex:
+
+    def test_query_matches_brute_force(self):
+        rnd = random.Random(42)
+        points = {pid: (rnd.uniform(-90, 90), rnd.uniform(-180, 180)) for pid in range(1, 2001)}
+        index = PeakGridIndex(cell_size=2.0).load((pid, lat, lon) for pid, (lat, lon) in points.items())
+        assert len(index) == 2000
+        for lat_min, lat_max, lon_min, lon_max in [
+            (-10, 10, -10, 10),
+            (-90, 90, -180, 180),
+            (44.5, 46.3, 6.1, 7.9),
+            (-1, -1, 3, 3),
+        ]:
+            expected = sorted(
+                pid for pid, (lat, lon) in points.items()
+                if lat_min <= lat <= lat_max and lon_min <= lon <= lon_max
+            )
+            assert index.query(lat_min, lat_max, lon_min, lon_max) == expected
+
+    def test_upsert_and_remove(self):
+        index = PeakGridIndex(cell_size=1.0)
+        index.upsert(1, 45.83, 6.86)
+        assert index.query(45, 46, 6, 7) == [1]
+        # moving a peak removes it from its previous cell
+        index.upsert(1, -10.5, 20.2)
+        assert index.query(45, 46, 6, 7) == []
+        assert index.query(-11, -10, 20, 21) == [1]
+        index.remove(1)
+        assert 1 not in index
+        assert index.query(-90, 90, -180, 180) == []
+        # removing an unknown pid is a no-op
+        index.remove(1)
+
+    def test_bad_cell_size(self):
+        with pytest.raises(ValueError):
+            PeakGridIndex(cell_size=0)
+
+
+class TestIndexedOperations:
+
+    def test_index_in_sync_with_crud_ops(self, t_session, monkeypatch):
+        peak_1 = add_a_peak(session=t_session,
+                            peak=PeakCreate(name="Mont Blanc", height=4808, latitude=45.83, longitude=6.86))
+        set_peak_index(build_peak_index(session=t_session))
+        assert get_peak_index().position(peak_1.pid) == (45.83, 6.86)
+        peak_2 = add_a_peak(session=t_session,
+                            peak=PeakCreate(name="Aconcagua", height=6961, latitude=-32.65, longitude=-70.01))
+        assert peak_2.pid in get_peak_index()
+        alps = BBox(latitude_min=40, latitude_max=50, longitude_min=0, longitude_max=10)
+        andes = BBox(latitude_min=-40, latitude_max=-30, longitude_min=-75, longitude_max=-65)
+        assert [p.name for p in find_peaks_into_bbox(session=t_session, bbox=alps)] == ["Mont Blanc"]
+        assert [p.name for p in find_peaks_into_bbox(session=t_session, bbox=andes)] == ["Aconcagua"]
+        by_bboxes = find_peaks_into_bboxes(session=t_session, bboxes=[andes, alps])
+        assert [[p.name for p in peaks] for peaks in by_bboxes] == [["Aconcagua"], ["Mont Blanc"]]
+        # move the first peak to the Andes
+        update_a_peak(session=t_session, peak_id=peak_1.pid,
+                      peak_data=PeakUpdate(latitude=-32.0, longitude=-70.0))
+        assert find_peaks_into_bbox(session=t_session, bbox=alps) == []
+        assert len(find_peaks_into_bbox(session=t_session, bbox=andes)) == 2
+        fiji = add_a_peak(session=t_session,
+                          peak=PeakCreate(name="Tomanivi", height=1324, latitude=-17.62, longitude=178.01))
+        across = BBox(latitude_min=-20, latitude_max=-15, longitude_min=175, longitude_max=-175)
+        assert [p.pid for p in find_peaks_into_bbox(session=t_session, bbox=across)] == [fiji.pid]
+        triangle = Polygon(points=[Coords(latitude=-40, longitude=-75), Coords(latitude=-30, longitude=-75),
+                                   Coords(latitude=-30, longitude=-65)])
+        area = Area(bboxes=[across], polygons=[triangle])
+        # peak_1 (-32.0, -70.0) is inside the triangle, peak_2 (-32.65, -70.01) too
+        assert [p.pid for p in find_peaks_into_area(session=t_session, area=area)] == [peak_1.pid, peak_2.pid, fiji.pid]
+        set_peak_index(None)
+        assert [p.pid for p in find_peaks_into_area(session=t_session, area=area)] == [peak_1.pid, peak_2.pid, fiji.pid]
+        set_peak_index(build_peak_index(session=t_session))
+        # a peak deleted between the query of the index and the read of its position is skipped
+        position = get_peak_index().position
+        monkeypatch.setattr(get_peak_index(), "position", lambda pid: None if pid == peak_2.pid else position(pid))
+        assert [p.pid for p in find_peaks_into_area(session=t_session, area=area)] == [peak_1.pid, fiji.pid]
+        monkeypatch.undo()
+        delete_a_peak(session=t_session, peak_id=peak_2.pid)
+        assert peak_2.pid not in get_peak_index()
+        assert [p.pid for p in find_peaks_into_bbox(session=t_session, bbox=andes)] == [peak_1.pid]
+
+
+class TestGeo:
+
+    def test_haversine(self):
+        # Paris - London, about 344 km
+        assert haversine_km(48.8566, 2.3522, 51.5074, -0.1278) == pytest.approx(343.5, abs=1.0)
+        assert haversine_km(10, 20, 10, 20) == 0.0
+
+    def test_circle_bounds_contain_the_circle(self):
+        rnd = random.Random(7)
+        for latitude, longitude, radius_km in [(45.8, 6.8, 100), (-17.0, 179.5, 300), (88.0, 0.0, 500)]:
+            bounds = circle_bounds(latitude, longitude, radius_km)
+            for _ in range(500):
+                # sample around the center, wrapping the longitude
+                lat = min(90.0, max(-90.0, latitude + rnd.uniform(-6, 6)))
+                lon = (longitude + rnd.uniform(-40, 40) + 180.0) % 360.0 - 180.0
+                if haversine_km(latitude, longitude, lat, lon) <= radius_km:
+                    assert any(b[0] <= lat <= b[1] and b[2] <= lon <= b[3] for b in bounds)
+        # across the antimeridian, two boxes are needed
+        assert len(circle_bounds(-17.0, 179.5, 300)) == 2
+
+    def test_points_in_polygon_match_ray_casting(self):
+        def ray_casting(lat, lon, polygon):
+            inside = False
+            for (lat_i, lon_i), (lat_j, lon_j) in zip(polygon, polygon[-1:] + polygon[:-1]):
+                if (lat_i > lat) != (lat_j > lat) and lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+                    inside = not inside
+            return inside
+
+        rnd = random.Random(5)
+        # concave polygon, with an horizontal edge
+        polygon = [(0.0, 0.0), (10.0, 0.0), (10.0, 10.0), (5.0, 5.0), (0.0, 10.0), (0.0, 5.0)]
+        latitudes = np.array([rnd.uniform(-1, 11) for _ in range(2000)])
+        longitudes = np.array([rnd.uniform(-1, 11) for _ in range(2000)])
+        mask = points_in_polygon(latitudes, longitudes, polygon)
+        assert mask.tolist() == [ray_casting(lat, lon, polygon) for lat, lon in zip(latitudes, longitudes)]
+        assert 0 < mask.sum() < len(mask)
+        boxes = points_in_boxes(latitudes, longitudes, [(0, 1, 0, 1), (5, 6, 5, 6)])
+        assert boxes.sum() == sum(
+            (0 <= lat <= 1 and 0 <= lon <= 1) or (5 <= lat <= 6 and 5 <= lon <= 6)
+            for lat, lon in zip(latitudes, longitudes)
+        )
@@ -0,0 +1,217 @@
+"""
+Tests of the write-behind mode: batched transactions, coalesced updates, size and time triggers,
+tickets outcomes and consistency of the read caches and indexes after a flush
+"""
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, StaticPool
+
+from mountain_peaks.backend.main import app
+from mountain_peaks.backend.db.create import Base, get_db, get_session
+from mountain_peaks.backend.db.models import DBPeak
+from mountain_peaks.backend.app import crud_ops
+from mountain_peaks.backend.app.cache import LocalResponseCache, set_response_cache
+from mountain_peaks.backend.app.schemas import PeakBulkUpdate, PeakCreate, PeakUpdate
+from mountain_peaks.backend.app.spatial_index import build_peak_index, set_peak_index
+from mountain_peaks.backend.app.write_behind import WriteBehindQueue, set_write_behind
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+@pytest.fixture
+def session_factory():
+    Base.create_all_tables(engine=test_engine)
+    with get_session(engine=test_engine)() as db:
+        db.add_all(
+            DBPeak(pid=pid, name=f"Behind Peak {pid}", height=1000 + pid, latitude=pid, longitude=-pid)
+            for pid in range(1, 11)
+        )
+        db.commit()
+    yield get_session(engine=test_engine)
+    Base.metadata.drop_all(bind=test_engine)
+
+
+@pytest.fixture
+def queue(session_factory):
+    write_behind = WriteBehindQueue(session_factory=session_factory, batch_size=100, max_delay=60)
+    write_behind.start()
+    yield write_behind
+    write_behind.close()
+
+
+@pytest.fixture
+def client(session_factory, queue):
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    set_write_behind(queue)
+    yield TestClient(app)
+    set_write_behind(None)
+    set_peak_index(None)
+    set_response_cache(None)
+    if previous_override is not None:
+        app.dependency_overrides[get_db] = previous_override
+    else:
+        del app.dependency_overrides[get_db]
+
+
+def test_write_peaks_single_transaction(session_factory):
+    with session_factory() as db:
+        revision = crud_ops.get_current_revision(session=db)
+        added, updated, errors = crud_ops.write_peaks(
+            session=db,
+            peaks=[PeakCreate(name="New", height=10, latitude=1, longitude=2),
+                   PeakCreate(name="Behind Peak 1", height=10, latitude=1, longitude=2)],
+            updates=[
+                PeakBulkUpdate(pid=2, height=5), PeakBulkUpdate(pid=3, name="New"), PeakBulkUpdate(pid=99, height=1)
+            ],
+        )
+        # the already used names are skipped, the new one is taken by the insert of the same batch
+        assert [peak.name for peak in added] == ["New"]
+        assert [(peak.pid, peak.height) for peak in updated] == [(2, 5)]
+        assert errors == {3: "name New already used by the peak 11", 99: "no peak found with this id"}
+        # on sqlite, the insert and the update statements take a revision each
+        assert crud_ops.get_current_revision(session=db) == revision + 2
+        assert crud_ops.write_peaks(session=db, peaks=[], updates=[PeakBulkUpdate(pid=99, height=1)])[2]
+        assert crud_ops.get_current_revision(session=db) == revision + 2
+
+
+def test_coalesced_updates(queue, session_factory):
+    tickets = [
+        queue.submit_update(4, PeakUpdate(height=1)),
+        queue.submit_update(4, PeakUpdate(name="Renamed", height=2)),
+        queue.submit_update(5, PeakUpdate(latitude=-5)),
+        queue.submit_update(4, PeakUpdate(longitude=44)),
+    ]
+    assert queue.pending() == 2 and all(ticket.status == "pending" for ticket in tickets)
+    assert queue.flush(timeout=5)
+    outcomes = [queue.status(ticket.ticket) for ticket in tickets]
+    assert [outcome.status for outcome in outcomes] == ["applied"] * 4
+    assert outcomes[0].peak == outcomes[1].peak == outcomes[3].peak
+    assert (outcomes[0].peak.name, outcomes[0].peak.height, outcomes[0].peak.longitude) == ("Renamed", 2, 44)
+    assert queue.flushed_batches == 1
+    with session_factory() as db:
+        assert db.get(DBPeak, 5).latitude == -5
+
+
+def test_size_and_time_triggers(session_factory):
+    queue = WriteBehindQueue(session_factory=session_factory, batch_size=3, max_delay=60)
+    queue.start()
+    tickets = [queue.submit_create(PeakCreate(name=f"Sized {i}", height=10, latitude=0, longitude=0)) for i in range(7)]
+    deadline = time.monotonic() + 5
+    while queue.flushed_batches < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # two full batches, the last write waits for the max delay
+    assert queue.flushed_batches == 2 and queue.pending() == 1
+    assert [queue.status(ticket.ticket).status for ticket in tickets] == ["applied"] * 6 + ["pending"]
+    queue.max_delay = 0.01
+    queue.submit_update(1, PeakUpdate(height=3))
+    while queue.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    queue.close()
+    assert queue.flushed_batches == 3 and queue.status(tickets[-1].ticket).status == "applied"
+
+
+def test_rejected_and_failed_writes(queue, monkeypatch):
+    commit_peak_writes = crud_ops.commit_peak_writes
+
+    def failing_commit_peak_writes(session, peaks, updates):
+        if any(peak.name == "Faulty" for peak in peaks):
+            raise ValueError("faulty peak")
+        return commit_peak_writes(session=session, peaks=peaks, updates=updates)
+
+    monkeypatch.setattr(crud_ops, "commit_peak_writes", failing_commit_peak_writes)
+    tickets = [
+        queue.submit_create(PeakCreate(name="Fine", height=10, latitude=0, longitude=0)),
+        queue.submit_create(PeakCreate(name="Fine", height=20, latitude=0, longitude=0)),
+        queue.submit_create(PeakCreate(name="Behind Peak 1", height=10, latitude=0, longitude=0)),
+        queue.submit_create(PeakCreate(name="Faulty", height=10, latitude=0, longitude=0)),
+        queue.submit_update(77, PeakUpdate(height=1)),
+        queue.submit_update(6, PeakUpdate(height=1)),
+    ]
+    assert queue.flush(timeout=5)
+    outcomes = [queue.status(ticket.ticket) for ticket in tickets]
+    # the faulty write fails alone, the others are written again without it
+    statuses = [outcome.status for outcome in outcomes]
+    assert statuses == ["applied", "rejected", "rejected", "failed", "rejected", "applied"]
+    assert outcomes[3].error == "Write failed: ValueError"
+    assert outcomes[4].error == "no peak found with this id"
+
+
+def test_failure_after_commit(queue, session_factory, monkeypatch):
+    commits = []
+    commit_peak_writes = crud_ops.commit_peak_writes
+
+    def counted_commit_peak_writes(session, peaks, updates):
+        commits.append(len(peaks) + len(updates))
+        return commit_peak_writes(session=session, peaks=peaks, updates=updates)
+
+    def failing_sync_indexes(upserted, removed_pids):
+        raise RuntimeError("index failure")
+
+    monkeypatch.setattr(crud_ops, "commit_peak_writes", counted_commit_peak_writes)
+    monkeypatch.setattr(crud_ops, "_sync_indexes", failing_sync_indexes)
+    cache = LocalResponseCache()
+    set_response_cache(cache)
+    try:
+        tickets = [
+            queue.submit_create(PeakCreate(name="Committed", height=10, latitude=0, longitude=0)),
+            queue.submit_update(3, PeakUpdate(height=3)),
+        ]
+        assert queue.flush(timeout=5)
+        # the committed batch is not written again by halves, and the cache doesn't serve the older data
+        assert commits == [2] and cache.data_version() == 1
+        outcomes = [queue.status(ticket.ticket) for ticket in tickets]
+        assert [outcome.status for outcome in outcomes] == ["applied", "applied"]
+        assert outcomes[0].peak.name == "Committed" and outcomes[1].peak is None
+        assert outcomes[0].error == "Written, but the indexes may be out of sync: RuntimeError"
+    finally:
+        set_response_cache(None)
+    with session_factory() as db:
+        assert db.get(DBPeak, 3).height == 3
+
+
+def test_routes(client, queue, session_factory):
+    with session_factory() as db:
+        set_peak_index(build_peak_index(session=db))
+    set_response_cache(LocalResponseCache())
+    bbox = {"latitude_min": 40, "latitude_max": 50, "longitude_min": 0, "longitude_max": 10}
+    assert client.post("/get_peaks_inside_bbox", json=bbox).json() == []
+    assert client.get("/peaks/7").json()["height"] == 1007
+    resp = client.post("/peaks/write_behind", json={"name": "Queued", "height": 10, "latitude": 45, "longitude": 5})
+    assert resp.status_code == 202 and resp.json()["status"] == "pending"
+    created = resp.json()["ticket"]
+    updated = client.put("/peaks/write_behind/7", json={"height": 7}).json()["ticket"]
+    assert client.get(f"/peaks/write_behind/{created}").json()["status"] == "pending"
+    assert client.put("/peaks/write_behind/7", json={"height": -1}).status_code == 422
+    assert queue.flush(timeout=5)
+    resp = client.get(f"/peaks/write_behind/{created}")
+    assert resp.json()["status"] == "applied" and resp.json()["peak"]["name"] == "Queued"
+    assert client.get(f"/peaks/write_behind/{updated}").json()["peak"]["height"] == 7
+    # the spatial index and the cached responses follow the flushed batch
+    assert [peak["name"] for peak in client.post("/get_peaks_inside_bbox", json=bbox).json()] == ["Queued"]
+    assert client.get("/peaks/7").json()["height"] == 7
+    assert "peaks_write_behind_batches_total 1" in client.get("/metrics").text
+    assert client.get("/peaks/write_behind/unknown").status_code == 404
+    set_write_behind(None)
+    assert client.put("/peaks/write_behind/7", json={"height": 7}).status_code == 404
+
+
+def test_queue_full(client, session_factory):
+    queue = WriteBehindQueue(session_factory=session_factory, max_pending=1, max_delay=60)
+    set_write_behind(queue)
+    assert client.put("/peaks/write_behind/1", json={"height": 7}).status_code == 202
+    resp = client.put("/peaks/write_behind/2", json={"height": 7})
+    assert resp.status_code == 503 and resp.headers["Retry-After"] == "1"